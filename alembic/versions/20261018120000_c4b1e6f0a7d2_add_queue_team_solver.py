@@ -0,0 +1,33 @@
+"""Add queue team solver
+
+Revision ID: c4b1e6f0a7d2
+Revises: 1872970f1238
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "c4b1e6f0a7d2"
+down_revision = "1872970f1238"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("queue", schema=None) as batch_op:
+        batch_op.add_column(
+            sa.Column(
+                "team_solver",
+                sa.String(),
+                server_default="auto",
+                nullable=False,
+            )
+        )
+
+
+def downgrade():
+    with op.batch_alter_table("queue", schema=None) as batch_op:
+        batch_op.drop_column("team_solver")
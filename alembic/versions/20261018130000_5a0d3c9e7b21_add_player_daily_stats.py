@@ -0,0 +1,97 @@
+"""Add player daily stats
+
+Revision ID: 5a0d3c9e7b21
+Revises: c4b1e6f0a7d2
+Create Date: 2026-10-18 13:00:00.000000
+
+"""
+from uuid import uuid4
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "5a0d3c9e7b21"
+down_revision = "c4b1e6f0a7d2"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    player_daily_stats = op.create_table(
+        "player_daily_stats",
+        sa.Column("player_id", sa.BigInteger(), nullable=False),
+        sa.Column("day", sa.Date(), nullable=False),
+        sa.Column("wins", sa.Integer(), nullable=False),
+        sa.Column("losses", sa.Integer(), nullable=False),
+        sa.Column("ties", sa.Integer(), nullable=False),
+        sa.Column("id", sa.String(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["player_id"],
+            ["player.id"],
+            name=op.f("fk_player_daily_stats_player_id_player"),
+        ),
+        sa.PrimaryKeyConstraint("id", name=op.f("pk_player_daily_stats")),
+        sa.UniqueConstraint(
+            "player_id", "day", name=op.f("uq_player_daily_stats_player_id")
+        ),
+    )
+    op.create_index(
+        op.f("ix_player_daily_stats_player_id"),
+        "player_daily_stats",
+        ["player_id"],
+        unique=False,
+    )
+    op.create_index(
+        "ix_player_leaderboard_trueskill",
+        "player",
+        [sa.text("(rated_trueskill_mu - 3 * rated_trueskill_sigma)")],
+        unique=False,
+    )
+
+    # Count every game that has already been finished
+    rows = op.get_bind().execute(
+        sa.text(
+            """
+            SELECT
+                finished_game_player.player_id,
+                CAST(finished_game.finished_at AS DATE) AS day,
+                COUNT(*) FILTER (
+                    WHERE finished_game_player.team = finished_game.winning_team
+                ) AS wins,
+                COUNT(*) FILTER (
+                    WHERE finished_game.winning_team != -1
+                    AND finished_game_player.team != finished_game.winning_team
+                ) AS losses,
+                COUNT(*) FILTER (WHERE finished_game.winning_team = -1) AS ties
+            FROM finished_game_player
+            JOIN finished_game
+                ON finished_game.id = finished_game_player.finished_game_id
+            JOIN player ON player.id = finished_game_player.player_id
+            GROUP BY finished_game_player.player_id, day
+            """
+        )
+    )
+    op.bulk_insert(
+        player_daily_stats,
+        [
+            {
+                "id": str(uuid4()),
+                "player_id": row.player_id,
+                "day": row.day,
+                "wins": row.wins,
+                "losses": row.losses,
+                "ties": row.ties,
+            }
+            for row in rows
+        ],
+    )
+
+
+def downgrade():
+    op.drop_index("ix_player_leaderboard_trueskill", table_name="player")
+    op.drop_index(
+        op.f("ix_player_daily_stats_player_id"), table_name="player_daily_stats"
+    )
+    op.drop_table("player_daily_stats")
@@ -0,0 +1,37 @@
+"""Add leaderboard indexes
+
+Revision ID: 8e2f4b6a1c93
+Revises: 5a0d3c9e7b21
+Create Date: 2026-10-18 14:00:00.000000
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "8e2f4b6a1c93"
+down_revision = "5a0d3c9e7b21"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        "ix_finished_game_player_player_id_finished_game_id",
+        "finished_game_player",
+        ["player_id", "finished_game_id"],
+        unique=False,
+    )
+    op.create_index(
+        "ix_finished_game_started_at_finished_at",
+        "finished_game",
+        ["started_at", "finished_at"],
+        unique=False,
+    )
+
+
+def downgrade():
+    op.drop_index("ix_finished_game_started_at_finished_at", table_name="finished_game")
+    op.drop_index(
+        "ix_finished_game_player_player_id_finished_game_id",
+        table_name="finished_game_player",
+    )
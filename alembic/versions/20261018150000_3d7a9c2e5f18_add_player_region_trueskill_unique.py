@@ -0,0 +1,45 @@
+"""Add player region trueskill unique constraint
+
+Revision ID: 3d7a9c2e5f18
+Revises: 8e2f4b6a1c93
+Create Date: 2026-10-18 15:00:00.000000
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "3d7a9c2e5f18"
+down_revision = "8e2f4b6a1c93"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Keep the most recently created rating if a player somehow ended up with
+    # more than one in a region
+    op.execute(
+        sa.text(
+            """
+            DELETE FROM player_region_trueskill AS duplicate
+            USING player_region_trueskill AS kept
+            WHERE duplicate.player_id = kept.player_id
+                AND duplicate.queue_region_id = kept.queue_region_id
+                AND (COALESCE(duplicate.created_at, '-infinity'), duplicate.id)
+                    < (COALESCE(kept.created_at, '-infinity'), kept.id)
+            """
+        )
+    )
+    with op.batch_alter_table("player_region_trueskill", schema=None) as batch_op:
+        batch_op.create_unique_constraint(
+            batch_op.f("uq_player_region_trueskill_player_id"),
+            ["player_id", "queue_region_id"],
+        )
+
+
+def downgrade():
+    with op.batch_alter_table("player_region_trueskill", schema=None) as batch_op:
+        batch_op.drop_constraint(
+            batch_op.f("uq_player_region_trueskill_player_id"), type_="unique"
+        )
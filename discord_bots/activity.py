@@ -0,0 +1,169 @@
+# Buffers player activity (messages and reactions in the bot channel) in
+# memory and writes it to the player table in bulk, instead of a SELECT and a
+# commit for every single message.
+#
+# Players the bot has never seen are written right away, commands expect the
+# player row to exist by the time they run. Everyone else is only written when
+# the buffer is flushed: every ACTIVITY_FLUSH_SECONDS (see
+# tasks.activity_flush_task), before the AFK sweep and on shutdown.
+#
+# Messages in the bot channel also keep players' names up to date. Reactions
+# can come from anywhere, so they only name players the bot hasn't seen yet.
+from dataclasses import dataclass
+from datetime import datetime, timezone
+
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session as SQLAlchemySession
+
+from discord_bots.log import define_logger
+from discord_bots.models import (
+    Player,
+    Session,
+    default_trueskill_mu,
+    default_trueskill_sigma,
+)
+
+log = define_logger(__name__)
+
+
+@dataclass
+class PlayerActivity:
+    """
+    :update_name: Whether name replaces the name of an existing player
+    """
+
+    last_seen: datetime
+    name: str
+    update_name: bool = True
+
+    def merge(self, other: "PlayerActivity") -> None:
+        """
+        Fold in activity recorded after this
+        """
+        self.last_seen = max(self.last_seen, other.last_seen)
+        if other.update_name or not self.update_name:
+            self.name = other.name
+        self.update_name = self.update_name or other.update_name
+
+
+class ActivityTracker:
+    def __init__(self):
+        self._buffer: dict[int, PlayerActivity] = {}
+        self._known_player_ids: set[int] = set()
+        self._is_loaded = False
+        self.recorded = 0
+        self.flushed = 0
+
+    def load(self, session: SQLAlchemySession | None = None) -> None:
+        """
+        Load the ids of every player that already has a row
+        """
+        if session is None:
+            with Session() as session:
+                self.load(session)
+            return
+        self._known_player_ids = {
+            player_id for player_id, in session.query(Player.id)
+        }
+        self._is_loaded = True
+
+    def record(
+        self,
+        player_id: int,
+        name: str,
+        seen_at: datetime | None = None,
+        update_name: bool = True,
+    ) -> None:
+        """
+        Buffer a player's activity, updates for the same player are coalesced
+        into one row. New players are written right away.
+
+        :update_name: False to only use the name if the player is new
+        """
+        if not self._is_loaded:
+            self.load()
+        seen_at = seen_at or datetime.now(timezone.utc)
+        self.recorded += 1
+        activity = PlayerActivity(seen_at, name, update_name)
+        buffered = self._buffer.get(player_id)
+        if buffered is None:
+            self._buffer[player_id] = activity
+        else:
+            buffered.merge(activity)
+        if player_id not in self._known_player_ids:
+            self.flush()
+
+    def pending(self) -> int:
+        return len(self._buffer)
+
+    def flush(self) -> int:
+        """
+        Write and commit everything buffered with an INSERT ... ON CONFLICT
+        DO UPDATE for the players to rename and one for everyone else
+
+        :returns: Number of players written
+        """
+        if not self._buffer:
+            return 0
+
+        buffer = self._buffer
+        self._buffer = {}
+        try:
+            with Session() as session:
+                for update_name in (True, False):
+                    activities = {
+                        player_id: activity
+                        for player_id, activity in buffer.items()
+                        if activity.update_name == update_name
+                    }
+                    if activities:
+                        session.execute(self._upsert_statement(activities, update_name))
+                session.commit()
+        except Exception:
+            # Put it back so it's written with the next flush, keeping
+            # anything recorded since
+            for player_id, activity in buffer.items():
+                newer = self._buffer.get(player_id)
+                if newer is not None:
+                    activity.merge(newer)
+                self._buffer[player_id] = activity
+            raise
+        self._known_player_ids.update(buffer)
+        self.flushed += len(buffer)
+        log.debug(
+            f"[ActivityTracker.flush] {len(buffer)} players, "
+            f"{self.recorded} updates recorded / {self.flushed} rows written so far"
+        )
+        return len(buffer)
+
+    @staticmethod
+    def _upsert_statement(activities: dict[int, PlayerActivity], update_name: bool):
+        statement = insert(Player).values(
+            [
+                {
+                    "id": player_id,
+                    "name": activity.name,
+                    "last_activity_at": activity.last_seen,
+                    "is_admin": False,
+                    "is_banned": False,
+                    "rated_trueskill_mu": default_trueskill_mu,
+                    "rated_trueskill_sigma": default_trueskill_sigma,
+                    "unrated_trueskill_mu": default_trueskill_mu,
+                    "unrated_trueskill_sigma": default_trueskill_sigma,
+                }
+                for player_id, activity in activities.items()
+            ]
+        )
+        set_ = {
+            # Activity may have been written directly in the meantime
+            "last_activity_at": func.greatest(
+                Player.last_activity_at, statement.excluded.last_activity_at
+            ),
+        }
+        if update_name:
+            set_["name"] = statement.excluded.name
+        return statement.on_conflict_do_update(index_elements=[Player.id], set_=set_)
+
+
+activity_tracker = ActivityTracker()
@@ -1,10 +1,7 @@
-import heapq
+import asyncio
 import os
 import sys
-from bisect import bisect
-from collections import defaultdict
 from datetime import datetime, timedelta, timezone
-from itertools import combinations
 from math import floor
 from random import randint, random, shuffle
 from tempfile import NamedTemporaryFile
@@ -19,16 +16,20 @@ from discord.ext import commands
 from discord.ext.commands.context import Context
 from discord.member import Member
 from discord.utils import escape_markdown
+from sqlalchemy import and_, func, select
 from sqlalchemy.exc import IntegrityError
-from trueskill import Rating, rate
+from sqlalchemy.orm import Session as SQLAlchemySession
+from trueskill import Rating
 
 import discord_bots.config as config
 from discord_bots.utils import (
     upload_stats_screenshot_imgkit,
     update_current_map,
+    ilike,
     is_really_numeric,
 )
 from .bot import bot
+from .log import define_logger
 from .models import (
     AdminRole,
     CurrentMap,
@@ -43,7 +44,6 @@ from .models import (
     PlayerRegionTrueskill,
     Queue,
     QueueNotification,
-    QueuePlayer,
     QueueRegion,
     QueueRole,
     QueueWaitlist,
@@ -55,6 +55,23 @@ from .models import (
 )
 from .names import generate_be_name, generate_ds_name
 from .queues import AddPlayerQueueMessage, add_player_queue
+from .custom_commands import custom_command_registry
+from .game_ratings import rate_game, write_game_ratings
+from .in_game import in_game_index
+from .leaderboard import LeaderboardEntry, leaderboard_service
+from .permissions import permission_cache
+from .player_stats import get_player_stats, get_rating_percentile, record_game_outcome
+from .queue_state import QueueState, plan_queue_adds, queue_state
+from .rating_replay import RATINGS_LOCK_KEY, recompute_ratings
+from .scheduler import queue_waitlist_scheduler, vote_passed_waitlist_scheduler
+from .snapshot import SystemSnapshot, load_system_snapshot
+from .teams import (
+    TEAM_SOLVERS,
+    compute_team_split,
+    get_best_and_worst_team_indices,
+    prefix_sum_win_probability,
+    rating_prefix_sums,
+)
 from .twitch import twitch
 from .utils import (
     get_current_map_readonly,
@@ -63,115 +80,117 @@ from .utils import (
     send_message,
     short_uuid,
     update_current_map_to_next_map_in_rotation,
-    win_probability,
 )
 
+log = define_logger(__name__)
+
+# Held while editgamewinner replays ratings, finishgame waits for it instead
+# of rating a game from ratings the replay is about to overwrite
+ratings_lock = asyncio.Lock()
+
 
-def get_even_teams(
-        player_ids: list[int], team_size: int, is_rated: bool, queue_region_id: str | None
+async def get_even_teams(
+        player_ids: list[int],
+        team_size: int,
+        is_rated: bool,
+        queue_region_id: str | None,
+        team_solver: str = "auto",
 ) -> tuple[list[Player], float]:
     """
-    TODO: Tests
     TODO: Re-use get_n_teams function
 
     Try to figure out even teams, the first half of the returning list is
     the first team, the second half is the second team.
 
+    The ratings are read here and the search itself runs on a worker pool, see
+    teams.compute_team_split
+
+    :team_solver: See teams.solve_team_split
     :returns: list of players and win probability for the first team
     """
-    session = Session()
     shuffle(player_ids)
-    players: list[Player] = (
-        session.query(Player).filter(Player.id.in_(player_ids)).all()
-    )
-    if queue_region_id:
-        player_region_trueskills = session.query(PlayerRegionTrueskill).filter(
-            PlayerRegionTrueskill.player_id.in_(player_ids),
-            PlayerRegionTrueskill.queue_region_id == queue_region_id,
+    with Session() as session:
+        players: list[Player] = (
+            session.query(Player).filter(Player.id.in_(player_ids)).all()
         )
-        player_region_trueskills = {
-            prt.player_id: prt for prt in player_region_trueskills
-        }
-    else:
-        player_region_trueskills = {}
-    best_win_prob_so_far: float = 0.0
-    best_teams_so_far: list[Player] = []
-
-    # We only take half the combinations because they end up repeating. i.e.
-    # [1,2] vs [3,4] is the same as [3,4] vs [1,2]
-    all_combinations = list(combinations(players, team_size))
-    for team0 in all_combinations[: len(all_combinations) // 2]:
-        team1 = [p for p in players if p not in team0]
-        if is_rated:
-            team0_ratings = []
-            for player in team0:
-                if queue_region_id and player.id in player_region_trueskills:
-                    player_region_trueskill = player_region_trueskills[player.id]
-                    team0_ratings.append(
-                        Rating(
-                            player_region_trueskill.rated_trueskill_mu,
-                            player_region_trueskill.rated_trueskill_sigma,
-                        )
-                    )
-                else:
-                    team0_ratings.append(
-                        Rating(player.rated_trueskill_mu, player.rated_trueskill_sigma)
-                    )
-            team1_ratings = []
-            for player in team1:
-                if queue_region_id and player.id in player_region_trueskills:
-                    player_region_trueskill = player_region_trueskills[player.id]
-                    team1_ratings.append(
-                        Rating(
-                            player_region_trueskill.rated_trueskill_mu,
-                            player_region_trueskill.rated_trueskill_sigma,
-                        )
-                    )
-                else:
-                    team1_ratings.append(
-                        Rating(player.rated_trueskill_mu, player.rated_trueskill_sigma)
-                    )
+        if queue_region_id:
+            player_region_trueskills = session.query(PlayerRegionTrueskill).filter(
+                PlayerRegionTrueskill.player_id.in_(player_ids),
+                PlayerRegionTrueskill.queue_region_id == queue_region_id,
+            )
+            player_region_trueskills = {
+                prt.player_id: prt for prt in player_region_trueskills
+            }
         else:
-            team0_ratings = []
-            for player in team0:
-                if queue_region_id and player.id in player_region_trueskills:
-                    player_region_trueskill = player_region_trueskills[player.id]
-                    team0_ratings.append(
-                        Rating(
-                            player_region_trueskill.unrated_trueskill_mu,
-                            player_region_trueskill.unrated_trueskill_sigma,
-                        )
-                    )
-                else:
-                    team0_ratings.append(
-                        Rating(
-                            player.unrated_trueskill_mu, player.unrated_trueskill_sigma
-                        )
-                    )
-            team1_ratings = []
-            for player in team1:
-                if queue_region_id and player.id in player_region_trueskills:
-                    player_region_trueskill = player_region_trueskills[player.id]
-                    team1_ratings.append(
-                        Rating(
-                            player_region_trueskill.unrated_trueskill_mu,
-                            player_region_trueskill.unrated_trueskill_sigma,
-                        )
+            player_region_trueskills = {}
+
+    ratings: list[tuple[float, float]] = []
+    for player in players:
+        if queue_region_id and player.id in player_region_trueskills:
+            player_region_trueskill = player_region_trueskills[player.id]
+            if is_rated:
+                ratings.append(
+                    (
+                        player_region_trueskill.rated_trueskill_mu,
+                        player_region_trueskill.rated_trueskill_sigma,
                     )
-                else:
-                    team1_ratings.append(
-                        Rating(
-                            player.unrated_trueskill_mu, player.unrated_trueskill_sigma
-                        )
+                )
+            else:
+                ratings.append(
+                    (
+                        player_region_trueskill.unrated_trueskill_mu,
+                        player_region_trueskill.unrated_trueskill_sigma,
                     )
-        win_prob = win_probability(team0_ratings, team1_ratings)
-        current_team_evenness = abs(0.50 - win_prob)
-        best_team_evenness_so_far = abs(0.50 - best_win_prob_so_far)
-        if current_team_evenness < best_team_evenness_so_far:
-            best_win_prob_so_far = win_prob
-            best_teams_so_far = list(team0[:]) + list(team1[:])
+                )
+        elif is_rated:
+            ratings.append((player.rated_trueskill_mu, player.rated_trueskill_sigma))
+        else:
+            ratings.append(
+                (player.unrated_trueskill_mu, player.unrated_trueskill_sigma)
+            )
+
+    team_split = await compute_team_split(ratings, team_size, team_solver)
+    log.info(
+        f"[get_even_teams] {len(players)} players, solver: {team_split.solver}, "
+        f"optimal: {team_split.is_optimal}, evenness: {round(team_split.evenness, 4)}"
+    )
+    return [players[i] for i in team_split.indices], team_split.win_probability
 
-    return best_teams_so_far, best_win_prob_so_far
+
+def _best_and_worst_teams(
+        items: list,
+        ratings: list[Rating],
+        team_size: int,
+        n_best: int,
+        n_worst: int,
+) -> tuple[list[tuple[float, list]], list[tuple[float, list]]]:
+    """
+    Materialize get_best_and_worst_team_indices for the winning splits only.
+    Worst teams are scored negatively so both lists sort ascending, the same
+    as the direction argument of get_n_teams.
+    """
+    best, worst = get_best_and_worst_team_indices(ratings, team_size, n_best, n_worst)
+    return (
+        [(evenness, [items[i] for i in indices]) for evenness, indices in best],
+        [(-evenness, [items[i] for i in indices]) for evenness, indices in worst],
+    )
+
+
+def get_best_and_worst_teams(
+        players: list[Player],
+        team_size: int,
+        is_rated: bool,
+        n_best: int,
+        n_worst: int,
+) -> tuple[list[tuple[float, list[Player]]], list[tuple[float, list[Player]]]]:
+    """
+    The n_best most even and n_worst least even teams in a single pass
+    """
+    if is_rated:
+        ratings = [Rating(p.rated_trueskill_mu, p.rated_trueskill_sigma) for p in players]
+    else:
+        ratings = [Rating(p.unrated_trueskill_mu, p.unrated_trueskill_sigma) for p in players]
+    return _best_and_worst_teams(players, ratings, team_size, n_best, n_worst)
 
 
 # Return n of the most even or least even teams
@@ -182,66 +201,51 @@ def get_n_teams(
         is_rated: bool,
         n: int,
         direction: int = 1,
-) -> list[tuple[list[Player], float]]:
-    teams: list[tuple[float, list[Player]]] = []
-
-    # We only take half the combinations because they end up repeating. i.e.
-    # [1,2] vs [3,4] is the same as [3,4] vs [1,2]
-    all_combinations = list(combinations(players, team_size))
-    for team0 in all_combinations[: len(all_combinations) // 2]:
-        team1 = [p for p in players if p not in team0]
-        if is_rated:
-            team0_ratings = list(
-                map(
-                    lambda x: Rating(x.rated_trueskill_mu, x.rated_trueskill_sigma),
-                    team0,
-                )
-            )
-            team1_ratings = list(
-                map(
-                    lambda x: Rating(x.rated_trueskill_mu, x.rated_trueskill_sigma),
-                    team1,
-                )
-            )
-        else:
-            team0_ratings = list(
-                map(
-                    lambda x: Rating(x.unrated_trueskill_mu, x.unrated_trueskill_sigma),
-                    team0,
-                )
-            )
-            team1_ratings = list(
-                map(
-                    lambda x: Rating(x.unrated_trueskill_mu, x.unrated_trueskill_sigma),
-                    team1,
-                )
-            )
-
-        win_prob = win_probability(team0_ratings, team1_ratings)
-        current_team_evenness = abs(0.50 - win_prob)
-        heapq.heappush(
-            teams, (direction * current_team_evenness, list(team0[:]) + list(team1[:]))
-        )
-
-    teams_out = []
-    for _ in range(n):
-        teams_out.append(heapq.heappop(teams))
-
-    return teams_out
+) -> list[tuple[float, list[Player]]]:
+    if direction == 1:
+        return get_best_and_worst_teams(players, team_size, is_rated, n, 0)[0]
+    return get_best_and_worst_teams(players, team_size, is_rated, 0, n)[1]
 
 
 def get_n_best_teams(
         players: list[Player], team_size: int, is_rated: bool, n: int
-) -> list[tuple[list[Player], float]]:
+) -> list[tuple[float, list[Player]]]:
     return get_n_teams(players, team_size, is_rated, n, 1)
 
 
 def get_n_worst_teams(
         players: list[Player], team_size: int, is_rated: bool, n: int
-) -> list[tuple[list[Player], float]]:
+) -> list[tuple[float, list[Player]]]:
     return get_n_teams(players, team_size, is_rated, n, -1)
 
 
+def get_best_and_worst_finished_game_teams(
+        fgps: list[FinishedGamePlayer],
+        team_size: int,
+        is_rated: bool,
+        n_best: int,
+        n_worst: int,
+) -> tuple[
+    list[tuple[float, list[FinishedGamePlayer]]],
+    list[tuple[float, list[FinishedGamePlayer]]],
+]:
+    """
+    The n_best most even and n_worst least even teams in a single pass, using
+    the ratings from before the game
+    """
+    if is_rated:
+        ratings = [
+            Rating(fgp.rated_trueskill_mu_before, fgp.rated_trueskill_sigma_before)
+            for fgp in fgps
+        ]
+    else:
+        ratings = [
+            Rating(fgp.unrated_trueskill_mu_before, fgp.unrated_trueskill_sigma_before)
+            for fgp in fgps
+        ]
+    return _best_and_worst_teams(fgps, ratings, team_size, n_best, n_worst)
+
+
 # Return n of the most even or least even teams
 # For best teams, use direction = 1, for worst teams use direction = -1
 def get_n_finished_game_teams(
@@ -250,264 +254,258 @@ def get_n_finished_game_teams(
         is_rated: bool,
         n: int,
         direction: int = 1,
-) -> list[tuple[list[FinishedGamePlayer], float]]:
-    teams: list[tuple[float, list[FinishedGamePlayer]]] = []
-
-    # We only take half the combinations because they end up repeating. i.e.
-    # [1,2] vs [3,4] is the same as [3,4] vs [1,2]
-    all_combinations = list(combinations(fgps, team_size))
-    for team0 in all_combinations[: len(all_combinations) // 2]:
-        team1 = [p for p in fgps if p not in team0]
-        if is_rated:
-            team0_ratings = list(
-                map(
-                    lambda x: Rating(
-                        x.rated_trueskill_mu_before, x.rated_trueskill_sigma_before
-                    ),
-                    team0,
-                )
-            )
-            team1_ratings = list(
-                map(
-                    lambda x: Rating(
-                        x.rated_trueskill_mu_before, x.rated_trueskill_sigma_before
-                    ),
-                    team1,
-                )
-            )
-        else:
-            team0_ratings = list(
-                map(
-                    lambda x: Rating(
-                        x.unrated_trueskill_mu_before, x.unrated_trueskill_sigma_before
-                    ),
-                    team0,
-                )
-            )
-            team1_ratings = list(
-                map(
-                    lambda x: Rating(
-                        x.unrated_trueskill_mu_before, x.unrated_trueskill_sigma_before
-                    ),
-                    team1,
-                )
-            )
-
-        win_prob = win_probability(team0_ratings, team1_ratings)
-        current_team_evenness = abs(0.50 - win_prob)
-        heapq.heappush(
-            teams, (direction * current_team_evenness, list(team0[:]) + list(team1[:]))
-        )
-
-    teams_out = []
-    for _ in range(n):
-        teams_out.append(heapq.heappop(teams))
-
-    return teams_out
+) -> list[tuple[float, list[FinishedGamePlayer]]]:
+    if direction == 1:
+        return get_best_and_worst_finished_game_teams(fgps, team_size, is_rated, n, 0)[0]
+    return get_best_and_worst_finished_game_teams(fgps, team_size, is_rated, 0, n)[1]
 
 
 def get_n_best_finished_game_teams(
         fgps: list[FinishedGamePlayer], team_size: int, is_rated: bool, n: int
-) -> list[tuple[list[FinishedGamePlayer], float]]:
+) -> list[tuple[float, list[FinishedGamePlayer]]]:
     return get_n_finished_game_teams(fgps, team_size, is_rated, n, 1)
 
 
 def get_n_worst_finished_game_teams(
         fgps: list[FinishedGamePlayer], team_size: int, is_rated: bool, n: int
-) -> list[tuple[list[FinishedGamePlayer], float]]:
+) -> list[tuple[float, list[FinishedGamePlayer]]]:
     return get_n_finished_game_teams(fgps, team_size, is_rated, n, -1)
 
 
-async def add_player_to_queue(queue_id: str, player_id: int) -> tuple[bool, bool]:
+async def pop_queue(session, queue: Queue, player_ids: list[int]) -> InProgressGame:
     """
-    Helper function to add player to a queue and pop if needed.
-
-    TODO: Remove this function, it's only called in one place so just inline it
+    Start a game for a queue that just filled up: balance the teams, message
+    the players and create the voice channels.
 
-    :returns: A tuple of booleans - the first represents whether the player was
-    added to the queue, the second represents whether the queue popped as a
-    result.
+    Doesn't remove the players from the queues or commit, that's left to the
+    caller so several pops can share one transaction.
     """
-    session = Session()
-    queue_roles = session.query(QueueRole).filter(QueueRole.queue_id == queue_id).all()
     guild = bot.get_channel(config.CHANNEL_ID).guild
+    if len(player_ids) == 1:
+        # Useful for debugging, no real world application
+        players = session.query(Player).filter(Player.id == player_ids[0]).all()
+        win_prob = 0
+    else:
+        players, win_prob = await get_even_teams(
+            player_ids,
+            len(player_ids) // 2,
+            is_rated=queue.is_rated,
+            queue_region_id=queue.queue_region_id,
+            team_solver=queue.team_solver,
+        )
+    if queue.is_rated:
+        average_trueskill = mean(list(map(lambda x: x.rated_trueskill_mu, players)))
+    else:
+        average_trueskill = mean(
+            list(map(lambda x: x.unrated_trueskill_mu, players))
+        )
+    current_map, current_map_full = get_current_map_readonly()
+    game = InProgressGame(
+        average_trueskill=average_trueskill,
+        map_full_name=current_map_full.full_name if current_map_full else "",
+        map_short_name=current_map_full.short_name if current_map_full else "",
+        queue_id=queue.id,
+        team0_name=generate_be_name(),
+        team1_name=generate_ds_name(),
+        win_probability=win_prob,
+    )
+    session.add(game)
 
-    # Zero queue roles means no role restrictions
-    if len(queue_roles) > 0:
-        member = guild.get_member(player_id)
-        if not member:
-            return False, False
-        queue_role_ids = set(map(lambda x: x.role_id, queue_roles))
-        player_role_ids = set(map(lambda x: x.id, member.roles))
-        has_role = len(queue_role_ids.intersection(player_role_ids)) > 0
-        if not has_role:
-            return False, False
+    team0_players = players[: len(players) // 2]
+    team1_players = players[len(players) // 2:]
 
-    if is_in_game(player_id):
-        return False, False
+    short_game_id = short_uuid(game.id)
+    message_content = f"Game '{queue.name}' ({short_game_id}) has begun!"
+    message_embed = f"**Map: {game.map_full_name} ({game.map_short_name})**\n"
+    message_embed += pretty_format_team(game.team0_name, win_prob, team0_players)
+    message_embed += pretty_format_team(
+        game.team1_name, 1 - win_prob, team1_players
+    )
 
-    session.add(
-        QueuePlayer(
-            queue_id=queue_id,
-            player_id=player_id,
+    for player in team0_players:
+        if not config.DISABLE_PRIVATE_MESSAGES:
+            member: Member | None = guild.get_member(player.id)
+            if member:
+                try:
+                    await member.send(
+                        content=message_content,
+                        embed=Embed(
+                            description=f"{message_embed}",
+                            colour=Colour.blue(),
+                        ),
+                    )
+                except Exception:
+                    pass
+
+        game_player = InProgressGamePlayer(
+            in_progress_game_id=game.id,
+            player_id=player.id,
+            team=0,
         )
+        session.add(game_player)
+
+    for player in team1_players:
+        if not config.DISABLE_PRIVATE_MESSAGES:
+            member: Member | None = guild.get_member(player.id)
+            if member:
+                try:
+                    await member.send(
+                        content=message_content,
+                        embed=Embed(
+                            description=f"{message_embed}",
+                            colour=Colour.blue(),
+                        ),
+                    )
+                except Exception:
+                    pass
+
+        game_player = InProgressGamePlayer(
+            in_progress_game_id=game.id,
+            player_id=player.id,
+            team=1,
+        )
+        session.add(game_player)
+
+    channel = bot.get_channel(config.CHANNEL_ID)
+    await send_message(
+        channel,
+        content=message_content,
+        embed_description=message_embed,
+        colour=Colour.blue(),
     )
-    try:
-        session.commit()
-    except IntegrityError:
+
+    categories = {category.id: category for category in guild.categories}
+    tribes_voice_category = categories[config.TRIBES_VOICE_CATEGORY_CHANNEL_ID]
+
+    be_channel = await guild.create_voice_channel(
+        f"{game.team0_name}", category=tribes_voice_category, bitrate=96000
+    )
+    ds_channel = await guild.create_voice_channel(
+        f"{game.team1_name}", category=tribes_voice_category, bitrate=96000
+    )
+    session.add(
+        InProgressGameChannel(in_progress_game_id=game.id, channel_id=be_channel.id)
+    )
+    session.add(
+        InProgressGameChannel(in_progress_game_id=game.id, channel_id=ds_channel.id)
+    )
+
+    session.query(MapVote).delete()
+    session.query(SkipMapVote).delete()
+    return game
+
+
+async def add_players_to_queues(
+        requests: list[tuple[int, list[str]]]
+) -> list[tuple[list[str], bool]]:
+    """
+    Add players to queues in one go and pop the queues that fill up.
+
+    Each request is a player id and the queues to add them to, tried in the
+    order given. Role eligibility and whether the player is in a game are
+    checked once per player. As soon as one of a player's queues pops the
+    rest of their queues are skipped, so shuffle the queue ids first for
+    POP_RANDOM_QUEUE. Requests are applied in order, so a player who ends up in
+    a game from an earlier request isn't added anywhere by a later one.
+
+    All of the new queue_player rows are inserted in one statement and
+    committed before any queue pops, the pops then share a transaction. A
+    queue that was left full by a failed pop pops on the next add. Games
+    that pop in the same batch are on the same map, the map rotates once per
+    pop afterwards.
+
+    :returns: For each request, the ids of the queues the player was added to
+    and whether a queue popped as a result
+    """
+    guild = bot.get_channel(config.CHANNEL_ID).guild
+
+    def player_role_ids(player_id: int) -> set[int] | None:
+        member: Member | None = guild.get_member(player_id)
+        return set(map(lambda x: x.id, member.roles)) if member else None
+
+    # Planned twice at most: if queue_player was changed without going
+    # through the cache, the insert is rolled back and the adds are planned
+    # again against what's in the database
+    for _ in range(2):
+        plan = plan_queue_adds(
+            queue_state.queues(), requests, player_role_ids, is_in_game
+        )
+        if not plan.new_rows and not plan.pops:
+            return plan.results
+
+        session = Session()
+        try:
+            is_in_sync = queue_state.add_players(session, plan.new_rows)
+        except IntegrityError:
+            # E.g. a queue was deleted
+            is_in_sync = False
+        if is_in_sync:
+            # Commit before popping, which talks to Discord, so the rows
+            # aren't left uncommitted while other commands change the queues
+            session.commit()
+            break
         session.rollback()
         session.close()
-        return False, False
-
-    queue: Queue = session.query(Queue).filter(Queue.id == queue_id).first()
-    queue_players: list[QueuePlayer] = (
-        session.query(QueuePlayer).filter(QueuePlayer.queue_id == queue_id).all()
-    )
-    if len(queue_players) == queue.size:  # Pop!
-        player_ids: list[int] = list(map(lambda x: x.player_id, queue_players))
-        if len(player_ids) == 1:
-            # Useful for debugging, no real world application
-            players = session.query(Player).filter(Player.id == player_ids[0]).all()
-            win_prob = 0
-        else:
-            players, win_prob = get_even_teams(
-                player_ids,
-                len(player_ids) // 2,
-                is_rated=queue.is_rated,
-                queue_region_id=queue.queue_region_id,
-            )
-        if queue.is_rated:
-            average_trueskill = mean(list(map(lambda x: x.rated_trueskill_mu, players)))
-        else:
-            average_trueskill = mean(
-                list(map(lambda x: x.unrated_trueskill_mu, players))
-            )
-        current_map, current_map_full = get_current_map_readonly()
-        game = InProgressGame(
-            average_trueskill=average_trueskill,
-            map_full_name=current_map_full.full_name if current_map_full else "",
-            map_short_name=current_map_full.short_name if current_map_full else "",
-            queue_id=queue.id,
-            team0_name=generate_be_name(),
-            team1_name=generate_ds_name(),
-            win_probability=win_prob,
-        )
-        session.add(game)
-
-        team0_players = players[: len(players) // 2]
-        team1_players = players[len(players) // 2:]
-
-        short_game_id = short_uuid(game.id)
-        message_content = f"Game '{queue.name}' ({short_game_id}) has begun!"
-        message_embed = f"**Map: {game.map_full_name} ({game.map_short_name})**\n"
-        message_embed += pretty_format_team(game.team0_name, win_prob, team0_players)
-        message_embed += pretty_format_team(
-            game.team1_name, 1 - win_prob, team1_players
-        )
-
-        for player in team0_players:
-            if not config.DISABLE_PRIVATE_MESSAGES:
-                member: Member | None = guild.get_member(player.id)
-                if member:
-                    try:
-                        await member.send(
-                            content=message_content,
-                            embed=Embed(
-                                description=f"{message_embed}",
-                                colour=Colour.blue(),
-                            ),
-                        )
-                    except Exception:
-                        pass
+        queue_state.invalidate()
+    else:
+        return [([], False) for _ in requests]
+    results = plan.results
+    pops = plan.pops
+    popped_player_ids = {
+        player_id for _, pop_player_ids in pops for player_id in pop_player_ids
+    }
 
-            game_player = InProgressGamePlayer(
-                in_progress_game_id=game.id,
-                player_id=player.id,
-                team=0,
+    games: list[tuple[str, list[int]]] = []
+    try:
+        for queue_id, pop_player_ids in pops:
+            queue: Queue = session.query(Queue).filter(Queue.id == queue_id).first()
+            game = await pop_queue(session, queue, pop_player_ids)
+            games.append((game.id, pop_player_ids))
+        queue_state.remove_players(session, popped_player_ids)
+
+        popped_queue_ids = {queue_id for queue_id, _ in pops}
+        for queue_id, sizes in plan.reached_sizes.items():
+            if queue_id in popped_queue_ids:
+                continue
+            queue_notifications: list[QueueNotification] = (
+                session.query(QueueNotification)
+                .filter(
+                    QueueNotification.queue_id == queue_id,
+                    QueueNotification.size.in_(sizes),  # type: ignore
+                )
+                .all()
             )
-            session.add(game_player)
-
-        for player in team1_players:
-            if not config.DISABLE_PRIVATE_MESSAGES:
-                member: Member | None = guild.get_member(player.id)
+            for queue_notification in queue_notifications:
+                member: Member | None = guild.get_member(queue_notification.player_id)
                 if member:
                     try:
                         await member.send(
-                            content=message_content,
                             embed=Embed(
-                                description=f"{message_embed}",
+                                description=f"'{queue_state.get(queue_id).name}' is at {queue_notification.size} players!",
                                 colour=Colour.blue(),
-                            ),
+                            )
                         )
                     except Exception:
                         pass
-
-            game_player = InProgressGamePlayer(
-                in_progress_game_id=game.id,
-                player_id=player.id,
-                team=1,
-            )
-            session.add(game_player)
-
-        channel = bot.get_channel(config.CHANNEL_ID)
-        await send_message(
-            channel,
-            content=message_content,
-            embed_description=message_embed,
-            colour=Colour.blue(),
-        )
-
-        categories = {category.id: category for category in guild.categories}
-        tribes_voice_category = categories[config.TRIBES_VOICE_CATEGORY_CHANNEL_ID]
-
-        be_channel = await guild.create_voice_channel(
-            f"{game.team0_name}", category=tribes_voice_category, bitrate=96000
-        )
-        ds_channel = await guild.create_voice_channel(
-            f"{game.team1_name}", category=tribes_voice_category, bitrate=96000
-        )
-        session.add(
-            InProgressGameChannel(in_progress_game_id=game.id, channel_id=be_channel.id)
-        )
-        session.add(
-            InProgressGameChannel(in_progress_game_id=game.id, channel_id=ds_channel.id)
-        )
-
-        session.query(QueuePlayer).filter(
-            QueuePlayer.player_id.in_(player_ids)  # type: ignore
-        ).delete()
-        session.query(MapVote).delete()
-        session.query(SkipMapVote).delete()
+                session.delete(queue_notification)
         session.commit()
-        if not queue.is_isolated:
-            await update_current_map_to_next_map_in_rotation()
-        return True, True
-
-    queue_notifications: list[QueueNotification] = (
-        session.query(QueueNotification)
-        .filter(
-            QueueNotification.queue_id == queue_id,
-            QueueNotification.size == len(queue_players),
-        )
-        .all()
-    )
-    for queue_notification in queue_notifications:
-        member: Member | None = guild.get_member(queue_notification.player_id)
-        if member:
-            try:
-                await member.send(
-                    embed=Embed(
-                        description=f"'{queue.name}' is at {queue_notification.size} players!",
-                        colour=Colour.blue(),
-                    )
-                )
-            except Exception:
-                pass
-        session.delete(queue_notification)
-    session.commit()
-    session.close()
+    except Exception:
+        session.rollback()
+        # The caches were updated as if the pops went through
+        queue_state.invalidate()
+        in_game_index.invalidate()
+        raise
+    finally:
+        session.close()
+    for game_id, game_player_ids in games:
+        in_game_index.add_game(game_id, game_player_ids)
 
-    return True, False
+    # Rotating the map deletes the map votes in its own session, so it has to
+    # wait until the pops are committed
+    for queue_id, _ in pops:
+        if not queue_state.get(queue_id).is_isolated:
+            await update_current_map_to_next_map_in_rotation()
+    return results
 
 
 async def is_admin(ctx: Context):
@@ -516,36 +514,26 @@ async def is_admin(ctx: Context):
 
     https://discordpy.readthedocs.io/en/stable/ext/commands/commands.html#global-checks
     """
-    with Session() as session:
-        message: Message = ctx.message
-        caller = (
-            session.query(Player)
-            .filter(Player.id == message.author.id, Player.is_admin == True)
-            .first()
-        )
-        if caller:
-            return True
+    message: Message = ctx.message
+    if permission_cache.is_admin(message.author.id):
+        return True
 
-        if not message.guild:
-            return False
+    if not message.guild:
+        return False
 
-        member = message.guild.get_member(message.author.id)
-        if not member:
-            return False
+    member = message.guild.get_member(message.author.id)
+    if not member:
+        return False
 
-        admin_roles = session.query(AdminRole).all()
-        admin_role_ids = map(lambda x: x.role_id, admin_roles)
-        member_role_ids = map(lambda x: x.id, member.roles)
-        is_admin: bool = len(set(admin_role_ids).intersection(set(member_role_ids))) > 0
-        if is_admin:
-            return True
-        else:
-            await send_message(
-                message.channel,
-                embed_description="You must be an admin to use that command",
-                colour=Colour.red(),
-            )
-            return False
+    if permission_cache.is_admin(member.id, {role.id for role in member.roles}):
+        return True
+    else:
+        await send_message(
+            message.channel,
+            embed_description="You must be an admin to use that command",
+            colour=Colour.red(),
+        )
+        return False
 
 
 def mock_teams_str(
@@ -557,22 +545,17 @@ def mock_teams_str(
     Helper method to debug print teams if these were the players
     """
     output = ""
+    players = team0_players + team1_players
     if is_rated:
-        team0_rating = [
-            Rating(p.rated_trueskill_mu, p.rated_trueskill_sigma) for p in team0_players
-        ]
-        team1_rating = [
-            Rating(p.rated_trueskill_mu, p.rated_trueskill_sigma) for p in team1_players
-        ]
+        mu_sums, sigma_squared_sums = rating_prefix_sums(
+            [p.rated_trueskill_mu for p in players],
+            [p.rated_trueskill_sigma for p in players],
+        )
     else:
-        team0_rating = [
-            Rating(p.unrated_trueskill_mu, p.unrated_trueskill_sigma)
-            for p in team0_players
-        ]
-        team1_rating = [
-            Rating(p.unrated_trueskill_mu, p.unrated_trueskill_sigma)
-            for p in team1_players
-        ]
+        mu_sums, sigma_squared_sums = rating_prefix_sums(
+            [p.unrated_trueskill_mu for p in players],
+            [p.unrated_trueskill_sigma for p in players],
+        )
 
     team0_names = ", ".join(
         sorted([escape_markdown(player.name) for player in team0_players])
@@ -580,7 +563,10 @@ def mock_teams_str(
     team1_names = ", ".join(
         sorted([escape_markdown(player.name) for player in team1_players])
     )
-    team0_win_prob = round(100 * win_probability(team0_rating, team1_rating), 1)
+    team0_win_prob = round(
+        100 * prefix_sum_win_probability(mu_sums, sigma_squared_sums, len(team0_players)),
+        1,
+    )
     team1_win_prob = round(100 - team0_win_prob, 1)
     if is_rated:
         team0_mu = round(
@@ -627,24 +613,17 @@ def mock_finished_game_teams_str(
     """
     output = ""
     session = Session()
+    fg_players = team0_fg_players + team1_fg_players
     if is_rated:
-        team0_rating = [
-            Rating(fgp.rated_trueskill_mu_before, fgp.rated_trueskill_sigma_before)
-            for fgp in team0_fg_players
-        ]
-        team1_rating = [
-            Rating(fgp.rated_trueskill_mu_before, fgp.rated_trueskill_sigma_before)
-            for fgp in team1_fg_players
-        ]
+        mu_sums, sigma_squared_sums = rating_prefix_sums(
+            [fgp.rated_trueskill_mu_before for fgp in fg_players],
+            [fgp.rated_trueskill_sigma_before for fgp in fg_players],
+        )
     else:
-        team0_rating = [
-            Rating(fgp.unrated_trueskill_mu_before, fgp.unrated_trueskill_sigma_before)
-            for fgp in team0_fg_players
-        ]
-        team1_rating = [
-            Rating(fgp.unrated_trueskill_mu_before, fgp.unrated_trueskill_sigma_before)
-            for fgp in team1_fg_players
-        ]
+        mu_sums, sigma_squared_sums = rating_prefix_sums(
+            [fgp.unrated_trueskill_mu_before for fgp in fg_players],
+            [fgp.unrated_trueskill_sigma_before for fgp in fg_players],
+        )
 
     team0_player_ids = set(map(lambda x: x.player_id, team0_fg_players))
     team1_player_ids = set(map(lambda x: x.player_id, team1_fg_players))
@@ -660,7 +639,13 @@ def mock_finished_game_teams_str(
     team1_names = ", ".join(
         sorted([escape_markdown(player.name) for player in team1_players])
     )
-    team0_win_prob = round(100 * win_probability(team0_rating, team1_rating), 1)
+    team0_win_prob = round(
+        100
+        * prefix_sum_win_probability(
+            mu_sums, sigma_squared_sums, len(team0_fg_players)
+        ),
+        1,
+    )
     team1_win_prob = round(100 - team0_win_prob, 1)
     if is_rated:
         team0_mu = round(
@@ -701,155 +686,147 @@ def mock_finished_game_teams_str(
     return output
 
 
-def finished_game_str(finished_game: FinishedGame, debug: bool = False) -> str:
+def load_finished_game_players(
+    session: SQLAlchemySession, finished_games: list[FinishedGame]
+) -> dict[str, list[FinishedGamePlayer]]:
+    """
+    Fetch the players of several finished games in one query, for rendering
+    them with finished_game_str
+
+    :returns: finished_game.id -> players
+    """
+    fg_players_by_game_id: dict[str, list[FinishedGamePlayer]] = {
+        finished_game.id: [] for finished_game in finished_games
+    }
+    if not fg_players_by_game_id:
+        return fg_players_by_game_id
+    fgp: FinishedGamePlayer
+    for fgp in session.query(FinishedGamePlayer).filter(
+        FinishedGamePlayer.finished_game_id.in_(fg_players_by_game_id)  # type: ignore
+    ):
+        fg_players_by_game_id[fgp.finished_game_id].append(fgp)
+    return fg_players_by_game_id
+
+
+def finished_game_str(
+    finished_game: FinishedGame,
+    debug: bool = False,
+    fg_players: list[FinishedGamePlayer] | None = None,
+) -> str:
     """
     Helper method to pretty print a finished game
+
+    :fg_players: The game's players, see load_finished_game_players. Queried
+    if not passed in
     """
-    with Session() as session:
-        output = ""
-        short_game_id = short_uuid(finished_game.game_id)
-        team0_fg_players: list[FinishedGamePlayer] = (
-            session.query(FinishedGamePlayer)
-            .filter(
-                FinishedGamePlayer.finished_game_id == finished_game.id,
-                FinishedGamePlayer.team == 0,
-            )
-            .all()
+    if fg_players is None:
+        with Session() as session:
+            fg_players = load_finished_game_players(session, [finished_game])[
+                finished_game.id
+            ]
+    output = ""
+    short_game_id = short_uuid(finished_game.game_id)
+    team0_fg_players = [fgp for fgp in fg_players if fgp.team == 0]
+    team1_fg_players = [fgp for fgp in fg_players if fgp.team == 1]
+
+    if finished_game.is_rated:
+        average_mu = mean(
+            [fgp.rated_trueskill_mu_before for fgp in team0_fg_players + team1_fg_players]
         )
-        team1_fg_players: list[FinishedGamePlayer] = (
-            session.query(FinishedGamePlayer)
-            .filter(
-                FinishedGamePlayer.finished_game_id == finished_game.id,
-                FinishedGamePlayer.team == 1,
-            )
-            .all()
+        average_sigma = mean(
+            [
+                fgp.rated_trueskill_sigma_before
+                for fgp in team0_fg_players + team1_fg_players
+            ]
+        )
+    else:
+        average_mu = mean(
+            [
+                fgp.unrated_trueskill_mu_before
+                for fgp in team0_fg_players + team1_fg_players
+            ]
+        )
+        average_sigma = mean(
+            [
+                fgp.unrated_trueskill_sigma_before
+                for fgp in team0_fg_players + team1_fg_players
+            ]
         )
 
-        if finished_game.is_rated:
-            average_mu = mean(
-                [
-                    fgp.rated_trueskill_mu_before
-                    for fgp in team0_fg_players + team1_fg_players
-                ]
-            )
-            average_sigma = mean(
-                [
-                    fgp.rated_trueskill_sigma_before
-                    for fgp in team0_fg_players + team1_fg_players
-                ]
-            )
-        else:
-            average_mu = mean(
-                [
-                    fgp.unrated_trueskill_mu_before
-                    for fgp in team0_fg_players + team1_fg_players
-                ]
-            )
-            average_sigma = mean(
-                [
-                    fgp.unrated_trueskill_sigma_before
-                    for fgp in team0_fg_players + team1_fg_players
-                ]
-            )
+    output += f"**{finished_game.queue_name}** ({short_game_id}) - Map: **{finished_game.map_full_name}**"
+    if debug:
+        output += f" (mu: {round(average_mu, 2)}, sigma: {round(average_sigma, 2)})"
 
-        output += f"**{finished_game.queue_name}** ({short_game_id}) - Map: **{finished_game.map_full_name}**"
-        if debug:
-            output += f" (mu: {round(average_mu, 2)}, sigma: {round(average_sigma, 2)})"
-
-        team0_player_ids = set(map(lambda x: x.player_id, team0_fg_players))
-        team1_player_ids = set(map(lambda x: x.player_id, team1_fg_players))
-        team0_fgp_by_id = {fgp.player_id: fgp for fgp in team0_fg_players}
-        team1_fgp_by_id = {fgp.player_id: fgp for fgp in team1_fg_players}
-        team0_players: list[Player] = session.query(Player).filter(Player.id.in_(team0_player_ids))  # type: ignore
-        team1_players: list[Player] = session.query(Player).filter(Player.id.in_(team1_player_ids))  # type: ignore
-        if debug and False:
-            team0_names = ", ".join(
-                sorted(
-                    [
-                        f"{escape_markdown(player.name)} ({round(team0_fgp_by_id[player.id].rated_trueskill_mu_before, 1)})"
-                        for player in team0_players
-                    ]
-                )
-            )
-            team1_names = ", ".join(
-                sorted(
-                    [
-                        f"{escape_markdown(player.name)} ({round(team1_fgp_by_id[player.id].rated_trueskill_mu_before, 1)})"
-                        for player in team1_players
-                    ]
-                )
-            )
-        else:
-            team0_names = ", ".join(
-                sorted([escape_markdown(player.name) for player in team0_players])
-            )
-            team1_names = ", ".join(
-                sorted([escape_markdown(player.name) for player in team1_players])
-            )
-        team0_win_prob = round(100 * finished_game.win_probability, 1)
-        team1_win_prob = round(100 - team0_win_prob, 1)
-        if finished_game.is_rated:
-            team0_mu = round(
-                mean([player.rated_trueskill_mu_before for player in team0_fg_players]), 2
-            )
-            team1_mu = round(
-                mean([player.rated_trueskill_mu_before for player in team1_fg_players]), 2
-            )
-            team0_sigma = round(
-                mean([player.rated_trueskill_sigma_before for player in team0_fg_players]),
-                2,
-            )
-            team1_sigma = round(
-                mean([player.rated_trueskill_sigma_before for player in team1_fg_players]),
-                2,
-            )
-        else:
-            team0_mu = round(
-                mean([player.unrated_trueskill_mu_before for player in team0_fg_players]), 2
-            )
-            team1_mu = round(
-                mean([player.unrated_trueskill_mu_before for player in team1_fg_players]), 2
-            )
-            team0_sigma = round(
-                mean(
-                    [player.unrated_trueskill_sigma_before for player in team0_fg_players]
-                ),
-                2,
-            )
-            team1_sigma = round(
-                mean(
-                    [player.unrated_trueskill_sigma_before for player in team1_fg_players]
-                ),
-                2,
-            )
-        if debug:
-            team0_str = f"{finished_game.team0_name} ({team0_win_prob}%, mu: {team0_mu}, sigma: {team0_sigma}): {team0_names}"
-            team1_str = f"{finished_game.team1_name} ({team1_win_prob}%, mu: {team1_mu}, sigma: {team1_sigma}): {team1_names}"
-        else:
-            team0_str = f"{finished_game.team0_name} ({team0_win_prob}%): {team0_names}"
-            team1_str = f"{finished_game.team1_name} ({team1_win_prob}%): {team1_names}"
-
-        if finished_game.winning_team == 0:
-            output += f"\n**{team0_str}**"
-            output += f"\n{team1_str}"
-        elif finished_game.winning_team == 1:
-            output += f"\n{team0_str}"
-            output += f"\n**{team1_str}**"
-        else:
-            output += f"\n{team0_str}"
-            output += f"\n{team1_str}"
-        delta: timedelta = datetime.now(timezone.utc) - finished_game.finished_at.replace(
-            tzinfo=timezone.utc
-        )
-        if delta.days > 0:
-            output += f"\n@ {delta.days} days ago\n"
-        elif delta.seconds > 3600:
-            hours_ago = delta.seconds // 3600
-            output += f"\n@ {hours_ago} hours ago\n"
-        else:
-            minutes_ago = delta.seconds // 60
-            output += f"\n@ {minutes_ago} minutes ago\n"
-        return output
+    team0_names = ", ".join(
+        sorted([escape_markdown(fgp.player_name) for fgp in team0_fg_players])
+    )
+    team1_names = ", ".join(
+        sorted([escape_markdown(fgp.player_name) for fgp in team1_fg_players])
+    )
+    team0_win_prob = round(100 * finished_game.win_probability, 1)
+    team1_win_prob = round(100 - team0_win_prob, 1)
+    if finished_game.is_rated:
+        team0_mu = round(
+            mean([player.rated_trueskill_mu_before for player in team0_fg_players]), 2
+        )
+        team1_mu = round(
+            mean([player.rated_trueskill_mu_before for player in team1_fg_players]), 2
+        )
+        team0_sigma = round(
+            mean([player.rated_trueskill_sigma_before for player in team0_fg_players]),
+            2,
+        )
+        team1_sigma = round(
+            mean([player.rated_trueskill_sigma_before for player in team1_fg_players]),
+            2,
+        )
+    else:
+        team0_mu = round(
+            mean([player.unrated_trueskill_mu_before for player in team0_fg_players]), 2
+        )
+        team1_mu = round(
+            mean([player.unrated_trueskill_mu_before for player in team1_fg_players]), 2
+        )
+        team0_sigma = round(
+            mean(
+                [player.unrated_trueskill_sigma_before for player in team0_fg_players]
+            ),
+            2,
+        )
+        team1_sigma = round(
+            mean(
+                [player.unrated_trueskill_sigma_before for player in team1_fg_players]
+            ),
+            2,
+        )
+    if debug:
+        team0_str = f"{finished_game.team0_name} ({team0_win_prob}%, mu: {team0_mu}, sigma: {team0_sigma}): {team0_names}"
+        team1_str = f"{finished_game.team1_name} ({team1_win_prob}%, mu: {team1_mu}, sigma: {team1_sigma}): {team1_names}"
+    else:
+        team0_str = f"{finished_game.team0_name} ({team0_win_prob}%): {team0_names}"
+        team1_str = f"{finished_game.team1_name} ({team1_win_prob}%): {team1_names}"
+
+    if finished_game.winning_team == 0:
+        output += f"\n**{team0_str}**"
+        output += f"\n{team1_str}"
+    elif finished_game.winning_team == 1:
+        output += f"\n{team0_str}"
+        output += f"\n**{team1_str}**"
+    else:
+        output += f"\n{team0_str}"
+        output += f"\n{team1_str}"
+    delta: timedelta = datetime.now(timezone.utc) - finished_game.finished_at.replace(
+        tzinfo=timezone.utc
+    )
+    if delta.days > 0:
+        output += f"\n@ {delta.days} days ago\n"
+    elif delta.seconds > 3600:
+        hours_ago = delta.seconds // 3600
+        output += f"\n@ {hours_ago} hours ago\n"
+    else:
+        minutes_ago = delta.seconds // 60
+        output += f"\n@ {minutes_ago} minutes ago\n"
+    return output
 
 
 def in_progress_game_str(in_progress_game: InProgressGame, debug: bool = False) -> str:
@@ -951,7 +928,7 @@ def in_progress_game_str(in_progress_game: InProgressGame, debug: bool = False)
 
 
 def is_in_game(player_id: int) -> bool:
-    return get_player_game(player_id, Session()) is not None
+    return in_game_index.is_in_game(player_id)
 
 
 def get_player_game(player_id: int, session=None) -> InProgressGame | None:
@@ -961,80 +938,57 @@ def get_player_game(player_id: int, session=None) -> InProgressGame | None:
     :session: Pass in a session if you want to do something with the game that
     gets returned
     """
-    should_close = False
-    if not session:
-        should_close = True
-        session = Session()
-    ipg_player = (
-        session.query(InProgressGamePlayer)
-        .join(InProgressGame)
-        .filter(InProgressGamePlayer.player_id == player_id)
-        .first()
-    )
-    if ipg_player:
-        if should_close:
-            session.close()
-        return (
-            session.query(InProgressGame)
-            .filter(InProgressGame.id == ipg_player.in_progress_game_id)
-            .first()
-        )
-    else:
-        if should_close:
-            session.close()
+    in_progress_game_id = in_game_index.game_id_for_player(player_id)
+    if in_progress_game_id is None:
         return None
+    if not session:
+        with Session() as session:
+            return session.query(InProgressGame).get(in_progress_game_id)
+    return session.query(InProgressGame).get(in_progress_game_id)
 
 
-def map_status_str(full_status: bool) -> str:
-    with Session() as session:
-        output = ""
-        current_map, current_map_full = get_current_map_readonly()
-        if current_map:
-            output += f"**Next map: {current_map_full.full_name} ({current_map_full.short_name})**\n"
-
-            if full_status:
-                # TODO next-map logic is duplicated from utils.py -> update_current_map_to_next_map_in_rotation
-                time_since_update: timedelta = datetime.now(
-                    timezone.utc
-                ) - current_map.updated_at.replace(tzinfo=timezone.utc)
-                time_until_rotation = config.MAP_ROTATION_MINUTES - (
-                        time_since_update.seconds // 60
-                )
-                if config.RANDOM_MAP_ROTATION:
-                    output += f"_(Auto-rotates to a random map in {time_until_rotation} minutes)_\n"
+def map_status_str(snapshot: SystemSnapshot, full_status: bool) -> str:
+    output = ""
+    current_map = snapshot.current_map
+    current_map_full = snapshot.current_map_full
+    if current_map and current_map_full:
+        output += f"**Next map: {current_map_full.full_name} ({current_map_full.short_name})**\n"
+
+        if full_status:
+            # TODO next-map logic is duplicated from utils.py -> update_current_map_to_next_map_in_rotation
+            time_since_update: timedelta = datetime.now(
+                timezone.utc
+            ) - current_map.updated_at.replace(tzinfo=timezone.utc)
+            time_until_rotation = config.MAP_ROTATION_MINUTES - (
+                    time_since_update.seconds // 60
+            )
+            if config.RANDOM_MAP_ROTATION:
+                output += f"_(Auto-rotates to a random map in {time_until_rotation} minutes)_\n"
+            else:
+                current_rotation_index = current_map_full.rotation_index
+                rotation_maps = [map for map in snapshot.maps if map.rotation_weight > 0]
+                other_rotation_maps = [map for map in rotation_maps if map.id != current_map.map_id]
+                next_map = next(filter(lambda x: x.rotation_index > current_rotation_index, other_rotation_maps),
+                                current_map_full) or other_rotation_maps[0]
+                first_rotation_map = rotation_maps[0] if rotation_maps else None
+                if first_rotation_map and current_rotation_index == first_rotation_map.rotation_index:
+                    output += f"_Map after next: {next_map.full_name} ({next_map.short_name})_\n"
                 else:
-                    current_map_id = current_map.map_id if current_map else 'DUMMY'
-                    current_rotation_index = current_map_full.rotation_index if current_map_full else -1
-                    other_rotation_maps: list[Map] = session.query(Map).filter(Map.rotation_weight > 0,
-                                                                               Map.id != current_map_id).order_by(
-                        Map.rotation_index.asc()).all()  # type: ignore
-                    next_map = next(filter(lambda x: x.rotation_index > current_rotation_index, other_rotation_maps),
-                                    current_map_full) or other_rotation_maps[0]
-                    first_rotation_map: Map = session.query(Map).filter(Map.rotation_weight > 0).order_by(
-                        Map.rotation_index.asc()).first()  # type: ignore
-                    if first_rotation_map and current_rotation_index == first_rotation_map.rotation_index:
-                        output += f"_Map after next: {next_map.full_name} ({next_map.short_name})_\n"
-                    else:
-                        output += f"_Map after next (auto-rotates in {time_until_rotation} minutes): {next_map.full_name} ({next_map.short_name})_\n"
-
-                skip_map_votes: list[SkipMapVote] = session.query(SkipMapVote).all()
-                output += f"_Votes to skip (voteskip): [{len(skip_map_votes)}/{config.MAP_VOTE_THRESHOLD}]_\n"
-
-                map_votes: list[MapVote] = session.query(MapVote).all()
-                voted_map_ids: list[str] = [map_vote.voteable_map_id for map_vote in map_votes]
-                voted_maps: list[Map] = (
-                    session.query(Map).filter(Map.id.in_(voted_map_ids)).all()  # type: ignore
-                )
-                voted_maps_str = ", ".join(
-                    [
-                        f"{voted_map.short_name} [{voted_map_ids.count(voted_map.id)}/{config.MAP_VOTE_THRESHOLD}]"
-                        for voted_map in voted_maps
-                    ]
-                )
-                output += f"_Votes to change map (votemap): {voted_maps_str}_\n"
-        else:
-            output += "There is no current map"
-        return output
+                    output += f"_Map after next (auto-rotates in {time_until_rotation} minutes): {next_map.full_name} ({next_map.short_name})_\n"
+
+            output += f"_Votes to skip (voteskip): [{snapshot.skip_map_votes}/{config.MAP_VOTE_THRESHOLD}]_\n"
+
+            voted_maps_str = ", ".join(
+                [
+                    f"{voted_map.short_name} [{snapshot.map_votes[voted_map.id]}/{config.MAP_VOTE_THRESHOLD}]"
+                    for voted_map in snapshot.maps
+                    if voted_map.id in snapshot.map_votes
+                ]
+            )
+            output += f"_Votes to change map (votemap): {voted_maps_str}_\n"
+    else:
+        output += "There is no current map"
+    return output
 
 
 # Commands start here
@@ -1047,13 +1001,7 @@ async def is_not_banned(ctx: Context):
 
     https://discordpy.readthedocs.io/en/stable/ext/commands/commands.html#global-checks
     """
-    is_banned = (
-        Session()
-        .query(Player)
-        .filter(Player.id == ctx.message.author.id, Player.is_banned)
-        .first()
-    )
-    return not is_banned
+    return not permission_cache.is_banned(ctx.message.author.id)
 
 
 @bot.command()
@@ -1190,7 +1138,7 @@ async def add(ctx: Context, *args):
             )
             return
 
-        add_player_queue.put(
+        await add_player_queue.put(
             AddPlayerQueueMessage(
                 message.author.id,
                 message.author.display_name,
@@ -1220,6 +1168,7 @@ async def addadmin(ctx: Context, member: Member):
             colour=Colour.green(),
         )
         session.commit()
+        permission_cache.set_admin(member.id, True)
     else:
         if player.is_admin:
             await send_message(
@@ -1230,6 +1179,7 @@ async def addadmin(ctx: Context, member: Member):
         else:
             player.is_admin = True
             session.commit()
+            permission_cache.set_admin(player.id, True)
             await send_message(
                 message.channel,
                 embed_description=f"{escape_markdown(player.name)} added to admins",
@@ -1260,6 +1210,7 @@ async def addadminrole(ctx: Context, role_name: str):
             colour=Colour.green(),
         )
         session.commit()
+        permission_cache.add_admin_role(role_name_to_role_id[role_name.lower()])
 
 
 @bot.command()
@@ -1319,6 +1270,7 @@ async def addqueuerole(ctx: Context, queue_name: str, role_name: str):
             colour=Colour.green(),
         )
         session.commit()
+        queue_state.add_role(queue.id, role_name_to_role_id[role_name.lower()])
 
 
 @bot.command()
@@ -1342,6 +1294,7 @@ async def ban(ctx: Context, member: Member):
             colour=Colour.green(),
         )
         session.commit()
+        permission_cache.set_banned(member.id, True)
     else:
         player = players[0]
         if player.is_banned:
@@ -1353,6 +1306,7 @@ async def ban(ctx: Context, member: Member):
         else:
             player.is_banned = True
             session.commit()
+            permission_cache.set_banned(player.id, True)
             await send_message(
                 message.channel,
                 embed_description=f"{escape_markdown(player.name)} banned",
@@ -1396,10 +1350,13 @@ async def cancelgame(ctx: Context, game_id: str):
             await voice_channel.delete()
         session.delete(ipg_channel)
 
+    in_progress_game_id = game.id
     session.query(InProgressGame).filter(
         InProgressGame.id == game.id
     ).delete()
     session.commit()
+    # Only once the game is gone from the database, add and pop check this
+    in_game_index.remove_game(in_progress_game_id)
     await send_message(
         message.channel,
         embed_description=f"Game {game_id} cancelled",
@@ -1422,6 +1379,7 @@ async def createcommand(ctx: Context, name: str, *, output: str):
         return
 
     session.add(CustomCommand(name, output))
+    custom_command_registry.invalidate(session)
     session.commit()
 
     await send_message(
@@ -1451,7 +1409,7 @@ async def clearqueue(ctx: Context, queue_name: str):
             colour=Colour.red(),
         )
         return
-    session.query(QueuePlayer).filter(QueuePlayer.queue_id == queue.id).delete()
+    queue_state.clear_queue(session, queue.id)
     session.commit()
 
     await send_message(
@@ -1471,6 +1429,7 @@ async def createqueue(ctx: Context, queue_name: str, queue_size: int):
     try:
         session.add(queue)
         session.commit()
+        queue_state.sync_queue(queue)
         await send_message(
             message.channel,
             embed_description=f"Queue created: {queue.name}",
@@ -1494,16 +1453,16 @@ async def del_(ctx: Context, *args):
     """
     message = ctx.message
     with Session() as session:
-        queues_to_del: list[Queue] = []
-        all_added_queues: list[Queue] = session.query(Queue).join(QueuePlayer).filter(
-            QueuePlayer.player_id == message.author.id).order_by(Queue.created_at.asc()).all()  # type: ignore
+        queues_to_del: list[QueueState] = []
+        added_queue_ids = queue_state.queue_ids_for_player(message.author.id)
+        all_queues: list[QueueState] = queue_state.queues()
+        all_added_queues = [q for q in all_queues if q.id in added_queue_ids]
 
         if len(args) == 0:
             queues_to_del = all_added_queues
         else:
-            all_queues: list[Queue] = session.query(Queue).order_by(Queue.created_at.asc()).all()  # type: ignore
             for arg in args:
-                queue_to_del: list[Queue] = []
+                queue_to_del: list[QueueState] = []
                 # Try deleting by integer index first, then try string name
                 if is_really_numeric(arg):
                     queue_index = int(arg) - 1
@@ -1515,10 +1474,10 @@ async def del_(ctx: Context, *args):
                 if len(queue_to_del) == 1:
                     queues_to_del.append(queue_to_del[0])
 
+        queue_state.remove_players(
+            session, [message.author.id], [queue.id for queue in queues_to_del]
+        )
         for queue in queues_to_del:
-            session.query(QueuePlayer).filter(
-                QueuePlayer.queue_id == queue.id, QueuePlayer.player_id == message.author.id
-            ).delete()
             # TODO Sauon: The QueueWaitlist part doesnt work yet
             queue_waitlist: QueueWaitlist | None = (
                 session.query(QueueWaitlist)
@@ -1532,22 +1491,15 @@ async def del_(ctx: Context, *args):
                     QueueWaitlistPlayer.player_id == message.author.id,
                     QueueWaitlistPlayer.queue_waitlist_id == queue_waitlist.id,
                 ).delete()
+        session.commit()
 
-        queue_statuses = []
-        all_queues = session.query(Queue).order_by(Queue.created_at.asc()).all()  # type: ignore
-        for queue in all_queues:
-            queue_players = (
-                session.query(QueuePlayer).filter(QueuePlayer.queue_id == queue.id).all()
-            )
-            queue_statuses.append(f"{queue.name} [{len(queue_players)}/{queue.size}]")
-
+        snapshot = load_system_snapshot(session)
         await send_message(
             message.channel,
             content=f"{escape_markdown(message.author.display_name)} removed from: {', '.join([queue.name for queue in queues_to_del])}",
-            embed_description=" ".join(queue_statuses),
+            embed_description=" ".join(snapshot.queue_status_strs()),
             colour=Colour.green(),
         )
-        session.commit()
 
 
 @bot.command(usage="<player>")
@@ -1558,12 +1510,9 @@ async def delplayer(ctx: Context, member: Member, *args):
     """
     message = ctx.message
     session = Session()
-    queues: list(Queue) = session.query(Queue).join(QueuePlayer).filter(QueuePlayer.player_id == member.id).order_by(
-        Queue.created_at.asc()).all()  # type: ignore
+    removed_queue_ids = queue_state.remove_players(session, [member.id])
+    queues: list[QueueState] = [queue_state.get(queue_id) for queue_id in removed_queue_ids]
     for queue in queues:
-        session.query(QueuePlayer).filter(
-            QueuePlayer.queue_id == queue.id, QueuePlayer.player_id == member.id
-        ).delete()
         # TODO: Test this part
         queue_waitlist: QueueWaitlist | None = (
             session.query(QueueWaitlist)
@@ -1578,18 +1527,10 @@ async def delplayer(ctx: Context, member: Member, *args):
                 QueueWaitlistPlayer.queue_waitlist_id == queue_waitlist.id,
             ).delete()
 
-    queue_statuses = []
-    queue: Queue
-    for queue in session.query(Queue).order_by(Queue.created_at.asc()).all():  # type: ignore
-        queue_players = (
-            session.query(QueuePlayer).filter(QueuePlayer.queue_id == queue.id).all()
-        )
-        queue_statuses.append(f"{queue.name} [{len(queue_players)}/{queue.size}]")
-
     await send_message(
         message.channel,
         content=f"{escape_markdown(member.name)} removed from: {', '.join([queue.name for queue in queues])}",
-        embed_description=" ".join(queue_statuses),
+        embed_description=" ".join(queue_state.status_strs()),
         colour=Colour.green(),
     )
     session.commit()
@@ -1609,6 +1550,7 @@ async def editcommand(ctx: Context, name: str, *, output: str):
         return
 
     exists.output = output
+    custom_command_registry.invalidate(session)
     session.commit()
 
     await send_message(
@@ -1635,6 +1577,7 @@ async def editgamewinner(ctx: Context, game_id: str, outcome: str):
             colour=Colour.red(),
         )
         return
+    old_winning_team = game.winning_team
     outcome = outcome.lower()
     if outcome == "tie":
         game.winning_team = -1
@@ -1651,11 +1594,34 @@ async def editgamewinner(ctx: Context, game_id: str, outcome: str):
         return
 
     session.add(game)
+    fg_players = load_finished_game_players(session, [game])[game.id]
+    player_teams = [(fgp.player_id, fgp.team) for fgp in fg_players]
+    record_game_outcome(
+        session, game.finished_at, player_teams, game.winning_team, old_winning_team
+    )
+    game_str = finished_game_str(game, fg_players=fg_players)
+    finished_game_id = game.id
     session.commit()
+    session.close()
+    # Re-rate this game and everything played after it, off the event loop
+    async with ratings_lock:
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                None, recompute_ratings, finished_game_id
+            )
+        except Exception:
+            log.exception("[editgamewinner] Failed to recompute ratings")
+            await send_message(
+                message.channel,
+                embed_description=f"Game {game_id} outcome changed, but recomputing ratings failed. Run scripts/recompute_ratings.py to retry.",
+                colour=Colour.red(),
+            )
+            return
+        finally:
+            leaderboard_service.invalidate()
     await send_message(
         message.channel,
-        embed_description=f"Game {game_id} outcome changed:\n\n"
-                          + finished_game_str(game),
+        embed_description=f"Game {game_id} outcome changed:\n\n" + game_str,
         colour=Colour.green(),
     )
 
@@ -1699,76 +1665,52 @@ async def finishgame(ctx: Context, outcome: str):
         )
         return
 
-    players = (
-        session.query(Player)
-        .join(InProgressGamePlayer)
-        .filter(
-            InProgressGamePlayer.player_id == Player.id,
-            InProgressGamePlayer.in_progress_game_id == in_progress_game.id,
+    # Wait for a replay started by editgamewinner to finish. Nothing below
+    # awaits until the commit, so another one can't start in the meantime.
+    async with ratings_lock:
+        pass
+    # A replay run from scripts/recompute_ratings.py holds the lock
+    # exclusively, don't block the event loop waiting for it
+    if not session.execute(
+        select(func.pg_try_advisory_xact_lock_shared(RATINGS_LOCK_KEY))
+    ).scalar_one():
+        session.rollback()
+        session.close()
+        await send_message(
+            message.channel,
+            embed_description="Ratings are being recomputed, try again in a few minutes",
+            colour=Colour.red(),
         )
-    ).all()
-    player_ids: list[str] = [player.id for player in players]
-    players_by_id: dict[int, Player] = {player.id: player for player in players}
-    player_region_trueskills_by_id: dict[str, PlayerRegionTrueskill] = {}
-    if queue.queue_region_id:
-        player_region_trueskills: list[PlayerRegionTrueskill] = (
-            session.query(PlayerRegionTrueskill)
-            .filter(
-                PlayerRegionTrueskill.player_id.in_(player_ids),
+        return
+
+    # Everyone's rating in the queue's region, if they have one there
+    rows: list[tuple[int, Player, PlayerRegionTrueskill | None]] = (
+        session.query(InProgressGamePlayer.team, Player, PlayerRegionTrueskill)
+        .join(Player, Player.id == InProgressGamePlayer.player_id)
+        .outerjoin(
+            PlayerRegionTrueskill,
+            and_(
+                PlayerRegionTrueskill.player_id == Player.id,
                 PlayerRegionTrueskill.queue_region_id == queue.queue_region_id,
-            )
-            .all()
+            ),
         )
-        player_region_trueskills_by_id = {
-            prt.player_id: prt for prt in player_region_trueskills
-        }
-    in_progress_game_players = (
-        session.query(InProgressGamePlayer)
         .filter(InProgressGamePlayer.in_progress_game_id == in_progress_game.id)
+        .order_by(InProgressGamePlayer.team)
         .all()
     )
-    team0_rated_ratings_before = []
-    team1_rated_ratings_before = []
-    team0_unrated_ratings_before = []
-    team1_unrated_ratings_before = []
-    team0_players: list[InProgressGamePlayer] = []
-    team1_players: list[InProgressGamePlayer] = []
-    for in_progress_game_player in in_progress_game_players:
-        player = players_by_id[in_progress_game_player.player_id]
-        if in_progress_game_player.team == 0:
-            team0_players.append(in_progress_game_player)
-            if queue.queue_region_id and player.id in player_region_trueskills_by_id:
-                prt = player_region_trueskills_by_id[player.id]
-                team0_rated_ratings_before.append(
-                    Rating(prt.rated_trueskill_mu, prt.rated_trueskill_sigma)
-                )
-                team0_unrated_ratings_before.append(
-                    Rating(prt.unrated_trueskill_mu, prt.unrated_trueskill_sigma)
-                )
-            else:
-                team0_rated_ratings_before.append(
-                    Rating(player.rated_trueskill_mu, player.rated_trueskill_sigma)
-                )
-                team0_unrated_ratings_before.append(
-                    Rating(player.unrated_trueskill_mu, player.unrated_trueskill_sigma)
-                )
-        else:
-            team1_players.append(in_progress_game_player)
-            if queue.queue_region_id and player.id in player_region_trueskills_by_id:
-                prt = player_region_trueskills_by_id[player.id]
-                team1_rated_ratings_before.append(
-                    Rating(prt.rated_trueskill_mu, prt.rated_trueskill_sigma)
-                )
-                team1_unrated_ratings_before.append(
-                    Rating(prt.unrated_trueskill_mu, prt.unrated_trueskill_sigma)
-                )
-            else:
-                team1_rated_ratings_before.append(
-                    Rating(player.rated_trueskill_mu, player.rated_trueskill_sigma)
-                )
-                team1_unrated_ratings_before.append(
-                    Rating(player.unrated_trueskill_mu, player.unrated_trueskill_sigma)
-                )
+    players: list[Player] = [player for _, player, _ in rows]
+    player_ids: list[int] = [player.id for player in players]
+    teams: list[int] = [team for team, _, _ in rows]
+    rated_before: list[tuple[float, float]] = []
+    unrated_before: list[tuple[float, float]] = []
+    for _, player, prt in rows:
+        rating_source = prt or player
+        rated_before.append(
+            (rating_source.rated_trueskill_mu, rating_source.rated_trueskill_sigma)
+        )
+        unrated_before.append(
+            (rating_source.unrated_trueskill_mu, rating_source.unrated_trueskill_sigma)
+        )
 
     if queue.queue_region_id:
         queue_region_name = (
@@ -1796,129 +1738,36 @@ async def finishgame(ctx: Context, outcome: str):
         winning_team=winning_team,
     )
     session.add(finished_game)
+    session.flush()
 
-    result = None
-    if winning_team == -1:
-        result = [0, 0]
-    elif winning_team == 0:
-        result = [0, 1]
-    elif winning_team == 1:
-        result = [1, 0]
-
-    team0_rated_ratings_after: list[Rating]
-    team1_rated_ratings_after: list[Rating]
-    team0_unrated_ratings_after: list[Rating]
-    team1_unrated_ratings_after: list[Rating]
-    if queue.is_rated and not queue.is_isolated:
-        if len(players) > 1:
-            team0_rated_ratings_after, team1_rated_ratings_after = rate(
-                [team0_rated_ratings_before, team1_rated_ratings_before], result
-            )
-        else:
-            # Mostly useful for creating solo queues for testing, no real world
-            # application
-            team0_rated_ratings_after, team1_rated_ratings_after = (
-                team0_rated_ratings_before,
-                team1_rated_ratings_before,
-            )
-    else:
-        # Don't modify rated ratings if the queue isn't rated
-        team0_rated_ratings_after, team1_rated_ratings_after = (
-            team0_rated_ratings_before,
-            team1_rated_ratings_before,
-        )
-
-    if len(players) > 1 and not queue.is_isolated:
-        team0_unrated_ratings_after, team1_unrated_ratings_after = rate(
-            [team0_unrated_ratings_before, team1_unrated_ratings_before], result
-        )
-    else:
-        team0_unrated_ratings_after, team1_unrated_ratings_after = (
-            team0_unrated_ratings_before,
-            team1_unrated_ratings_before,
-        )
-
-    for i, team0_gip in enumerate(team0_players):
-        player = players_by_id[team0_gip.player_id]
-        finished_game_player = FinishedGamePlayer(
-            finished_game_id=finished_game.id,
-            player_id=player.id,
-            player_name=player.name,
-            team=team0_gip.team,
-            rated_trueskill_mu_before=team0_rated_ratings_before[i].mu,
-            rated_trueskill_sigma_before=team0_rated_ratings_before[i].sigma,
-            rated_trueskill_mu_after=team0_rated_ratings_after[i].mu,
-            rated_trueskill_sigma_after=team0_rated_ratings_after[i].sigma,
-            unrated_trueskill_mu_before=team0_unrated_ratings_before[i].mu,
-            unrated_trueskill_sigma_before=team0_unrated_ratings_before[i].sigma,
-            unrated_trueskill_mu_after=team0_unrated_ratings_after[i].mu,
-            unrated_trueskill_sigma_after=team0_unrated_ratings_after[i].sigma,
-        )
-        if not queue.queue_region_id:
-            player.rated_trueskill_mu = team0_rated_ratings_after[i].mu
-            player.rated_trueskill_sigma = team0_rated_ratings_after[i].sigma
-            player.unrated_trueskill_mu = team0_unrated_ratings_after[i].mu
-            player.unrated_trueskill_sigma = team0_unrated_ratings_after[i].sigma
-        else:
-            if player.id in player_region_trueskills_by_id:
-                prt = player_region_trueskills_by_id[player.id]
-                prt.rated_trueskill_mu = team0_rated_ratings_after[i].mu
-                prt.rated_trueskill_sigma = team0_rated_ratings_after[i].sigma
-                prt.unrated_trueskill_mu = team0_unrated_ratings_after[i].mu
-                prt.unrated_trueskill_sigma = team0_unrated_ratings_after[i].sigma
-            else:
-                session.add(
-                    PlayerRegionTrueskill(
-                        player_id=player.id,
-                        queue_region_id=queue.queue_region_id,
-                        rated_trueskill_mu=team0_rated_ratings_after[i].mu,
-                        rated_trueskill_sigma=team0_rated_ratings_after[i].sigma,
-                        unrated_trueskill_mu=team0_unrated_ratings_after[i].mu,
-                        unrated_trueskill_sigma=team0_unrated_ratings_after[i].sigma,
-                    )
-                )
-        session.add(finished_game_player)
-    for i, team1_gip in enumerate(team1_players):
-        player = players_by_id[team1_gip.player_id]
-        finished_game_player = FinishedGamePlayer(
-            finished_game_id=finished_game.id,
-            player_id=player.id,
-            player_name=player.name,
-            team=team1_gip.team,
-            rated_trueskill_mu_before=team1_rated_ratings_before[i].mu,
-            rated_trueskill_sigma_before=team1_rated_ratings_before[i].sigma,
-            rated_trueskill_mu_after=team1_rated_ratings_after[i].mu,
-            rated_trueskill_sigma_after=team1_rated_ratings_after[i].sigma,
-            unrated_trueskill_mu_before=team1_unrated_ratings_before[i].mu,
-            unrated_trueskill_sigma_before=team1_unrated_ratings_before[i].sigma,
-            unrated_trueskill_mu_after=team1_unrated_ratings_after[i].mu,
-            unrated_trueskill_sigma_after=team1_unrated_ratings_after[i].sigma,
-        )
-        if not queue.queue_region_id:
-            player.rated_trueskill_mu = team1_rated_ratings_after[i].mu
-            player.rated_trueskill_sigma = team1_rated_ratings_after[i].sigma
-            player.unrated_trueskill_mu = team1_unrated_ratings_after[i].mu
-            player.unrated_trueskill_sigma = team1_unrated_ratings_after[i].sigma
-        else:
-            if player.id in player_region_trueskills_by_id:
-                prt = player_region_trueskills_by_id[player.id]
-                prt.rated_trueskill_mu = team1_rated_ratings_after[i].mu
-                prt.rated_trueskill_sigma = team1_rated_ratings_after[i].sigma
-                prt.unrated_trueskill_mu = team1_unrated_ratings_after[i].mu
-                prt.unrated_trueskill_sigma = team1_unrated_ratings_after[i].sigma
-            else:
-                session.add(
-                    PlayerRegionTrueskill(
-                        player_id=player.id,
-                        queue_region_id=queue.queue_region_id,
-                        rated_trueskill_mu=team1_rated_ratings_after[i].mu,
-                        rated_trueskill_sigma=team1_rated_ratings_after[i].sigma,
-                        unrated_trueskill_mu=team1_unrated_ratings_after[i].mu,
-                        unrated_trueskill_sigma=team1_unrated_ratings_after[i].sigma,
-                    )
-                )
-        session.add(finished_game_player)
-
+    game_ratings = rate_game(
+        player_ids,
+        teams,
+        rated_before,
+        unrated_before,
+        winning_team,
+        queue.is_rated,
+        queue.is_isolated,
+    )
+    write_game_ratings(
+        session, finished_game.id, players, game_ratings, queue.queue_region_id
+    )
+    record_game_outcome(
+        session, finished_game.finished_at, list(zip(player_ids, teams)), winning_team
+    )
+    # Captured now, the leaderboard is only updated once the game commits
+    started_at = finished_game.started_at
+    queue_region_id = queue.queue_region_id
+    leaderboard_entries = [
+        LeaderboardEntry(
+            player.id, player.name, player.rated_trueskill_mu, player.rated_trueskill_sigma
+        )
+        for player in players
+    ]
+    region_ratings: dict[int, tuple[float, float]] = {
+        player_id: (mu, sigma)
+        for player_id, (mu, sigma) in zip(player_ids, game_ratings.rated_after.tolist())
+    }
     session.query(InProgressGamePlayer).filter(
         InProgressGamePlayer.in_progress_game_id == in_progress_game.id
     ).delete()
@@ -1935,17 +1784,20 @@ async def finishgame(ctx: Context, outcome: str):
         embed_description = (
             f"**Tie game**\n**Duration:** {duration.seconds // 60} minutes"
         )
-    queue = session.query(Queue).filter(Queue.id == in_progress_game.queue_id).first()
-    session.add(
-        QueueWaitlist(
-            finished_game_id=finished_game.id,
-            in_progress_game_id=in_progress_game.id,
-            queue_id=queue.id,
-            end_waitlist_at=datetime.now(timezone.utc)
-                            + timedelta(seconds=config.RE_ADD_DELAY_SECONDS),
-        )
+    queue_waitlist = QueueWaitlist(
+        finished_game_id=finished_game.id,
+        in_progress_game_id=in_progress_game.id,
+        queue_id=queue.id,
+        end_waitlist_at=datetime.now(timezone.utc)
+                        + timedelta(seconds=config.RE_ADD_DELAY_SECONDS),
     )
+    session.add(queue_waitlist)
     session.commit()
+    in_game_index.remove_game(in_progress_game.id)
+    leaderboard_service.record_game(
+        started_at, leaderboard_entries, queue_region_id, region_ratings
+    )
+    queue_waitlist_scheduler.schedule(queue_waitlist.id, queue_waitlist.end_waitlist_at)
     queue_name = queue.name
     short_in_progress_game_id = in_progress_game.id.split("-")[0]
     session.close()
@@ -1966,6 +1818,8 @@ async def isolatequeue(ctx: Context, queue_name: str):
     queue: Queue = session.query(Queue).filter(Queue.name.ilike(queue_name)).first()  # type: ignore
     if queue:
         queue.is_isolated = True
+        session.commit()
+        queue_state.sync_queue(queue)
         await send_message(
             message.channel,
             embed_description=f"Queue {queue_name} is now isolated (unrated, no map rotation, no auto-adds)",
@@ -1977,17 +1831,9 @@ async def isolatequeue(ctx: Context, queue_name: str):
             embed_description=f"Queue not found: {queue_name}",
             colour=Colour.red(),
         )
-    session.commit()
-
-
-def leaderboard_cooldown(message: Message):
-    command_length = len(f"{config.COMMAND_PREFIX}leaderboard")
-    key = message.content[command_length:].strip()
-    return key
 
 
 @bot.command()
-@commands.cooldown(1, 3600, leaderboard_cooldown)
 async def leaderboard(ctx: Context, *args):
     if not config.SHOW_TRUESKILL:
         await send_message(
@@ -2003,93 +1849,31 @@ async def leaderboard(ctx: Context, *args):
         )
         return
 
-    with Session() as session:
-        if len(args) > 0:
+    if len(args) > 0:
+        with Session() as session:
             queue_region: QueueRegion | None = session.query(QueueRegion).filter(args[0] == QueueRegion.name).first()
-            if queue_region:
-                output = "**Leaderboard**"
-                output += f"\n_{queue_region.name}_"
-
-                leaderboard_prt_native_query = f"""
-                        select
-                            p.id as player_id,
-                            (prt.rated_trueskill_mu - 3 * prt.rated_trueskill_sigma)::numeric as rating
-                        from player_region_trueskill prt
-                        join player p on p.id = prt.player_id
-                        INNER JOIN (
-                            select fgp.player_id, MAX(fg.finished_at) AS last_played
-                            from finished_game fg
-                            join finished_game_player fgp on fg.id = fgp.finished_game_id
-                            WHERE fg.started_at > NOW() - INTERVAL '{config.DAYS_UNTIL_INACTIVE} DAYS'
-                            group by fgp.player_id
-                        ) as last_played ON p.id = last_played.player_id
-                        where queue_region_id = '{queue_region.id}'
-                        AND   last_played.last_played > NOW() - INTERVAL '{config.DAYS_UNTIL_INACTIVE} DAYS'
-                        order by rating desc
-                        limit 10
-                        """
-                leaderboard_ids = []
-                rs = session.execute(leaderboard_prt_native_query)
-                for row in rs:
-                    leaderboard_ids.append(row[0])
-
-                top_10_prts: list[PlayerRegionTrueskill] = session.query(PlayerRegionTrueskill) \
-                    .filter(PlayerRegionTrueskill.queue_region_id == queue_region.id,
-                            PlayerRegionTrueskill.player_id.in_(leaderboard_ids)) \
-                    .order_by(PlayerRegionTrueskill.leaderboard_trueskill.desc()).all()
-
-                for i, prt in enumerate(top_10_prts, 1):
-                    player: Player = session.query(Player).filter(Player.id == prt.player_id).first()
-                    output += f"\n{i}. {round(prt.leaderboard_trueskill, 1)} - {player.name}"
-                    if config.SHOW_TRUESKILL_DETAILS:
-                        output += f" _(mu: {round(prt.rated_trueskill_mu, 1)}, sigma: {round(prt.rated_trueskill_sigma, 1)})_"
-
-                output += "\n"
-                output += "\n(Ranks calculated using the formula: _mu - 3*sigma_)"
-                await send_message(
-                    ctx.message.channel, embed_description=output, colour=Colour.blue()
-                )
-            else:
-                await send_message(
-                    ctx.message.channel, embed_description=f"Queueregion {args[0]} not found", colour=Colour.red()
-                )
-        else:
-            output = "**Leaderboard**\nranked"
-
-            leaderboard_player_native_query = f"""
-                                    select
-                                        p.id as player_id,
-                                        (p.rated_trueskill_mu - 3 * p.rated_trueskill_sigma)::numeric as rating
-                                    from player p
-                                    INNER JOIN (
-                                        select fgp.player_id, MAX(fg.finished_at) AS last_played
-                                        from finished_game fg
-                                        join finished_game_player fgp on fg.id = fgp.finished_game_id
-                                        WHERE fg.started_at > NOW() - INTERVAL '{config.DAYS_UNTIL_INACTIVE} DAYS'
-                                        group by fgp.player_id
-                                    ) as last_played ON p.id = last_played.player_id
-                                    AND   last_played.last_played > NOW() - INTERVAL '{config.DAYS_UNTIL_INACTIVE} DAYS'
-                                    order by rating desc
-                                    limit 10
-                                    """
-            leaderboard_ids = []
-            rs = session.execute(leaderboard_player_native_query)
-            for row in rs:
-                leaderboard_ids.append(row[0])
-
-            top_10_players: list[Player] = session.query(Player) \
-                .filter(Player.id.in_(leaderboard_ids)) \
-                .order_by(Player.leaderboard_trueskill.desc()) \
-                .all()
-
-            for i, player in enumerate(top_10_players, 1):
-                output += f"\n{i}. {round(player.leaderboard_trueskill, 1)} - {player.name}"
-                if config.SHOW_TRUESKILL_DETAILS:
-                    output += f" _(mu: {round(player.rated_trueskill_mu, 1)}, sigma: {round(player.rated_trueskill_sigma, 1)})_"
-            output += "\n(Ranks calculated using the formula: _mu - 3*sigma_)"
+        if not queue_region:
             await send_message(
-                ctx.message.channel, embed_description=output, colour=Colour.blue()
+                ctx.message.channel, embed_description=f"Queueregion {args[0]} not found", colour=Colour.red()
             )
+            return
+        output = "**Leaderboard**"
+        output += f"\n_{queue_region.name}_"
+        entries = leaderboard_service.top(10, queue_region.id)
+    else:
+        output = "**Leaderboard**\nranked"
+        entries = leaderboard_service.top(10)
+
+    for i, entry in enumerate(entries, 1):
+        output += f"\n{i}. {round(entry.leaderboard_trueskill, 1)} - {entry.name}"
+        if config.SHOW_TRUESKILL_DETAILS:
+            output += f" _(mu: {round(entry.rated_trueskill_mu, 1)}, sigma: {round(entry.rated_trueskill_sigma, 1)})_"
+    if len(args) > 0:
+        output += "\n"
+    output += "\n(Ranks calculated using the formula: _mu - 3*sigma_)"
+    await send_message(
+        ctx.message.channel, embed_description=output, colour=Colour.blue()
+    )
 
 
 @bot.command()
@@ -2201,6 +1985,7 @@ async def lockqueue(ctx: Context, queue_name: str):
 
     queue.is_locked = True
     session.commit()
+    queue_state.sync_queue(queue)
 
     await send_message(
         message.channel,
@@ -2242,7 +2027,9 @@ async def trueskill(ctx: Context):
 
 @bot.command(name="map")
 async def map_(ctx: Context):
-    output = map_status_str(True)
+    with Session() as session:
+        snapshot = load_system_snapshot(session)
+    output = map_status_str(snapshot, True)
     await ctx.send(embed=Embed(description=output, colour=Colour.blue()))
 
 
@@ -2286,7 +2073,7 @@ async def mockrandomqueue(ctx: Context, *args):
     for player in numpy.random.choice(
             players_from_last_30_days, size=int(args[1]), replace=False
     ):
-        add_player_queue.put(
+        await add_player_queue.put(
             AddPlayerQueueMessage(
                 player.id,
                 player.name,
@@ -2369,14 +2156,17 @@ async def gamehistory(ctx: Context, count: int):
 
     session = Session()
     finished_games: list[FinishedGame] = (
-        session.query(FinishedGame).order_by(FinishedGame.finished_at.desc()).limit(count)  # type: ignore
+        session.query(FinishedGame).order_by(FinishedGame.finished_at.desc()).limit(count).all()  # type: ignore
     )
+    fg_players_by_game_id = load_finished_game_players(session, finished_games)
 
     output = ""
     for i, finished_game in enumerate(finished_games):
         if i > 0:
             output += "\n"
-        output += finished_game_str(finished_game)
+        output += finished_game_str(
+            finished_game, fg_players=fg_players_by_game_id[finished_game.id]
+        )
 
     await send_message(
         message.channel,
@@ -2414,6 +2204,7 @@ async def removeadmin(ctx: Context, member: Member):
 
     players[0].is_admin = False
     session.commit()
+    permission_cache.set_admin(member.id, False)
     await send_message(
         message.channel,
         embed_description=f"{escape_markdown(member.name)} removed from admins",
@@ -2450,6 +2241,7 @@ async def removeadminrole(ctx: Context, role_name: str):
                 colour=Colour.green(),
             )
             session.commit()
+            permission_cache.remove_admin_role(role_name_to_role_id[role_name.lower()])
         else:
             await send_message(
                 message.channel,
@@ -2474,6 +2266,7 @@ async def removecommand(ctx: Context, name: str):
         return
 
     session.delete(exists)
+    custom_command_registry.invalidate(session)
     session.commit()
 
     await send_message(
@@ -2522,6 +2315,7 @@ async def removequeue(ctx: Context, queue_name: str):
         else:
             session.delete(queue)
             session.commit()
+            queue_state.remove_queue(queue.id)
             await send_message(
                 message.channel,
                 embed_description=f"Queue removed: {queue.name}",
@@ -2595,6 +2389,7 @@ async def removequeuerole(ctx: Context, queue_name: str, role_name: str):
             colour=Colour.green(),
         )
         session.commit()
+        queue_state.remove_role(queue.id, role_name_to_role_id[role_name.lower()])
 
 
 @bot.command()
@@ -2689,6 +2484,37 @@ async def setqueueregion(ctx: Context, queue_name: str, region_name: str):
     session.commit()
 
 
+@bot.command(usage=f"<queue_name> <{'|'.join(TEAM_SOLVERS)}>")
+@commands.check(is_admin)
+async def setqueuesolver(ctx: Context, queue_name: str, team_solver: str):
+    message = ctx.message
+    team_solver = team_solver.lower()
+    if team_solver not in TEAM_SOLVERS:
+        await send_message(
+            message.channel,
+            embed_description=f"Solver must be one of {', '.join(TEAM_SOLVERS)}",
+            colour=Colour.red(),
+        )
+        return
+
+    with Session() as session:
+        queue: Queue | None = session.query(Queue).filter(Queue.name.ilike(queue_name)).first()  # type: ignore
+        if not queue:
+            await send_message(
+                message.channel,
+                embed_description=f"Could not find queue: {queue_name}",
+                colour=Colour.red(),
+            )
+            return
+        queue.team_solver = team_solver
+        session.commit()
+        await send_message(
+            message.channel,
+            embed_description=f"Queue {queue.name} now uses the {team_solver} team solver",
+            colour=Colour.blue(),
+        )
+
+
 @bot.command()
 @commands.check(is_admin)
 async def setqueueunrated(ctx: Context, queue_name: str):
@@ -2741,7 +2567,8 @@ async def showgame(ctx: Context, game_id: str):
         )
         return
 
-    game_str = finished_game_str(finished_game)
+    fg_players = load_finished_game_players(session, [finished_game])[finished_game.id]
+    game_str = finished_game_str(finished_game, fg_players=fg_players)
     await send_message(
         message.channel,
         embed_description=game_str,
@@ -2767,17 +2594,10 @@ async def showgamedebug(ctx: Context, game_id: str):
         .first()
     )
     if finished_game:
-        game_str = finished_game_str(finished_game, debug=True)
-        fgps: list[FinishedGamePlayer] = (
-            session.query(FinishedGamePlayer)
-            .filter(FinishedGamePlayer.finished_game_id == finished_game.id)
-            .all()
-        )
-        best_teams = get_n_best_finished_game_teams(
-            fgps, (len(fgps) + 1) // 2, finished_game.is_rated, 5
-        )
-        worst_teams = get_n_worst_finished_game_teams(
-            fgps, (len(fgps) + 1) // 2, finished_game.is_rated, 1
+        fgps = load_finished_game_players(session, [finished_game])[finished_game.id]
+        game_str = finished_game_str(finished_game, debug=True, fg_players=fgps)
+        best_teams, worst_teams = get_best_and_worst_finished_game_teams(
+            fgps, (len(fgps) + 1) // 2, finished_game.is_rated, 5, 1
         )
         game_str += "\n**Most even team combinations:**"
         for _, best_team in best_teams:
@@ -2823,11 +2643,8 @@ async def showgamedebug(ctx: Context, game_id: str):
             players: list[Player] = (
                 session.query(Player).filter(Player.id.in_(player_ids)).all()
             )
-            best_teams = get_n_best_teams(
-                players, (len(players) + 1) // 2, queue.is_rated, 5
-            )
-            worst_teams = get_n_worst_teams(
-                players, (len(players) + 1) // 2, queue.is_rated, 1
+            best_teams, worst_teams = get_best_and_worst_teams(
+                players, (len(players) + 1) // 2, queue.is_rated, 5, 1
             )
             game_str += "\n**Most even team combinations:**"
             for _, best_team in best_teams:
@@ -2853,242 +2670,100 @@ async def showgamedebug(ctx: Context, game_id: str):
 @bot.command()
 async def status(ctx: Context, *args):
     with Session() as session:
-        full_status = len(args) == 0
-        queues: list[Queue] = []
-        all_queues = session.query(Queue).order_by(Queue.created_at.asc()).all()  # type: ignore
-        if full_status:
-            queues: list[Queue] = all_queues
-        else:
-            for arg in args:
-                # Try adding by integer index first, then try string name
-                try:
-                    queue_index = int(arg) - 1
-                    queues.append(all_queues[queue_index])
-                except ValueError:
-                    queue: Queue | None = session.query(Queue).filter(Queue.name.ilike(arg)).first()  # type: ignore
-                    if queue:
-                        queues.append(queue)
-                except IndexError:
-                    continue
-
-        games_by_queue: dict[str, list[InProgressGame]] = defaultdict(list)
-        for game in session.query(InProgressGame):
-            if game.queue_id:
-                games_by_queue[game.queue_id].append(game)
-
-        output = map_status_str(full_status)
-        output += "\n"
-
-        for i, queue in enumerate(queues):
-            if i > 0 and full_status:
-                output += "\n"
-            players_in_queue = (
-                session.query(Player)
-                .join(QueuePlayer)
-                .filter(QueuePlayer.queue_id == queue.id)
-                .all()
-            )
-            queue_region: QueueRegion | None = None
-            if queue.queue_region_id:
-                queue_region = (
-                    session.query(QueueRegion)
-                    .filter(QueueRegion.id == queue.queue_region_id)
-                    .first()
-                )
-            if queue.is_locked:
-                output += (
-                    f"*{queue.name} (locked)* [{len(players_in_queue)} / {queue.size}]\n"
-                )
-            else:
-                output += f"**{queue.name}** [{len(players_in_queue)} / {queue.size}]\n"
+        snapshot = load_system_snapshot(session)
 
-            if len(players_in_queue) > 0:
-                output += f"**IN QUEUE:** "
-                output += ", ".join(
-                    sorted([escape_markdown(player.name) for player in players_in_queue])
+    full_status = len(args) == 0
+    queues: list[Queue] = []
+    if full_status:
+        queues = snapshot.queues
+    else:
+        for arg in args:
+            # Try adding by integer index first, then try string name
+            try:
+                queue_index = int(arg) - 1
+                queues.append(snapshot.queues[queue_index])
+            except ValueError:
+                # Same matching as Queue.name.ilike(arg), wildcards included
+                queue: Queue | None = next(
+                    (q for q in snapshot.queues if ilike(q.name, arg)), None
                 )
-                output += "\n"
-
-            if queue.id in games_by_queue:
-                game: InProgressGame
-                for i, game in enumerate(games_by_queue[queue.id]):
-                    team0_players = (
-                        session.query(Player)
-                        .join(InProgressGamePlayer)
-                        .filter(
-                            InProgressGamePlayer.in_progress_game_id == game.id,
-                            InProgressGamePlayer.team == 0,
-                        )
-                        .all()
-                    )
+                if queue:
+                    queues.append(queue)
+            except IndexError:
+                continue
 
-                    team1_players = (
-                        session.query(Player)
-                        .join(InProgressGamePlayer)
-                        .filter(
-                            InProgressGamePlayer.in_progress_game_id == game.id,
-                            InProgressGamePlayer.team == 1,
-                        )
-                        .all()
-                    )
+    output = map_status_str(snapshot, full_status)
+    output += "\n"
 
-                    short_game_id = short_uuid(game.id)
-                    if i > 0:
-                        output += "\n"
-                    output += f"**Map: {game.map_full_name}** ({short_game_id}):\n"
-                    output += pretty_format_team(
-                        game.team0_name, game.win_probability, team0_players
-                    )
-                    output += pretty_format_team(
-                        game.team1_name, 1 - game.win_probability, team1_players
-                    )
-                    minutes_ago = (
-                                          datetime.now(timezone.utc)
-                                          - game.created_at.replace(tzinfo=timezone.utc)
-                                  ).seconds // 60
-                    output += f"@ {minutes_ago} minutes ago\n"
+    for i, queue in enumerate(queues):
+        if i > 0 and full_status:
+            output += "\n"
+        players_in_queue = snapshot.players_by_queue_id[queue.id]
+        if queue.is_locked:
+            output += (
+                f"*{queue.name} (locked)* [{len(players_in_queue)} / {queue.size}]\n"
+            )
+        else:
+            output += f"**{queue.name}** [{len(players_in_queue)} / {queue.size}]\n"
 
-        if len(output) == 0:
-            output = "No queues or games"
+        if len(players_in_queue) > 0:
+            output += f"**IN QUEUE:** "
+            output += ", ".join(
+                sorted([escape_markdown(player.name) for player in players_in_queue])
+            )
+            output += "\n"
 
-        await send_message(
-            ctx.message.channel, embed_description=output, colour=Colour.blue()
-        )
+        for i, game_snapshot in enumerate(snapshot.games_by_queue_id.get(queue.id, [])):
+            game = game_snapshot.game
+            short_game_id = short_uuid(game.id)
+            if i > 0:
+                output += "\n"
+            output += f"**Map: {game.map_full_name}** ({short_game_id}):\n"
+            output += pretty_format_team(
+                game.team0_name, game.win_probability, game_snapshot.team0_players
+            )
+            output += pretty_format_team(
+                game.team1_name, 1 - game.win_probability, game_snapshot.team1_players
+            )
+            minutes_ago = (
+                                  datetime.now(timezone.utc)
+                                  - game.created_at.replace(tzinfo=timezone.utc)
+                          ).seconds // 60
+            output += f"@ {minutes_ago} minutes ago\n"
 
+    if len(output) == 0:
+        output = "No queues or games"
 
-def win_rate(wins, losses, ties):
-    denominator = max(wins + losses + ties, 1)
-    return round(100 * (wins + 0.5 * ties) / denominator, 1)
+    await send_message(
+        ctx.message.channel, embed_description=output, colour=Colour.blue()
+    )
 
 
 @bot.command()
-@commands.cooldown(1, 3600, commands.BucketType.user)
 async def stats(ctx: Context):
     with Session() as session:
         player_id = ctx.message.author.id
-        fgps = (
-            session.query(FinishedGamePlayer)
-            .filter(FinishedGamePlayer.player_id == player_id)
-            .all()
-        )
-        finished_game_ids = [fgp.finished_game_id for fgp in fgps]
-        fgs = (
-            session.query(FinishedGame).filter(FinishedGame.id.in_(finished_game_ids)).all()
-        )
-        fgps_by_finished_game_id: dict[str, FinishedGamePlayer] = {
-            fgp.finished_game_id: fgp for fgp in fgps
-        }
-
         player: Player = session.query(Player).filter(Player.id == player_id).first()
-        players: list[Player] = session.query(Player).all()
 
-        default_rating = Rating()
-        default_mu = config.DEFAULT_TRUESKILL_MU or default_rating.mu
-
-        # Filter players that haven't played a game
-        players = list(
-            filter(
-                lambda x: x.rated_trueskill_mu != default_rating.mu
-                          and x.rated_trueskill_mu != default_mu,
-                players,
-            )
-        )
-        trueskills = list(
-            sorted(
-                [
-                    round(p.rated_trueskill_mu - 3 * p.rated_trueskill_sigma, 2)
-                    for p in players
-                ]
-            )
-        )
-        if len(trueskills) > 0:
-            trueskill_index = bisect(
-                trueskills,
-                round(player.rated_trueskill_mu - 3 * player.rated_trueskill_sigma, 2),
-            )
-            trueskill_ratio = (len(trueskills) - trueskill_index) / len(trueskills)
-            if trueskill_ratio <= 0.05:
-                trueskill_pct = "Top 5%"
-            elif trueskill_ratio <= 0.10:
-                trueskill_pct = "Top 10%"
-            elif trueskill_ratio <= 0.25:
-                trueskill_pct = "Top 25%"
-            elif trueskill_ratio <= 0.50:
-                trueskill_pct = "Top 50%"
-            elif trueskill_ratio <= 0.75:
-                trueskill_pct = "Top 75%"
-            else:
-                trueskill_pct = "Top 100%"
-        else:
+        trueskill_ratio = get_rating_percentile(session, player)
+        if trueskill_ratio is None:
             trueskill_pct = "No games found"
+        elif trueskill_ratio <= 0.05:
+            trueskill_pct = "Top 5%"
+        elif trueskill_ratio <= 0.10:
+            trueskill_pct = "Top 10%"
+        elif trueskill_ratio <= 0.25:
+            trueskill_pct = "Top 25%"
+        elif trueskill_ratio <= 0.50:
+            trueskill_pct = "Top 50%"
+        elif trueskill_ratio <= 0.75:
+            trueskill_pct = "Top 75%"
+        else:
+            trueskill_pct = "Top 100%"
 
-        def is_win(finished_game: FinishedGame) -> bool:
-            if (
-                    fgps_by_finished_game_id[finished_game.id].team
-                    == finished_game.winning_team
-            ):
-                return True
-            return False
-
-        def is_loss(finished_game: FinishedGame) -> bool:
-            if (
-                    fgps_by_finished_game_id[finished_game.id].team
-                    != finished_game.winning_team
-                    and finished_game.winning_team != -1
-            ):
-                return True
-            return False
-
-        def is_tie(finished_game: FinishedGame) -> bool:
-            return finished_game.winning_team == -1
-
-        wins = list(filter(is_win, fgs))
-        losses = list(filter(is_loss, fgs))
-        ties = list(filter(is_tie, fgs))
-        winrate = win_rate(len(wins), len(losses), len(ties))
-        total_games = len(fgs)
-
-        def last_week(finished_game: FinishedGame) -> bool:
-            return finished_game.finished_at.timestamp() > datetime.now().timestamp() - timedelta(
-                days=7).total_seconds()
-
-        def last_month(finished_game: FinishedGame) -> bool:
-            return finished_game.finished_at.timestamp() > datetime.now().timestamp() - timedelta(
-                days=30).total_seconds()
-
-        def last_three_months(finished_game: FinishedGame) -> bool:
-            return finished_game.finished_at.timestamp() > datetime.now().timestamp() - timedelta(
-                days=90).total_seconds()
-
-        def last_year(finished_game: FinishedGame) -> bool:
-            return finished_game.finished_at.timestamp() > datetime.now().timestamp() - timedelta(
-                days=365).total_seconds()
-
-        games_last_week = list(filter(last_week, fgs))
-        wins_last_week = len(list(filter(is_win, games_last_week)))
-        losses_last_week = len(list(filter(is_loss, games_last_week)))
-        ties_last_week = len(list(filter(is_tie, games_last_week)))
-        winrate_last_week = win_rate(wins_last_week, losses_last_week, ties_last_week)
-
-        games_last_month = list(filter(last_month, fgs))
-        wins_last_month = len(list(filter(is_win, games_last_month)))
-        losses_last_month = len(list(filter(is_loss, games_last_month)))
-        ties_last_month = len(list(filter(is_tie, games_last_month)))
-        winrate_last_month = win_rate(wins_last_month, losses_last_month, ties_last_month)
-
-        games_last_three_months = list(filter(last_three_months, fgs))
-        wins_last_three_months = len(list(filter(is_win, games_last_three_months)))
-        losses_last_three_months = len(list(filter(is_loss, games_last_three_months)))
-        ties_last_three_months = len(list(filter(is_tie, games_last_three_months)))
-        winrate_last_three_months = win_rate(
-            wins_last_three_months, losses_last_three_months, ties_last_three_months
-        )
-
-        games_last_year = list(filter(last_year, fgs))
-        wins_last_year = len(list(filter(is_win, games_last_year)))
-        losses_last_year = len(list(filter(is_loss, games_last_year)))
-        ties_last_year = len(list(filter(is_tie, games_last_year)))
-        winrate_last_year = win_rate(wins_last_year, losses_last_year, ties_last_year)
+        lifetime, windows = get_player_stats(
+            session, player_id, datetime.now(timezone.utc).date()
+        )
 
         output = ""
         if config.SHOW_TRUESKILL:
@@ -3116,11 +2791,9 @@ async def stats(ctx: Context):
         else:
             output += f"**Trueskill:** {trueskill_pct}"
         output += f"\n\n**Wins / Losses / Ties / Total:**"
-        output += f"\n**Lifetime:** {len(wins)} / {len(losses)} / {len(ties)} / {total_games} _({winrate}%)_"
-        output += f"\n**Last 7 days:** {wins_last_week} / {losses_last_week} / {ties_last_week} / {len(games_last_week)} _({winrate_last_week}%)_"
-        output += f"\n**Last 30 days:** {wins_last_month} / {losses_last_month} / {ties_last_month} / {len(games_last_month)} _({winrate_last_month}%)_"
-        output += f"\n**Last 90 days:** {wins_last_three_months} / {losses_last_three_months} / {ties_last_three_months} / {len(games_last_three_months)} _({winrate_last_three_months}%)_"
-        output += f"\n**Last 365 days:** {wins_last_year} / {losses_last_year} / {ties_last_year} / {len(games_last_year)} _({winrate_last_year}%)_"
+        output += f"\n**Lifetime:** {lifetime.wins} / {lifetime.losses} / {lifetime.ties} / {lifetime.total} _({lifetime.win_rate}%)_"
+        for days, window in windows.items():
+            output += f"\n**Last {days} days:** {window.wins} / {window.losses} / {window.ties} / {window.total} _({window.win_rate}%)_"
 
         await send_message(
             channel=ctx.message.channel,
@@ -3220,8 +2893,9 @@ async def sub(ctx: Context, member: Member):
         session.delete(caller_game_player)
 
         # Remove the person subbed in from queues
-        session.query(QueuePlayer).filter(QueuePlayer.player_id == callee.id).delete()
+        queue_state.remove_players(session, [callee.id])
         session.commit()
+        in_game_index.substitute(caller_game.id, caller.id, callee.id)
     elif callee_game:
         callee_game_player = (
             session.query(InProgressGamePlayer)
@@ -3241,8 +2915,9 @@ async def sub(ctx: Context, member: Member):
         session.delete(callee_game_player)
 
         # Remove the person subbing in from queues
-        session.query(QueuePlayer).filter(QueuePlayer.player_id == caller.id).delete()
+        queue_state.remove_players(session, [caller.id])
         session.commit()
+        in_game_index.substitute(callee_game.id, callee.id, caller.id)
 
     await send_message(
         channel=message.channel,
@@ -3261,11 +2936,12 @@ async def sub(ctx: Context, member: Member):
         .all()
     )
     player_ids: list[int] = list(map(lambda x: x.player_id, game_players))
-    players, win_prob = get_even_teams(
+    players, win_prob = await get_even_teams(
         player_ids,
         len(player_ids) // 2,
         is_rated=queue.is_rated,
         queue_region_id=queue.queue_region_id,
+        team_solver=queue.team_solver,
     )
     for game_player in game_players:
         session.delete(game_player)
@@ -3351,6 +3027,7 @@ async def unban(ctx: Context, member: Member):
 
     players[0].is_banned = False
     session.commit()
+    permission_cache.set_banned(member.id, False)
     await send_message(
         message.channel,
         embed_description=f"{escape_markdown(member.name)} unbanned",
@@ -3366,6 +3043,8 @@ async def unisolatequeue(ctx: Context, queue_name: str):
     queue: Queue = session.query(Queue).filter(Queue.name.ilike(queue_name)).first()  # type: ignore
     if queue:
         queue.is_isolated = False
+        session.commit()
+        queue_state.sync_queue(queue)
         await send_message(
             message.channel,
             embed_description=f"Queue {queue_name} is now unisolated",
@@ -3377,7 +3056,6 @@ async def unisolatequeue(ctx: Context, queue_name: str):
             embed_description=f"Queue not found: {queue_name}",
             colour=Colour.red(),
         )
-    session.commit()
 
 
 @bot.command()
@@ -3396,6 +3074,7 @@ async def unlockqueue(ctx: Context, queue_name: str):
 
     queue.is_locked = False
     session.commit()
+    queue_state.sync_queue(queue)
 
     await send_message(
         message.channel,
@@ -3568,13 +3247,13 @@ async def votemap(ctx: Context, map_short_name: str):
             session.query(MapVote).delete()
             session.query(SkipMapVote).delete()
             # TODO: Check if another vote already exists
-            session.add(
-                VotePassedWaitlist(
-                    end_waitlist_at=datetime.now(timezone.utc)
-                                    + timedelta(seconds=config.RE_ADD_DELAY_SECONDS),
-                )
+            vpw = VotePassedWaitlist(
+                end_waitlist_at=datetime.now(timezone.utc)
+                                + timedelta(seconds=config.RE_ADD_DELAY_SECONDS),
             )
+            session.add(vpw)
             session.commit()
+            vote_passed_waitlist_scheduler.schedule(vpw.id, vpw.end_waitlist_at)
         else:
             map_votes: list[MapVote] = session.query(MapVote).all()
             voted_map_ids: list[str] = [map_vote.voteable_map_id for map_vote in map_votes]
@@ -3611,13 +3290,13 @@ async def voteskip_passed(message: Message):
         # TODO: Might be bugs if two votes pass one after the other
         vpw: VotePassedWaitlist | None = session.query(VotePassedWaitlist).first()
         if not vpw:
-            session.add(
-                VotePassedWaitlist(
-                    end_waitlist_at=datetime.now(timezone.utc)
-                                    + timedelta(seconds=config.RE_ADD_DELAY_SECONDS),
-                )
+            vpw = VotePassedWaitlist(
+                end_waitlist_at=datetime.now(timezone.utc)
+                                + timedelta(seconds=config.RE_ADD_DELAY_SECONDS),
             )
+            session.add(vpw)
         session.commit()
+        vote_passed_waitlist_scheduler.schedule(vpw.id, vpw.end_waitlist_at)
 
 
 @bot.command()
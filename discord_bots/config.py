@@ -99,6 +99,15 @@ DEFAULT_TRUESKILL_SIGMA: float | None = to_float(key="DEFAULT_TRUESKILL_MU")
 DISABLE_PRIVATE_MESSAGES = to_bool(key="DISABLE_PRIVATE_MESSAGES", default=False)
 POP_RANDOM_QUEUE = to_bool(key="POP_RANDOM_QUEUE", default=True)
 DAYS_UNTIL_INACTIVE: int = to_int(key="DAYS_UNTIL_INACTIVE", default=90)
+TEAM_SOLVER_EXACT_MAX_SIZE: int = to_int(key="TEAM_SOLVER_EXACT_MAX_SIZE", default=40)
+TEAM_SOLVER_TIME_LIMIT_SECONDS: float = to_float(key="TEAM_SOLVER_TIME_LIMIT_SECONDS", default=0.5)
+TEAM_SOLVER_WORKERS: int = to_int(key="TEAM_SOLVER_WORKERS", default=2)
+TEAM_SOLVER_TIMEOUT_SECONDS: float = to_float(key="TEAM_SOLVER_TIMEOUT_SECONDS", default=5.0)
+TEAM_SOLVER_FALLBACK_TIME_LIMIT_SECONDS: float = to_float(key="TEAM_SOLVER_FALLBACK_TIME_LIMIT_SECONDS", default=0.05)
+ADD_PLAYER_QUEUE_MAX_SIZE: int = to_int(key="ADD_PLAYER_QUEUE_MAX_SIZE", default=1000)
+ACTIVITY_FLUSH_SECONDS: float = to_float(key="ACTIVITY_FLUSH_SECONDS", default=5.0)
+PERMISSION_CACHE_TTL_SECONDS: float = to_float(key="PERMISSION_CACHE_TTL_SECONDS", default=300.0)
+SESSION_LEAK_SECONDS: float = to_float(key="SESSION_LEAK_SECONDS", default=60.0)
 
 # stats
 STATS_DIR: str | None = to_string(key="STATS_DIR")
@@ -0,0 +1,128 @@
+# In-memory copy of the custom_command table so on_message can look up custom
+# commands without going to the database.
+#
+# createcommand, editcommand and removecommand invalidate the registry, and
+# also send a NOTIFY on CHANNEL from the same transaction. Every bot process
+# LISTENs on that channel (see start_listener), so bots sharing a database
+# reload their copy once the change is committed. If the LISTEN connection
+# drops, it's reopened with backoff, reloading on every attempt meanwhile.
+import asyncio
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session as SQLAlchemySession
+
+from discord_bots.log import define_logger
+from discord_bots.models import CustomCommand, Session, engine
+
+log = define_logger(__name__)
+
+CHANNEL = "custom_command"
+# Seconds between attempts to LISTEN again after losing the connection
+MIN_RECONNECT_DELAY = 1
+MAX_RECONNECT_DELAY = 60
+
+
+class CustomCommandRegistry:
+    def __init__(self):
+        self._outputs: dict[str, str] = {}
+        self._is_loaded = False
+        self._listen_connection = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._reconnect_delay = MIN_RECONNECT_DELAY
+
+    def load(self, session: SQLAlchemySession | None = None) -> None:
+        if session is None:
+            with Session() as session:
+                self.load(session)
+            return
+        custom_command: CustomCommand
+        self._outputs = {
+            custom_command.name: custom_command.output
+            for custom_command in session.query(CustomCommand)
+        }
+        self._is_loaded = True
+        log.info(f"[CustomCommandRegistry.load] {len(self._outputs)} custom commands")
+
+    def get(self, name: str) -> str | None:
+        """
+        :returns: The output of the custom command, None if there isn't one
+        """
+        if not self._is_loaded:
+            self.load()
+        return self._outputs.get(name)
+
+    def invalidate(self, session: SQLAlchemySession | None = None) -> None:
+        """
+        Reload on the next lookup. Pass the session that changed the table to
+        also tell the other bot processes, they're notified when it commits.
+        """
+        self._is_loaded = False
+        if session is not None:
+            session.execute(text("SELECT pg_notify(:channel, '')"), {"channel": CHANNEL})
+
+    def start_listener(self, loop: asyncio.AbstractEventLoop) -> None:
+        """
+        LISTEN for changes made by other bot processes, on a dedicated
+        connection watched by the event loop
+        """
+        if self._listen_connection is not None:
+            return
+        self._loop = loop
+        connection = engine.raw_connection()
+        # Keep it out of the pool, it's in autocommit mode and LISTENing
+        connection.detach()
+        dbapi_connection = connection.connection
+        dbapi_connection.autocommit = True
+        with dbapi_connection.cursor() as cursor:
+            cursor.execute(f"LISTEN {CHANNEL}")
+        self._listen_connection = dbapi_connection
+        self._reconnect_delay = MIN_RECONNECT_DELAY
+        loop.add_reader(dbapi_connection.fileno(), self._on_notify)
+
+    def _on_notify(self) -> None:
+        try:
+            self._listen_connection.poll()
+        except Exception:
+            log.exception("[CustomCommandRegistry] Lost the LISTEN connection")
+            self._stop_listener()
+            self._schedule_reconnect()
+            return
+        if self._listen_connection.notifies:
+            self._listen_connection.notifies.clear()
+            self.invalidate()
+
+    def _stop_listener(self) -> None:
+        connection = self._listen_connection
+        self._listen_connection = None
+        try:
+            self._loop.remove_reader(connection.fileno())
+        except Exception:
+            pass
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def _schedule_reconnect(self) -> None:
+        # Notifications sent while disconnected are lost, so reload on every
+        # attempt until listening again
+        self.invalidate()
+        self._loop.call_later(self._reconnect_delay, self._reconnect)
+
+    def _reconnect(self) -> None:
+        try:
+            self.start_listener(self._loop)
+        except Exception:
+            self._reconnect_delay = min(self._reconnect_delay * 2, MAX_RECONNECT_DELAY)
+            log.warning(
+                f"[CustomCommandRegistry] Could not LISTEN, retrying in "
+                f"{self._reconnect_delay}s"
+            )
+            self._schedule_reconnect()
+            return
+        # Catch up on anything missed while disconnected
+        self.invalidate()
+        log.info("[CustomCommandRegistry] Listening again")
+
+
+custom_command_registry = CustomCommandRegistry()
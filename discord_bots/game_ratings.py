@@ -0,0 +1,219 @@
+# Rating a finished game and writing the results. Everyone's before and after
+# ratings are kept in arrays, one row per player, and written with one
+# statement per table: a bulk insert for finished_game_player, and either one
+# UPDATE ... FROM VALUES for player or one upsert for player_region_trueskill
+# depending on whether the queue has a region.
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from uuid import uuid4
+
+import numpy
+from sqlalchemy import BigInteger, Float, column, insert, update, values
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session as SQLAlchemySession
+from sqlalchemy.orm.attributes import set_committed_value
+from trueskill import Rating, rate
+
+from discord_bots.models import FinishedGamePlayer, Player, PlayerRegionTrueskill
+
+
+@dataclass
+class GameRatings:
+    """
+    Ratings of everyone in a game. Row i of every array is player_ids[i].
+
+    :teams: 0 or 1 for each player
+    :rated_before: (mu, sigma) for each player, likewise for the other arrays
+    """
+
+    player_ids: list[int]
+    teams: numpy.ndarray
+    rated_before: numpy.ndarray
+    rated_after: numpy.ndarray
+    unrated_before: numpy.ndarray
+    unrated_after: numpy.ndarray
+
+
+def _ranks(winning_team: int) -> list[int]:
+    if winning_team == 0:
+        return [0, 1]
+    elif winning_team == 1:
+        return [1, 0]
+    return [0, 0]
+
+
+def _rate_teams(before: numpy.ndarray, teams: numpy.ndarray, ranks: list[int]) -> numpy.ndarray:
+    team0 = numpy.flatnonzero(teams == 0)
+    team1 = numpy.flatnonzero(teams == 1)
+    team0_after, team1_after = rate(
+        [
+            [Rating(mu, sigma) for mu, sigma in before[team0]],
+            [Rating(mu, sigma) for mu, sigma in before[team1]],
+        ],
+        ranks,
+    )
+    after = before.copy()
+    after[team0] = [(rating.mu, rating.sigma) for rating in team0_after]
+    after[team1] = [(rating.mu, rating.sigma) for rating in team1_after]
+    return after
+
+
+def rate_game(
+    player_ids: list[int],
+    teams: list[int],
+    rated_before: list[tuple[float, float]],
+    unrated_before: list[tuple[float, float]],
+    winning_team: int,
+    is_rated: bool,
+    is_isolated: bool,
+) -> GameRatings:
+    """
+    Work out everyone's new ratings. Unrated queues only change the unrated
+    ratings and isolated queues don't change anything. A game with a single
+    player (solo queues for testing) doesn't change anything either.
+
+    :winning_team: 0, 1 or -1 for a tie
+    """
+    teams_array = numpy.array(teams, dtype=numpy.int8)
+    rated_before_array = numpy.array(rated_before, dtype=numpy.float64).reshape(-1, 2)
+    unrated_before_array = numpy.array(unrated_before, dtype=numpy.float64).reshape(-1, 2)
+    ranks = _ranks(winning_team)
+    should_rate = len(player_ids) > 1 and not is_isolated
+    return GameRatings(
+        player_ids=player_ids,
+        teams=teams_array,
+        rated_before=rated_before_array,
+        rated_after=(
+            _rate_teams(rated_before_array, teams_array, ranks)
+            if should_rate and is_rated
+            else rated_before_array
+        ),
+        unrated_before=unrated_before_array,
+        unrated_after=(
+            _rate_teams(unrated_before_array, teams_array, ranks)
+            if should_rate
+            else unrated_before_array
+        ),
+    )
+
+
+def write_game_ratings(
+    session: SQLAlchemySession,
+    finished_game_id: str,
+    players: list[Player],
+    game_ratings: GameRatings,
+    queue_region_id: str | None = None,
+) -> None:
+    """
+    Insert the game's finished_game_player rows and store everyone's new
+    ratings, in the player's region if the queue has one. The caller is
+    responsible for committing.
+
+    :players: In the same order as game_ratings.player_ids. Without a region
+    their ratings are updated in place, so they match the database.
+    """
+    if not players:
+        return
+
+    session.execute(
+        insert(FinishedGamePlayer),
+        [
+            {
+                "id": str(uuid4()),
+                "finished_game_id": finished_game_id,
+                "player_id": player.id,
+                "player_name": player.name,
+                "team": int(team),
+                "rated_trueskill_mu_before": float(rated_before[0]),
+                "rated_trueskill_sigma_before": float(rated_before[1]),
+                "rated_trueskill_mu_after": float(rated_after[0]),
+                "rated_trueskill_sigma_after": float(rated_after[1]),
+                "unrated_trueskill_mu_before": float(unrated_before[0]),
+                "unrated_trueskill_sigma_before": float(unrated_before[1]),
+                "unrated_trueskill_mu_after": float(unrated_after[0]),
+                "unrated_trueskill_sigma_after": float(unrated_after[1]),
+            }
+            for player, team, rated_before, rated_after, unrated_before, unrated_after in zip(
+                players,
+                game_ratings.teams,
+                game_ratings.rated_before,
+                game_ratings.rated_after,
+                game_ratings.unrated_before,
+                game_ratings.unrated_after,
+            )
+        ],
+    )
+
+    ratings_after = [
+        (
+            player.id,
+            float(rated_after[0]),
+            float(rated_after[1]),
+            float(unrated_after[0]),
+            float(unrated_after[1]),
+        )
+        for player, rated_after, unrated_after in zip(
+            players, game_ratings.rated_after, game_ratings.unrated_after
+        )
+    ]
+    if queue_region_id:
+        created_at = datetime.now(timezone.utc)
+        stmt = pg_insert(PlayerRegionTrueskill).values(
+            [
+                {
+                    "id": str(uuid4()),
+                    "player_id": player_id,
+                    "queue_region_id": queue_region_id,
+                    "rated_trueskill_mu": rated_mu,
+                    "rated_trueskill_sigma": rated_sigma,
+                    "unrated_trueskill_mu": unrated_mu,
+                    "unrated_trueskill_sigma": unrated_sigma,
+                    "created_at": created_at,
+                }
+                for player_id, rated_mu, rated_sigma, unrated_mu, unrated_sigma in ratings_after
+            ]
+        )
+        session.execute(
+            stmt.on_conflict_do_update(
+                index_elements=[
+                    PlayerRegionTrueskill.player_id,
+                    PlayerRegionTrueskill.queue_region_id,
+                ],
+                set_={
+                    "rated_trueskill_mu": stmt.excluded.rated_trueskill_mu,
+                    "rated_trueskill_sigma": stmt.excluded.rated_trueskill_sigma,
+                    "unrated_trueskill_mu": stmt.excluded.unrated_trueskill_mu,
+                    "unrated_trueskill_sigma": stmt.excluded.unrated_trueskill_sigma,
+                },
+            )
+        )
+        return
+
+    new_ratings = values(
+        column("id", BigInteger),
+        column("rated_trueskill_mu", Float),
+        column("rated_trueskill_sigma", Float),
+        column("unrated_trueskill_mu", Float),
+        column("unrated_trueskill_sigma", Float),
+        name="new_ratings",
+    ).data(ratings_after)
+    session.execute(
+        update(Player)
+        .where(Player.id == new_ratings.c.id)
+        .values(
+            rated_trueskill_mu=new_ratings.c.rated_trueskill_mu,
+            rated_trueskill_sigma=new_ratings.c.rated_trueskill_sigma,
+            unrated_trueskill_mu=new_ratings.c.unrated_trueskill_mu,
+            unrated_trueskill_sigma=new_ratings.c.unrated_trueskill_sigma,
+        )
+        .execution_options(synchronize_session=False)
+    )
+    # Keep the loaded players in line with what was written, without
+    # flushing the same change again
+    for player, (_, rated_mu, rated_sigma, unrated_mu, unrated_sigma) in zip(
+        players, ratings_after
+    ):
+        set_committed_value(player, "rated_trueskill_mu", rated_mu)
+        set_committed_value(player, "rated_trueskill_sigma", rated_sigma)
+        set_committed_value(player, "unrated_trueskill_mu", unrated_mu)
+        set_committed_value(player, "unrated_trueskill_sigma", unrated_sigma)
@@ -0,0 +1,74 @@
+# In-memory index of which in progress game each player is in, so checking
+# whether someone is in a game (on every add, and for every waitlisted player)
+# doesn't need a query.
+#
+# Like queue_state, the database stays the source of truth: queue pops,
+# finishgame, cancelgame and sub update the index once the
+# in_progress_game_player rows they write have committed, so a failed commit
+# doesn't leave the index ahead of the database. It's rebuilt from
+# in_progress_game_player when the bot starts (see main.on_ready).
+from sqlalchemy.orm import Session as SQLAlchemySession
+
+from discord_bots.log import define_logger
+from discord_bots.models import InProgressGamePlayer, Session
+
+log = define_logger(__name__)
+
+
+class InGameIndex:
+    def __init__(self):
+        self._game_id_by_player_id: dict[int, str] = {}
+        self._is_loaded = False
+
+    def load(self, session: SQLAlchemySession | None = None) -> None:
+        if session is None:
+            with Session() as session:
+                self.load(session)
+            return
+        self._game_id_by_player_id = {
+            player_id: in_progress_game_id
+            for player_id, in_progress_game_id in session.query(
+                InProgressGamePlayer.player_id, InProgressGamePlayer.in_progress_game_id
+            )
+        }
+        self._is_loaded = True
+        log.info(f"[InGameIndex.load] {len(self._game_id_by_player_id)} players in game")
+
+    def invalidate(self) -> None:
+        """
+        Rebuild the next time it's used, for when the database was changed
+        behind the index's back
+        """
+        self._is_loaded = False
+
+    def _ensure_loaded(self) -> None:
+        if not self._is_loaded:
+            self.load()
+
+    def game_id_for_player(self, player_id: int) -> str | None:
+        self._ensure_loaded()
+        return self._game_id_by_player_id.get(player_id)
+
+    def is_in_game(self, player_id: int) -> bool:
+        return self.game_id_for_player(player_id) is not None
+
+    def add_game(self, in_progress_game_id: str, player_ids: list[int]) -> None:
+        self._ensure_loaded()
+        for player_id in player_ids:
+            self._game_id_by_player_id[player_id] = in_progress_game_id
+
+    def remove_game(self, in_progress_game_id: str) -> None:
+        self._ensure_loaded()
+        self._game_id_by_player_id = {
+            player_id: game_id
+            for player_id, game_id in self._game_id_by_player_id.items()
+            if game_id != in_progress_game_id
+        }
+
+    def substitute(self, in_progress_game_id: str, out_player_id: int, in_player_id: int) -> None:
+        self._ensure_loaded()
+        self._game_id_by_player_id.pop(out_player_id, None)
+        self._game_id_by_player_id[in_player_id] = in_progress_game_id
+
+
+in_game_index = InGameIndex()
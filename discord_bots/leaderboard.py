@@ -0,0 +1,264 @@
+# Leaderboard rankings kept sorted in memory, globally and per queue region,
+# so the leaderboard command and rank lookups don't have to aggregate the
+# finished games every time.
+#
+# Only active players are ranked: players with a game that started within
+# the last DAYS_UNTIL_INACTIVE days, both when loading and when rolling off.
+# finishgame updates the ratings and last played time (when their latest game
+# started) of everyone in the game once it's committed,
+# and players roll off once their last game is too old, coming back in every
+# region they have a rating in when they play again. Everything is rebuilt
+# from the database when the bot starts (see main.on_ready).
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+
+from sortedcontainers import SortedList
+from sqlalchemy import bindparam, func, select
+from sqlalchemy.orm import Session as SQLAlchemySession
+
+import discord_bots.config as config
+from discord_bots.log import define_logger
+from discord_bots.models import (
+    FinishedGame,
+    FinishedGamePlayer,
+    Player,
+    PlayerRegionTrueskill,
+    Session,
+)
+
+log = define_logger(__name__)
+
+# When each active player's latest game started. Built once with a bound
+# parameter so the compiled statement is cached, and backed by
+# ix_finished_game_started_at_finished_at and
+# ix_finished_game_player_player_id_finished_game_id.
+LAST_PLAYED = (
+    select(
+        FinishedGamePlayer.player_id,
+        func.max(FinishedGame.started_at).label("last_played"),
+    )
+    .join(FinishedGame, FinishedGame.id == FinishedGamePlayer.finished_game_id)
+    .where(FinishedGame.started_at > bindparam("cutoff"))
+    .group_by(FinishedGamePlayer.player_id)
+)
+
+
+@dataclass
+class LeaderboardEntry:
+    player_id: int
+    name: str
+    rated_trueskill_mu: float
+    rated_trueskill_sigma: float
+
+    @property
+    def leaderboard_trueskill(self) -> float:
+        return self.rated_trueskill_mu - 3 * self.rated_trueskill_sigma
+
+
+class Ranking:
+    """
+    Entries sorted by leaderboard trueskill, highest first. Updates, top n and
+    rank lookups are all O(log n).
+    """
+
+    def __init__(self):
+        # (-leaderboard_trueskill, player_id), so the best player comes first
+        # and ties are broken the same way every time
+        self._sorted: SortedList = SortedList()
+        self._entries: dict[int, LeaderboardEntry] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def _key(entry: LeaderboardEntry) -> tuple[float, int]:
+        return -entry.leaderboard_trueskill, entry.player_id
+
+    def update(self, entry: LeaderboardEntry) -> None:
+        self.remove(entry.player_id)
+        self._entries[entry.player_id] = entry
+        self._sorted.add(self._key(entry))
+
+    def remove(self, player_id: int) -> None:
+        entry = self._entries.pop(player_id, None)
+        if entry is not None:
+            self._sorted.remove(self._key(entry))
+
+    def top(self, n: int) -> list[LeaderboardEntry]:
+        return [self._entries[player_id] for _, player_id in self._sorted.islice(0, n)]
+
+    def rank(self, player_id: int) -> int | None:
+        """
+        :returns: 1 for the best player, None if the player isn't ranked
+        """
+        entry = self._entries.get(player_id)
+        if entry is None:
+            return None
+        return self._sorted.index(self._key(entry)) + 1
+
+
+class LeaderboardService:
+    def __init__(self, days_until_inactive: int):
+        self.days_until_inactive = days_until_inactive
+        self._global = Ranking()
+        self._regions: dict[str, Ranking] = {}
+        self._last_played: dict[int, datetime] = {}
+        # (last_played, player_id) for rolling off inactive players, oldest
+        # first
+        self._by_last_played: SortedList = SortedList()
+        self._is_loaded = False
+
+    @staticmethod
+    def _utc(at: datetime) -> datetime:
+        # Datetimes from the database are naive UTC
+        return at if at.tzinfo else at.replace(tzinfo=timezone.utc)
+
+    def _cutoff(self, now: datetime | None = None) -> datetime:
+        now = self._utc(now) if now else datetime.now(timezone.utc)
+        return now - timedelta(days=self.days_until_inactive)
+
+    def load(self, session: SQLAlchemySession | None = None) -> None:
+        if session is None:
+            with Session() as session:
+                self.load(session)
+            return
+
+        self._global = Ranking()
+        self._regions = {}
+        self._last_played = {}
+        self._by_last_played = SortedList()
+        for player_id, last_played in session.execute(
+            LAST_PLAYED, {"cutoff": self._cutoff().replace(tzinfo=None)}
+        ):
+            self._set_last_played(player_id, last_played)
+
+        names: dict[int, str] = {}
+        player: Player
+        for player in session.query(Player).filter(
+            Player.id.in_(self._last_played)  # type: ignore
+        ):
+            names[player.id] = player.name
+            self._global.update(
+                LeaderboardEntry(
+                    player.id, player.name, player.rated_trueskill_mu, player.rated_trueskill_sigma
+                )
+            )
+        self._load_region_entries(session, names)
+        self._is_loaded = True
+        log.info(f"[LeaderboardService.load] {len(self._global)} active players")
+
+    def invalidate(self) -> None:
+        self._is_loaded = False
+
+    def _ensure_loaded(self) -> None:
+        if not self._is_loaded:
+            self.load()
+
+    def _region(self, queue_region_id: str) -> Ranking:
+        if queue_region_id not in self._regions:
+            self._regions[queue_region_id] = Ranking()
+        return self._regions[queue_region_id]
+
+    def _load_region_entries(
+        self, session: SQLAlchemySession, names: dict[int, str]
+    ) -> None:
+        """
+        Rank players in every region they have a rating in
+
+        :names: player_id -> name of the players to load
+        """
+        prt: PlayerRegionTrueskill
+        for prt in session.query(PlayerRegionTrueskill).filter(
+            PlayerRegionTrueskill.player_id.in_(names)  # type: ignore
+        ):
+            self._region(prt.queue_region_id).update(
+                LeaderboardEntry(
+                    prt.player_id,
+                    names[prt.player_id],
+                    prt.rated_trueskill_mu,
+                    prt.rated_trueskill_sigma,
+                )
+            )
+
+    def _set_last_played(self, player_id: int, last_played: datetime) -> None:
+        last_played = self._utc(last_played)
+        previous = self._last_played.get(player_id)
+        if previous is not None:
+            if previous >= last_played:
+                return
+            self._by_last_played.discard((previous, player_id))
+        self._last_played[player_id] = last_played
+        self._by_last_played.add((last_played, player_id))
+
+    def roll_off(self, now: datetime | None = None) -> int:
+        """
+        Remove players whose last game is too old
+
+        :returns: Number of players removed
+        """
+        cutoff = self._cutoff(now)
+        removed = 0
+        while self._by_last_played and self._by_last_played[0][0] <= cutoff:
+            _, player_id = self._by_last_played.pop(0)
+            del self._last_played[player_id]
+            self._global.remove(player_id)
+            for ranking in self._regions.values():
+                ranking.remove(player_id)
+            removed += 1
+        return removed
+
+    # Writes
+
+    def record_game(
+        self,
+        started_at: datetime,
+        entries: list[LeaderboardEntry],
+        queue_region_id: str | None = None,
+        region_ratings: dict[int, tuple[float, float]] | None = None,
+    ) -> None:
+        """
+        Update everyone who played a finished game, once it's committed
+
+        :started_at: When the game started, which is when it counts as played
+
+        :entries: Everyone's global rating after the game
+        :region_ratings: player_id -> (mu, sigma) in queue_region_id
+        """
+        self._ensure_loaded()
+        # Players who weren't active were rolled off every region, not just
+        # the one they played in now
+        returning_names = {
+            entry.player_id: entry.name
+            for entry in entries
+            if entry.player_id not in self._last_played
+        }
+        if returning_names:
+            with Session() as session:
+                self._load_region_entries(session, returning_names)
+        for entry in entries:
+            self._set_last_played(entry.player_id, started_at)
+            self._global.update(entry)
+            if queue_region_id and region_ratings and entry.player_id in region_ratings:
+                mu, sigma = region_ratings[entry.player_id]
+                self._region(queue_region_id).update(
+                    LeaderboardEntry(entry.player_id, entry.name, mu, sigma)
+                )
+
+    # Reads
+
+    def top(self, n: int, queue_region_id: str | None = None) -> list[LeaderboardEntry]:
+        self._ensure_loaded()
+        self.roll_off()
+        if queue_region_id:
+            return self._region(queue_region_id).top(n)
+        return self._global.top(n)
+
+    def rank(self, player_id: int, queue_region_id: str | None = None) -> int | None:
+        self._ensure_loaded()
+        self.roll_off()
+        if queue_region_id:
+            return self._region(queue_region_id).rank(player_id)
+        return self._global.rank(player_id)
+
+
+leaderboard_service = LeaderboardService(config.DAYS_UNTIL_INACTIVE)
@@ -8,14 +8,23 @@ from discord.ext.commands.errors import CommandOnCooldown
 
 from discord_bots.config import API_KEY, COMMAND_PREFIX, CONFIG_VALID, CHANNEL_ID, SEED_ADMIN_IDS
 from discord_bots.log import define_default_logger, define_logger
+from .activity import activity_tracker
 from .bot import bot
-from .models import CustomCommand, Player, QueuePlayer, QueueWaitlistPlayer, Session
+from .custom_commands import custom_command_registry
+from .models import Player, QueueWaitlistPlayer, Session
+from .in_game import in_game_index
+from .leaderboard import leaderboard_service
+from .permissions import permission_cache
+from .queue_state import queue_state
+from .sessions import closes_sessions
+from .teams import shutdown_team_pools
 from .tasks import (
-    add_player_task,
+    activity_flush_task,
     afk_timer_task,
+    connection_leak_task,
     map_rotation_task,
-    queue_waitlist_task,
-    vote_passed_waitlist_task,
+    start_add_player_worker,
+    start_waitlist_schedulers,
 )
 
 define_default_logger()
@@ -55,14 +64,23 @@ async def on_ready():
         await bot.logout()
         return
 
-    add_player_task.start()
+    queue_state.load()
+    activity_tracker.load()
+    custom_command_registry.load()
+    permission_cache.load()
+    in_game_index.load()
+    leaderboard_service.load()
+    custom_command_registry.start_listener(bot.loop)
+    start_add_player_worker()
+    activity_flush_task.start()
     afk_timer_task.start()
     map_rotation_task.start()
-    queue_waitlist_task.start()
-    vote_passed_waitlist_task.start()
+    connection_leak_task.start()
+    start_waitlist_schedulers()
 
 
 @bot.event
+@closes_sessions
 async def on_command_error(ctx: Context, error: CommandError):
     if isinstance(error, CommandNotFound) or isinstance(error, CheckFailure):
         log.debug(f"[on_command_error] {error}")
@@ -110,63 +128,32 @@ async def on_command_error(ctx: Context, error: CommandError):
 
 
 @bot.event
+@closes_sessions
 async def on_message(message: Message):
     if message.channel.id == CHANNEL_ID:
-        with Session() as session:
-            player: Player | None = (
-                session.query(Player).filter(Player.id == message.author.id).first()
-            )
-            if player:
-                player.last_activity_at = datetime.now(timezone.utc)
-                if player.name != message.author.display_name:
-                    player.name = message.author.display_name
-            else:
-                session.add(
-                    Player(
-                        id=message.author.id,
-                        name=message.author.display_name,
-                        last_activity_at=datetime.now(timezone.utc),
-                    )
-                )
-            session.commit()
+        activity_tracker.record(message.author.id, message.author.display_name)
         await bot.process_commands(message)
 
         # Custom commands below
         if not message.content.startswith(COMMAND_PREFIX):
             return
 
-        bot_commands = {command.name for command in bot.commands}
         command_name = message.content.split(" ")[0][1:]
-        with Session() as session:
-            if command_name not in bot_commands:
-                custom_command: CustomCommand | None = (
-                    session.query(CustomCommand)
-                    .filter(CustomCommand.name == command_name)
-                    .first()
-                )
-                if custom_command:
-                    await message.channel.send(content=custom_command.output)
+        if command_name not in bot.all_commands:
+            output = custom_command_registry.get(command_name)
+            if output:
+                await message.channel.send(content=output)
 
 
 @bot.event
+@closes_sessions
 async def on_reaction_add(reaction: Reaction, user: User | Member):
-    session = Session()
-    player: Player | None = session.query(Player).filter(Player.id == user.id).first()
-    if player:
-        player.last_activity_at = datetime.now(timezone.utc)
-        session.commit()
-    else:
-        session.add(
-            Player(
-                id=reaction.message.author.id,
-                name=reaction.message.author.display_name,
-                last_activity_at=datetime.now(timezone.utc),
-            )
-        )
-    session.close()
+    # Reactions count from any channel, they don't rename existing players
+    activity_tracker.record(user.id, user.display_name, update_name=False)
 
 
 @bot.event
+@closes_sessions
 async def on_join(member: Member):
     session = Session()
     player = session.query(Player).filter(Player.id == member.id).first()
@@ -180,9 +167,10 @@ async def on_join(member: Member):
 
 
 @bot.event
+@closes_sessions
 async def on_leave(member: Member):
     session = Session()
-    session.query(QueuePlayer).filter(QueuePlayer.player_id == member.id).delete()
+    queue_state.remove_players(session, [member.id])
     session.query(QueueWaitlistPlayer).filter(
         QueueWaitlistPlayer.player_id == member.id
     ).delete()
@@ -196,6 +184,8 @@ def main():
 
     create_seed_admins()
     bot.run(API_KEY)
+    activity_tracker.flush()
+    shutdown_team_pools()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,301 @@
+# Columnar backups of the match history: finished games, their players and a
+# snapshot of everyone's ratings (player and player_region_trueskill), saved
+# as one NumPy .npz archive with an array per column.
+#
+# Exporting streams each table from PostgreSQL in chunks into memory-mapped
+# column files, so memory use doesn't grow with the history, then zips them
+# up. Importing loads the archive with COPY into temporary tables and merges
+# it in with INSERT ... SELECT, so restoring over an existing database only
+# adds missing games and updates ratings. The new games are added to
+# player_daily_stats in the same transaction. The bot's in-memory state
+# (leaderboard, queue and in-game caches) isn't told about an import, restart
+# it afterwards.
+#
+# Archived columns are whatever the models have. Nullable columns get an
+# extra "<table>.<column>.null" mask array, since .npz arrays can't hold NULL
+# without pickling.
+import io
+import os
+import zipfile
+from datetime import datetime
+from tempfile import TemporaryDirectory
+from timeit import default_timer
+from typing import Iterator
+
+import numpy
+from numpy.lib.format import open_memmap
+from sqlalchemy import Column, Table, func, select, text
+from sqlalchemy.engine import Connection
+
+from discord_bots.log import define_logger
+from discord_bots.models import (
+    FinishedGame,
+    FinishedGamePlayer,
+    Player,
+    PlayerRegionTrueskill,
+    engine,
+)
+from discord_bots.player_stats import add_daily_counts
+
+log = define_logger(__name__)
+
+CHUNK_SIZE = 50000
+
+# In the order they're imported, so foreign keys are satisfied
+TABLES: list[Table] = [
+    Player.__table__,
+    FinishedGame.__table__,
+    FinishedGamePlayer.__table__,
+    PlayerRegionTrueskill.__table__,
+]
+
+# How archived rows are merged into each table. finished_game and
+# finished_game_player keep whatever is already there, ratings are replaced.
+MERGES: dict[str, str] = {
+    "player": """
+        ON CONFLICT (id) DO UPDATE SET
+            name = excluded.name,
+            rated_trueskill_mu = excluded.rated_trueskill_mu,
+            rated_trueskill_sigma = excluded.rated_trueskill_sigma,
+            unrated_trueskill_mu = excluded.unrated_trueskill_mu,
+            unrated_trueskill_sigma = excluded.unrated_trueskill_sigma
+    """,
+    "finished_game": "ON CONFLICT (id) DO NOTHING",
+    "finished_game_player": "ON CONFLICT (id) DO NOTHING",
+    "player_region_trueskill": """
+        ON CONFLICT (player_id, queue_region_id) DO UPDATE SET
+            rated_trueskill_mu = excluded.rated_trueskill_mu,
+            rated_trueskill_sigma = excluded.rated_trueskill_sigma,
+            unrated_trueskill_mu = excluded.unrated_trueskill_mu,
+            unrated_trueskill_sigma = excluded.unrated_trueskill_sigma
+    """,
+}
+
+# Wins, losses and ties per player and day of the finished_game_player rows
+# that were new, to add to player_daily_stats like finishgame would have
+NEW_DAILY_COUNTS = """
+    SELECT
+        import_finished_game_player.player_id,
+        CAST(finished_game.finished_at AS DATE) AS day,
+        COUNT(*) FILTER (
+            WHERE import_finished_game_player.team = finished_game.winning_team
+        ) AS wins,
+        COUNT(*) FILTER (
+            WHERE finished_game.winning_team != -1
+            AND import_finished_game_player.team != finished_game.winning_team
+        ) AS losses,
+        COUNT(*) FILTER (WHERE finished_game.winning_team = -1) AS ties
+    FROM import_finished_game_player
+    JOIN finished_game
+        ON finished_game.id = import_finished_game_player.finished_game_id
+    GROUP BY import_finished_game_player.player_id, day
+"""
+
+# Regions aren't archived, ratings in regions that don't exist are skipped
+FILTERS: dict[str, str] = {
+    "player_region_trueskill": "WHERE queue_region_id IN (SELECT id FROM queue_region)",
+}
+
+
+def _key(table: Table, column: Column) -> str:
+    return f"{table.name}.{column.name}"
+
+
+def _dtype(column: Column, string_length: int) -> numpy.dtype:
+    python_type = column.type.python_type
+    if python_type is bool:
+        return numpy.dtype(bool)
+    if python_type is int:
+        return numpy.dtype(numpy.int64)
+    if python_type is float:
+        return numpy.dtype(numpy.float64)
+    if python_type is datetime:
+        return numpy.dtype("datetime64[us]")
+    return numpy.dtype(f"U{max(string_length, 1)}")
+
+
+def _empty(dtype: numpy.dtype):
+    if dtype.kind == "M":
+        return numpy.datetime64("NaT")
+    if dtype.kind == "U":
+        return ""
+    return dtype.type(0)
+
+
+def _export_table(connection: Connection, table: Table, directory: str) -> list[str]:
+    """
+    Stream a table into memory-mapped column files
+
+    :returns: The files written
+    """
+    string_columns = [
+        column for column in table.columns if column.type.python_type is str
+    ]
+    row_count, *string_lengths = connection.execute(
+        select(
+            func.count(),
+            *[func.coalesce(func.max(func.length(column)), 0) for column in string_columns],
+        ).select_from(table)
+    ).one()
+    string_length_by_name = {
+        column.name: length for column, length in zip(string_columns, string_lengths)
+    }
+
+    paths = []
+    arrays: list[tuple[Column, numpy.ndarray, numpy.ndarray | None]] = []
+    for column in table.columns:
+        dtype = _dtype(column, string_length_by_name.get(column.name, 0))
+        path = os.path.join(directory, f"{_key(table, column)}.npy")
+        paths.append(path)
+        values = open_memmap(path, mode="w+", dtype=dtype, shape=(row_count,))
+        nulls = None
+        if column.nullable:
+            null_path = os.path.join(directory, f"{_key(table, column)}.null.npy")
+            paths.append(null_path)
+            nulls = open_memmap(null_path, mode="w+", dtype=bool, shape=(row_count,))
+        arrays.append((column, values, nulls))
+
+    start = 0
+    result = connection.execution_options(
+        stream_results=True, max_row_buffer=CHUNK_SIZE
+    ).execute(select(*table.columns))
+    for rows in result.partitions(CHUNK_SIZE):
+        end = start + len(rows)
+        for i, (column, values, nulls) in enumerate(arrays):
+            column_values = [row[i] for row in rows]
+            if nulls is not None:
+                is_null = [value is None for value in column_values]
+                nulls[start:end] = is_null
+                empty = _empty(values.dtype)
+                column_values = [
+                    empty if value_is_null else value
+                    for value, value_is_null in zip(column_values, is_null)
+                ]
+            values[start:end] = column_values
+        start = end
+    for _, values, nulls in arrays:
+        values.flush()
+        if nulls is not None:
+            nulls.flush()
+    log.info(f"[export_match_history] {table.name}: {row_count} rows")
+    return paths
+
+
+def export_match_history(path: str, connection: Connection | None = None) -> None:
+    if connection is None:
+        # One snapshot for every table, so counts and rows agree
+        with engine.connect().execution_options(
+            isolation_level="REPEATABLE READ"
+        ) as connection:
+            with connection.begin():
+                export_match_history(path, connection)
+            return
+
+    start = default_timer()
+    with TemporaryDirectory(prefix="match-archive-") as directory:
+        paths = []
+        for table in TABLES:
+            paths += _export_table(connection, table, directory)
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+            for column_path in paths:
+                archive.write(column_path, os.path.basename(column_path))
+    log.info(f"[export_match_history] Wrote {path} in {default_timer() - start:.1f}s")
+
+
+def _copy_value(value) -> str:
+    """
+    Encode a value for COPY's text format
+    """
+    if value is None:
+        return "\\N"
+    if isinstance(value, str):
+        return (
+            value.replace("\\", "\\\\")
+            .replace("\t", "\\t")
+            .replace("\n", "\\n")
+            .replace("\r", "\\r")
+        )
+    return str(value)
+
+
+def _copy_chunks(table: Table, directory: str) -> Iterator[io.StringIO]:
+    """
+    Encode a table's extracted column files for COPY, CHUNK_SIZE rows at a
+    time
+    """
+    arrays = []
+    for column in table.columns:
+        values = numpy.load(os.path.join(directory, f"{_key(table, column)}.npy"), mmap_mode="r")
+        null_path = os.path.join(directory, f"{_key(table, column)}.null.npy")
+        nulls = numpy.load(null_path, mmap_mode="r") if os.path.exists(null_path) else None
+        arrays.append((values, nulls))
+
+    row_count = len(arrays[0][0])
+    for start in range(0, row_count, CHUNK_SIZE):
+        column_values = []
+        for values, nulls in arrays:
+            chunk = values[start : start + CHUNK_SIZE]
+            if chunk.dtype.kind == "M":
+                chunk = chunk.astype(str)
+            chunk = chunk.tolist()
+            if nulls is not None:
+                chunk = [
+                    None if is_null else value
+                    for value, is_null in zip(chunk, nulls[start : start + CHUNK_SIZE])
+                ]
+            column_values.append([_copy_value(value) for value in chunk])
+        yield io.StringIO("".join("\t".join(row) + "\n" for row in zip(*column_values)))
+
+
+def import_match_history(path: str, connection: Connection | None = None) -> dict[str, int]:
+    """
+    :returns: Rows read from the archive per table
+    """
+    if connection is None:
+        with engine.begin() as connection:
+            return import_match_history(path, connection)
+
+    start = default_timer()
+    row_counts: dict[str, int] = {}
+    with TemporaryDirectory(prefix="match-archive-") as directory:
+        with zipfile.ZipFile(path) as archive:
+            archive.extractall(directory)
+        for table in TABLES:
+            column_list = ", ".join(column.name for column in table.columns)
+            staging = f"import_{table.name}"
+            connection.execute(
+                text(
+                    f"CREATE TEMPORARY TABLE {staging} AS "
+                    f"SELECT {column_list} FROM {table.name} WITH NO DATA"
+                )
+            )
+            cursor = connection.connection.cursor()
+            try:
+                for chunk in _copy_chunks(table, directory):
+                    cursor.copy_expert(f"COPY {staging} ({column_list}) FROM STDIN", chunk)
+            finally:
+                cursor.close()
+            row_counts[table.name] = connection.execute(
+                text(f"SELECT count(*) FROM {staging}")
+            ).scalar_one()
+            if table.name == "finished_game_player":
+                # Keep only the games that are new, to count them below
+                connection.execute(
+                    text(
+                        f"DELETE FROM {staging} USING finished_game_player "
+                        f"WHERE {staging}.id = finished_game_player.id"
+                    )
+                )
+            connection.execute(
+                text(
+                    f"INSERT INTO {table.name} ({column_list}) "
+                    f"SELECT {column_list} FROM {staging} {FILTERS.get(table.name, '')} "
+                    f"{MERGES[table.name]}"
+                )
+            )
+            if table.name == "finished_game_player":
+                add_daily_counts(connection, connection.execute(text(NEW_DAILY_COUNTS)))
+            connection.execute(text(f"DROP TABLE {staging}"))
+            log.info(f"[import_match_history] {table.name}: {row_counts[table.name]} rows")
+    log.info(f"[import_match_history] Read {path} in {default_timer() - start:.1f}s")
+    return row_counts
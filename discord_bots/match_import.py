@@ -0,0 +1,383 @@
+# Importing match history from the old bot's JSON export (an array of
+# matches, see scripts/import_match_history.py).
+#
+# The file is parsed one match at a time, so memory doesn't grow with the
+# export, and everyone's ratings are kept in memory and rated with
+# game_ratings.rate_game instead of being read back from the database.
+# Matches are written CHUNK_SIZE at a time, one transaction per chunk: one
+# upsert for the players seen in the chunk, one executemany each for
+# finished_game and finished_game_player, and the chunk's wins, losses and
+# ties added to player_daily_stats.
+#
+# Imported finished games get ids built from the match's position in the file
+# (see imported_finished_game_id), and players' ratings are committed with
+# their games, so an interrupted import can pick up after the last committed
+# match.
+import codecs
+import json
+import re
+from dataclasses import dataclass
+from datetime import datetime
+from timeit import default_timer
+from typing import Any, BinaryIO, Callable, Iterator
+from uuid import uuid4
+
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.engine import Connection
+from trueskill import Rating
+
+from discord_bots.game_ratings import rate_game
+from discord_bots.log import define_logger
+from discord_bots.models import (
+    FinishedGame,
+    FinishedGamePlayer,
+    Player,
+    PlayerDailyStats,
+    PlayerRegionTrueskill,
+    default_trueskill_mu,
+    default_trueskill_sigma,
+    engine,
+)
+from discord_bots.player_stats import add_daily_counts, count_game_outcomes
+from discord_bots.utils import win_probability
+
+log = define_logger(__name__)
+
+# Matches per transaction
+CHUNK_SIZE = 1000
+READ_SIZE = 1 << 16
+# Imported finished game ids are this followed by the match index in hex,
+# shaped like the uuid4 ids of every other game. Being fixed width, the
+# largest id is the last imported match.
+IMPORTED_ID_PREFIX = "00000000-0000-0000-"
+SKIPPED_QUEUES = {"bottest"}
+UNRATED_QUEUES = {"LTunrated"}
+
+WHITESPACE = re.compile(r"\s*")
+
+
+def imported_finished_game_id(match_index: int) -> str:
+    digits = f"{match_index:016x}"
+    return f"{IMPORTED_ID_PREFIX}{digits[:4]}-{digits[4:]}"
+
+
+def imported_match_index(finished_game_id: str) -> int:
+    return int(finished_game_id.removeprefix(IMPORTED_ID_PREFIX).replace("-", ""), 16)
+
+
+def iter_json_array(file: BinaryIO, read_size: int = READ_SIZE) -> Iterator[Any]:
+    """
+    Parse a top-level JSON array one item at a time, reading the file
+    read_size bytes at a time
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    position = 0
+    end_of_file = False
+    # "[" first, then an item or "]", then "," or "]" after every item
+    expected = "["
+    while True:
+        position = WHITESPACE.match(buffer, position).end()
+        if position == len(buffer) and not end_of_file:
+            data = file.read(read_size)
+            end_of_file = not data
+            buffer = buffer[position:] + utf8.decode(data, final=end_of_file)
+            position = 0
+            continue
+        if position == len(buffer):
+            raise ValueError("JSON array ended early")
+
+        char = buffer[position]
+        if expected == "[":
+            if char != "[":
+                raise ValueError(f"Expected a JSON array, found {char!r}")
+            position += 1
+            expected = "first item"
+        elif char == "]" and expected in ("first item", "separator"):
+            return
+        elif expected == "separator":
+            if char != ",":
+                raise ValueError(f"Expected ',' or ']' between items, found {char!r}")
+            position += 1
+            expected = "item"
+        else:
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if end_of_file:
+                    raise
+                end = None
+            # A number at the end of the buffer might continue in the next read
+            if end is None or (end == len(buffer) and not end_of_file):
+                data = file.read(read_size)
+                end_of_file = not data
+                buffer = buffer[position:] + utf8.decode(data, final=end_of_file)
+                position = 0
+                continue
+            yield item
+            position = end
+            expected = "separator"
+
+
+@dataclass
+class ImportStats:
+    """
+    :matches: Matches read in this run, including skipped ones
+    :skipped: Matches from skipped queues or that couldn't be rated
+    """
+
+    matches: int = 0
+    skipped: int = 0
+    game_players: int = 0
+    seconds: float = 0.0
+
+    @property
+    def imported(self) -> int:
+        return self.matches - self.skipped
+
+    @property
+    def matches_per_second(self) -> float:
+        return self.matches / self.seconds if self.seconds else 0.0
+
+
+class _Chunk:
+    """
+    Rows for the matches since the last commit
+    """
+
+    def __init__(self):
+        self.matches = 0
+        self.finished_games: list[dict] = []
+        self.finished_game_players: list[dict] = []
+        self.player_ids: set[int] = set()
+
+
+def _last_imported_match_index(connection: Connection) -> int | None:
+    last_id = connection.execute(
+        select(func.max(FinishedGame.id)).where(
+            FinishedGame.id.startswith(IMPORTED_ID_PREFIX)
+        )
+    ).scalar_one()
+    return imported_match_index(last_id) if last_id else None
+
+
+def _write_chunk(
+    connection: Connection,
+    chunk: _Chunk,
+    names: dict[int, str],
+    ratings: dict[int, list[float]],
+) -> None:
+    with connection.begin():
+        if chunk.player_ids:
+            stmt = pg_insert(Player).values(
+                [
+                    {
+                        "id": player_id,
+                        "name": names[player_id],
+                        "is_admin": False,
+                        "is_banned": False,
+                        "rated_trueskill_mu": ratings[player_id][0],
+                        "rated_trueskill_sigma": ratings[player_id][1],
+                        "unrated_trueskill_mu": ratings[player_id][2],
+                        "unrated_trueskill_sigma": ratings[player_id][3],
+                    }
+                    for player_id in sorted(chunk.player_ids)
+                ]
+            )
+            connection.execute(
+                stmt.on_conflict_do_update(
+                    index_elements=[Player.id],
+                    set_={
+                        "name": stmt.excluded.name,
+                        "rated_trueskill_mu": stmt.excluded.rated_trueskill_mu,
+                        "rated_trueskill_sigma": stmt.excluded.rated_trueskill_sigma,
+                        "unrated_trueskill_mu": stmt.excluded.unrated_trueskill_mu,
+                        "unrated_trueskill_sigma": stmt.excluded.unrated_trueskill_sigma,
+                    },
+                )
+            )
+        if chunk.finished_games:
+            connection.execute(insert(FinishedGame), chunk.finished_games)
+        if chunk.finished_game_players:
+            connection.execute(insert(FinishedGamePlayer), chunk.finished_game_players)
+            games = {
+                finished_game["id"]: finished_game for finished_game in chunk.finished_games
+            }
+            add_daily_counts(
+                connection,
+                count_game_outcomes(
+                    (
+                        row["player_id"],
+                        games[row["finished_game_id"]]["finished_at"].date(),
+                        row["team"],
+                        games[row["finished_game_id"]]["winning_team"],
+                    )
+                    for row in chunk.finished_game_players
+                ),
+            )
+
+
+def _add_match(
+    chunk: _Chunk,
+    match_index: int,
+    match: dict,
+    names: dict[int, str],
+    ratings: dict[int, list[float]],
+) -> bool:
+    """
+    Rate a match and add its rows to the chunk
+
+    :returns: False if the match was skipped
+    """
+    if match["queue"]["name"] in SKIPPED_QUEUES:
+        return False
+
+    player_ids = [json_player["user"]["id"] for json_player in match["players"]]
+    # Teams are 1 and 2 in the export
+    teams = [0 if json_player["team"] == 1 else 1 for json_player in match["players"]]
+    before = [
+        ratings.get(
+            player_id,
+            [default_trueskill_mu, default_trueskill_sigma] * 2,
+        )
+        for player_id in player_ids
+    ]
+    # winningTeam is 0 for a tie, 1 or 2 otherwise
+    winning_team = match["winningTeam"] - 1
+    is_rated = match["queue"]["name"] not in UNRATED_QUEUES
+    try:
+        game_ratings = rate_game(
+            player_ids,
+            teams,
+            [rating[:2] for rating in before],
+            [rating[2:] for rating in before],
+            winning_team,
+            is_rated,
+            False,
+        )
+    except ValueError:
+        log.warning(f"[import_json_match_history] Could not rate match {match_index}")
+        return False
+
+    finished_game_id = imported_finished_game_id(match_index)
+    chunk.finished_games.append(
+        {
+            "id": finished_game_id,
+            "average_trueskill": 0.0,
+            "game_id": str(uuid4()),
+            "finished_at": datetime.fromtimestamp(match["completionTimestamp"] // 1000),
+            "is_rated": is_rated,
+            "map_full_name": "",
+            "map_short_name": "",
+            "queue_name": match["queue"]["name"],
+            "started_at": datetime.fromtimestamp(match["timestamp"] // 1000),
+            "win_probability": win_probability(
+                [Rating(*rating[:2]) for rating, team in zip(before, teams) if team == 0],
+                [Rating(*rating[:2]) for rating, team in zip(before, teams) if team == 1],
+            ),
+            "winning_team": winning_team,
+        }
+    )
+    for i, json_player in enumerate(match["players"]):
+        player_id = player_ids[i]
+        names[player_id] = json_player["user"]["name"]
+        ratings[player_id] = [
+            *map(float, game_ratings.rated_after[i]),
+            *map(float, game_ratings.unrated_after[i]),
+        ]
+        chunk.player_ids.add(player_id)
+        chunk.finished_game_players.append(
+            {
+                "id": str(uuid4()),
+                "finished_game_id": finished_game_id,
+                "player_id": player_id,
+                "player_name": names[player_id],
+                "team": teams[i],
+                "rated_trueskill_mu_before": before[i][0],
+                "rated_trueskill_sigma_before": before[i][1],
+                "rated_trueskill_mu_after": ratings[player_id][0],
+                "rated_trueskill_sigma_after": ratings[player_id][1],
+                "unrated_trueskill_mu_before": before[i][2],
+                "unrated_trueskill_sigma_before": before[i][3],
+                "unrated_trueskill_mu_after": ratings[player_id][2],
+                "unrated_trueskill_sigma_after": ratings[player_id][3],
+            }
+        )
+    return True
+
+
+def import_json_match_history(
+    file: BinaryIO,
+    resume: bool = False,
+    chunk_size: int = CHUNK_SIZE,
+    on_chunk: Callable[[ImportStats], None] | None = None,
+    connection: Connection | None = None,
+) -> ImportStats:
+    """
+    Import a JSON match history export. Unless resuming, every player,
+    finished game and everything recorded about them is deleted first.
+
+    :resume: Keep what's there and continue after the last imported match
+    :on_chunk: Called after every commit, e.g. to show progress
+    """
+    if connection is None:
+        with engine.connect() as connection:
+            return import_json_match_history(
+                file, resume, chunk_size, on_chunk, connection
+            )
+
+    start = default_timer()
+    names: dict[int, str] = {}
+    # Rated mu, sigma, unrated mu, sigma
+    ratings: dict[int, list[float]] = {}
+    start_index = 0
+    if resume:
+        last_index = _last_imported_match_index(connection)
+        start_index = last_index + 1 if last_index is not None else 0
+        for player_id, name, *player_ratings in connection.execute(
+            select(
+                Player.id,
+                Player.name,
+                Player.rated_trueskill_mu,
+                Player.rated_trueskill_sigma,
+                Player.unrated_trueskill_mu,
+                Player.unrated_trueskill_sigma,
+            )
+        ):
+            names[player_id] = name
+            ratings[player_id] = player_ratings
+        log.info(f"[import_json_match_history] Resuming from match {start_index}")
+    else:
+        with connection.begin():
+            connection.execute(delete(PlayerDailyStats))
+            connection.execute(delete(PlayerRegionTrueskill))
+            connection.execute(delete(FinishedGamePlayer))
+            connection.execute(delete(FinishedGame))
+            connection.execute(delete(Player))
+
+    stats = ImportStats()
+    chunk = _Chunk()
+    for match_index, match in enumerate(iter_json_array(file)):
+        if match_index < start_index:
+            continue
+        if not _add_match(chunk, match_index, match, names, ratings):
+            stats.skipped += 1
+        chunk.matches += 1
+        if chunk.matches >= chunk_size:
+            _write_chunk(connection, chunk, names, ratings)
+            stats.matches += chunk.matches
+            stats.game_players += len(chunk.finished_game_players)
+            stats.seconds = default_timer() - start
+            if on_chunk:
+                on_chunk(stats)
+            chunk = _Chunk()
+    if chunk.matches:
+        _write_chunk(connection, chunk, names, ratings)
+        stats.matches += chunk.matches
+        stats.game_players += len(chunk.finished_game_players)
+    stats.seconds = default_timer() - start
+    if on_chunk:
+        on_chunk(stats)
+    return stats
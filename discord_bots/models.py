@@ -1,15 +1,17 @@
 from __future__ import annotations
 
 from dataclasses import dataclass, field
-from datetime import datetime, timezone
+from datetime import date, datetime, timezone
 from uuid import uuid4
 
 import trueskill
 from sqlalchemy import (
     Boolean,
     Column,
+    Date,
     DateTime,
     Float,
+    Index,
     Integer,
     String,
     UniqueConstraint,
@@ -24,6 +26,7 @@ from sqlalchemy.sql import expression, func
 from sqlalchemy.sql.schema import ForeignKey, MetaData
 
 import discord_bots.config as config
+from discord_bots.sessions import ScopedSession, connection_leak_detector
 
 # It may be tempting, but do not set check_same_thread=False here. Sqlite
 # doesn't handle concurrency well and writing to the db on different threads
@@ -39,6 +42,7 @@ import discord_bots.config as config
 # psql
 db_url = 'postgresql://' + config.DB_USER_NAME + ':' + config.DB_PASSWORD + '@localhost/' + config.DB_NAME
 engine = create_engine(db_url, echo=False, pool_size=40, max_overflow=50)
+connection_leak_detector.attach(engine)
 
 naming_convention = {
     "ix": "ix_%(column_0_label)s",
@@ -135,6 +139,10 @@ class CustomCommand:
 class FinishedGame:
     __sa_dataclass_metadata_key__ = "sa"
     __tablename__ = "finished_game"
+    # For the last played lookup in leaderboard.LeaderboardService.load
+    __table_args__ = (
+        Index("ix_finished_game_started_at_finished_at", "started_at", "finished_at"),
+    )
 
     average_trueskill: float = field(metadata={"sa": Column(Float, nullable=False)})
     game_id: str = field(metadata={"sa": Column(String, index=True, nullable=False)})
@@ -180,6 +188,13 @@ class FinishedGame:
 class FinishedGamePlayer:
     __sa_dataclass_metadata_key__ = "sa"
     __tablename__ = "finished_game_player"
+    __table_args__ = (
+        Index(
+            "ix_finished_game_player_player_id_finished_game_id",
+            "player_id",
+            "finished_game_id",
+        ),
+    )
 
     finished_game_id: str = field(
         metadata={
@@ -431,6 +446,42 @@ class Player:
         return self.id < other.id
 
 
+# For rating percentiles in the stats command
+Index(
+    "ix_player_leaderboard_trueskill",
+    Player.__table__.c.rated_trueskill_mu - 3 * Player.__table__.c.rated_trueskill_sigma,
+)
+
+
+@mapper_registry.mapped
+@dataclass
+class PlayerDailyStats:
+    """
+    Wins, losses and ties per player per day (UTC), kept up to date by
+    finishgame and editgamewinner so that stats doesn't have to go through
+    every game a player has finished
+    """
+
+    __sa_dataclass_metadata_key__ = "sa"
+    __tablename__ = "player_daily_stats"
+    __table_args__ = (UniqueConstraint("player_id", "day"),)
+
+    player_id: int = field(
+        metadata={
+            "sa": Column(BigInteger, ForeignKey("player.id"), nullable=False, index=True)
+        },
+    )
+    day: date = field(metadata={"sa": Column(Date, nullable=False)})
+    wins: int = field(default=0, metadata={"sa": Column(Integer, nullable=False)})
+    losses: int = field(default=0, metadata={"sa": Column(Integer, nullable=False)})
+    ties: int = field(default=0, metadata={"sa": Column(Integer, nullable=False)})
+    id: str = field(
+        init=False,
+        default_factory=lambda: str(uuid4()),
+        metadata={"sa": Column(String, primary_key=True)},
+    )
+
+
 @mapper_registry.mapped
 @dataclass
 class PlayerRegionTrueskill:
@@ -440,6 +491,7 @@ class PlayerRegionTrueskill:
 
     __sa_dataclass_metadata_key__ = "sa"
     __tablename__ = "player_region_trueskill"
+    __table_args__ = (UniqueConstraint("player_id", "queue_region_id"),)
 
     player_id: int = field(
         metadata={
@@ -485,6 +537,8 @@ class Queue:
     :is_isolated: A queue that doesn't interact with the other queues. No
     auto-adds, no waitlists, doesn't affect map rotation, and doesn't affect
     trueskill. Useful for things like 1v1s, duels, etc.
+    :team_solver: How teams are balanced when the queue pops, see
+    teams.solve_team_split
     """
 
     __sa_dataclass_metadata_key__ = "sa"
@@ -519,6 +573,10 @@ class Queue:
             )
         },
     )
+    team_solver: str = field(
+        default="auto",
+        metadata={"sa": Column(String, nullable=False, server_default="auto")},
+    )
     created_at: datetime = field(
         default_factory=lambda: datetime.now(timezone.utc),
         init=False,
@@ -779,4 +837,4 @@ class Map:
     is_votable: bool = field(metadata={"sa": Column(Boolean, nullable=False)})
 
 
-Session: sessionmaker = sessionmaker(bind=engine)
+Session: sessionmaker = sessionmaker(bind=engine, class_=ScopedSession)
@@ -0,0 +1,94 @@
+# Who is an admin, who is banned and which roles make someone an admin, kept in
+# memory for the is_admin and is_not_banned checks so running a command
+# doesn't need any queries to authorize it.
+#
+# ban, unban, addadmin, removeadmin, addadminrole and removeadminrole update
+# the cache after committing. As a safety net, e.g. for changes made directly
+# in the database, everything is reloaded once it is older than
+# PERMISSION_CACHE_TTL_SECONDS.
+from timeit import default_timer
+
+from sqlalchemy.orm import Session as SQLAlchemySession
+
+import discord_bots.config as config
+from discord_bots.log import define_logger
+from discord_bots.models import AdminRole, Player, Session
+
+log = define_logger(__name__)
+
+
+class PermissionCache:
+    def __init__(self, ttl_seconds: float):
+        self.ttl_seconds = ttl_seconds
+        self._admin_player_ids: set[int] = set()
+        self._banned_player_ids: set[int] = set()
+        self._admin_role_ids: set[int] = set()
+        self._loaded_at: float | None = None
+
+    def load(self, session: SQLAlchemySession | None = None) -> None:
+        if session is None:
+            with Session() as session:
+                self.load(session)
+            return
+        self._admin_player_ids = {
+            player_id
+            for player_id, in session.query(Player.id).filter(Player.is_admin == True)
+        }
+        self._banned_player_ids = {
+            player_id
+            for player_id, in session.query(Player.id).filter(Player.is_banned == True)
+        }
+        self._admin_role_ids = {
+            role_id for role_id, in session.query(AdminRole.role_id)
+        }
+        self._loaded_at = default_timer()
+        log.debug(
+            f"[PermissionCache.load] {len(self._admin_player_ids)} admins, "
+            f"{len(self._banned_player_ids)} banned, {len(self._admin_role_ids)} admin roles"
+        )
+
+    def invalidate(self) -> None:
+        self._loaded_at = None
+
+    def _ensure_fresh(self) -> None:
+        if self._loaded_at is None or default_timer() - self._loaded_at > self.ttl_seconds:
+            self.load()
+
+    # Reads
+
+    def is_admin(self, player_id: int, role_ids: set[int] | None = None) -> bool:
+        """
+        :role_ids: Roles of the member, they're an admin if any of them is an
+        admin role
+        """
+        self._ensure_fresh()
+        if player_id in self._admin_player_ids:
+            return True
+        return bool(role_ids and not self._admin_role_ids.isdisjoint(role_ids))
+
+    def is_banned(self, player_id: int) -> bool:
+        self._ensure_fresh()
+        return player_id in self._banned_player_ids
+
+    # Writes, to be called once the change is committed
+
+    def set_admin(self, player_id: int, is_admin: bool) -> None:
+        if is_admin:
+            self._admin_player_ids.add(player_id)
+        else:
+            self._admin_player_ids.discard(player_id)
+
+    def set_banned(self, player_id: int, is_banned: bool) -> None:
+        if is_banned:
+            self._banned_player_ids.add(player_id)
+        else:
+            self._banned_player_ids.discard(player_id)
+
+    def add_admin_role(self, role_id: int) -> None:
+        self._admin_role_ids.add(role_id)
+
+    def remove_admin_role(self, role_id: int) -> None:
+        self._admin_role_ids.discard(role_id)
+
+
+permission_cache = PermissionCache(config.PERMISSION_CACHE_TTL_SECONDS)
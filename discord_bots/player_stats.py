@@ -0,0 +1,199 @@
+# Wins / losses / ties for the stats command, read from player_daily_stats
+# instead of every finished game the player has been in.
+#
+# finishgame adds each game to its players' counts for the day it finished,
+# editgamewinner moves it from the old outcome to the new one. Windows like
+# "last 7 days" are whole UTC days: today and the 6 days before it.
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from typing import Iterable
+from uuid import uuid4
+
+from sqlalchemy import and_, func
+from sqlalchemy.dialects.postgresql import Insert, insert
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session as SQLAlchemySession
+from trueskill import Rating
+
+import discord_bots.config as config
+from discord_bots.models import Player, PlayerDailyStats
+
+# Windows shown by the stats command, in days
+STATS_WINDOW_DAYS = (7, 30, 90, 365)
+DAILY_COUNTS_BATCH_SIZE = 10000
+
+
+@dataclass
+class WinLossTie:
+    wins: int = 0
+    losses: int = 0
+    ties: int = 0
+
+    @property
+    def total(self) -> int:
+        return self.wins + self.losses + self.ties
+
+    @property
+    def win_rate(self) -> float:
+        return round(100 * (self.wins + 0.5 * self.ties) / max(self.total, 1), 1)
+
+
+def _outcome(team: int, winning_team: int) -> tuple[int, int, int]:
+    if winning_team == -1:
+        return 0, 0, 1
+    if team == winning_team:
+        return 1, 0, 0
+    return 0, 1, 0
+
+
+def record_game_outcome(
+    session: SQLAlchemySession,
+    finished_at: datetime,
+    player_teams: list[tuple[int, int]],
+    winning_team: int,
+    old_winning_team: int | None = None,
+) -> None:
+    """
+    Count a finished game for its players with a single upsert
+
+    :player_teams: (player_id, team) for everyone in the game
+    :old_winning_team: When changing the outcome of a game that was already
+    counted, the outcome it was counted with
+    """
+    deltas: dict[int, list[int]] = defaultdict(lambda: [0, 0, 0])
+    for player_id, team in player_teams:
+        for i, count in enumerate(_outcome(team, winning_team)):
+            deltas[player_id][i] += count
+        if old_winning_team is not None:
+            for i, count in enumerate(_outcome(team, old_winning_team)):
+                deltas[player_id][i] -= count
+    deltas = {player_id: delta for player_id, delta in deltas.items() if any(delta)}
+    if not deltas:
+        return
+
+    session.execute(
+        _add_daily_counts_statement(
+            [
+                (player_id, finished_at.date(), wins, losses, ties)
+                for player_id, (wins, losses, ties) in deltas.items()
+            ]
+        )
+    )
+
+
+def _add_daily_counts_statement(counts: list[tuple[int, date, int, int, int]]) -> Insert:
+    statement = insert(PlayerDailyStats).values(
+        [
+            {
+                "id": str(uuid4()),
+                "player_id": player_id,
+                "day": day,
+                "wins": wins,
+                "losses": losses,
+                "ties": ties,
+            }
+            for player_id, day, wins, losses, ties in counts
+        ]
+    )
+    return statement.on_conflict_do_update(
+        index_elements=[PlayerDailyStats.player_id, PlayerDailyStats.day],
+        set_={
+            "wins": PlayerDailyStats.wins + statement.excluded.wins,
+            "losses": PlayerDailyStats.losses + statement.excluded.losses,
+            "ties": PlayerDailyStats.ties + statement.excluded.ties,
+        },
+    )
+
+
+def add_daily_counts(
+    connection: Connection, counts: Iterable[tuple[int, date, int, int, int]]
+) -> None:
+    """
+    Add (player_id, day, wins, losses, ties) to player_daily_stats in
+    batches, for bulk imports of finished games
+    """
+    batch = []
+    for count in counts:
+        batch.append(count)
+        if len(batch) >= DAILY_COUNTS_BATCH_SIZE:
+            connection.execute(_add_daily_counts_statement(batch))
+            batch = []
+    if batch:
+        connection.execute(_add_daily_counts_statement(batch))
+
+
+def count_game_outcomes(
+    game_players: Iterable[tuple[int, date, int, int]]
+) -> list[tuple[int, date, int, int, int]]:
+    """
+    :game_players: (player_id, day, team, winning_team) of finished games
+    :returns: (player_id, day, wins, losses, ties) for add_daily_counts
+    """
+    counts: dict[tuple[int, date], list[int]] = defaultdict(lambda: [0, 0, 0])
+    for player_id, day, team, winning_team in game_players:
+        for i, count in enumerate(_outcome(team, winning_team)):
+            counts[player_id, day][i] += count
+    return [(player_id, day, *count) for (player_id, day), count in counts.items()]
+
+
+def get_player_stats(
+    session: SQLAlchemySession, player_id: int, today: date
+) -> tuple[WinLossTie, dict[int, WinLossTie]]:
+    """
+    :returns: Lifetime counts, and counts for each of STATS_WINDOW_DAYS
+    """
+    columns = [
+        func.coalesce(func.sum(PlayerDailyStats.wins), 0),
+        func.coalesce(func.sum(PlayerDailyStats.losses), 0),
+        func.coalesce(func.sum(PlayerDailyStats.ties), 0),
+    ]
+    for days in STATS_WINDOW_DAYS:
+        in_window = PlayerDailyStats.day > today - timedelta(days=days)
+        columns.extend(
+            func.coalesce(func.sum(column).filter(in_window), 0)
+            for column in (
+                PlayerDailyStats.wins,
+                PlayerDailyStats.losses,
+                PlayerDailyStats.ties,
+            )
+        )
+    row = (
+        session.query(*columns).filter(PlayerDailyStats.player_id == player_id).one()
+    )
+    lifetime = WinLossTie(*row[:3])
+    windows = {
+        days: WinLossTie(*row[3 * (i + 1): 3 * (i + 2)])
+        for i, days in enumerate(STATS_WINDOW_DAYS)
+    }
+    return lifetime, windows
+
+
+def get_rating_percentile(session: SQLAlchemySession, player: Player) -> float | None:
+    """
+    Fraction of players with a higher leaderboard trueskill, using
+    ix_player_leaderboard_trueskill. Players still on the default rating
+    haven't played and aren't counted.
+
+    :returns: None if nobody has played yet
+    """
+    default_rating = Rating()
+    default_mu = config.DEFAULT_TRUESKILL_MU or default_rating.mu
+    has_played = and_(
+        Player.rated_trueskill_mu != default_rating.mu,
+        Player.rated_trueskill_mu != default_mu,
+    )
+    total = session.query(func.count(Player.id)).filter(has_played).scalar()
+    if total == 0:
+        return None
+    leaderboard_trueskill = Player.rated_trueskill_mu - 3 * Player.rated_trueskill_sigma
+    higher = (
+        session.query(func.count(Player.id))
+        .filter(
+            leaderboard_trueskill
+            > player.rated_trueskill_mu - 3 * player.rated_trueskill_sigma,
+            has_played,
+        )
+        .scalar()
+    )
+    return higher / total
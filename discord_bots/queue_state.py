@@ -0,0 +1,424 @@
+# In-memory copy of the game queues: who is in which queue, queue sizes, the
+# locked / isolated flags and role requirements. Adding to a queue, removing
+# from a queue, printing queue sizes and checking whether a queue should pop
+# are all done against this instead of re-querying queue_player every time.
+#
+# The database stays the source of truth. Every change is written through to
+# PostgreSQL in the same statement that used to make it and the cache is
+# updated alongside, and the whole thing is rebuilt from the database when the
+# bot starts (see main.on_ready). If a session that wrote through the cache
+# rolls back or is closed without committing, the cache is thrown away and
+# reloaded. Changes that don't go through a session (sync_queue, roles) are
+# made once the caller has committed.
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Callable
+from datetime import datetime
+from uuid import uuid4
+
+from sqlalchemy import delete, event, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session as SQLAlchemySession
+
+from discord_bots.log import define_logger
+from discord_bots.models import Player, Queue, QueuePlayer, QueueRole, Session
+
+log = define_logger(__name__)
+
+# Session.info key for the managers a session wrote through
+WRITERS_KEY = "queue_state_writers"
+
+
+@dataclass
+class QueueState:
+    """
+    :role_ids: Roles allowed to join the queue, empty means anyone can join
+    :player_ids: Players in the queue, in the order they were added. A dict is
+    used as an ordered set.
+    """
+
+    id: str
+    name: str
+    size: int
+    is_locked: bool
+    is_isolated: bool
+    created_at: datetime
+    role_ids: set[int] = field(default_factory=set)
+    player_ids: dict[int, None] = field(default_factory=dict)
+
+    @property
+    def is_full(self) -> bool:
+        return len(self.player_ids) >= self.size
+
+    def status_str(self) -> str:
+        return f"{self.name} [{len(self.player_ids)}/{self.size}]"
+
+
+@dataclass
+class QueueAddPlan:
+    """
+    :new_rows: (queue_id, player_id) rows to insert
+    :pops: (queue_id, player_ids) for every queue that fills up, in the order
+    they fill up. Queues that were already full come first.
+    :reached_sizes: Sizes each queue that didn't pop went through, for queue
+    notifications
+    :results: For each request, the ids of the queues the player was added to
+    and whether a queue popped as a result
+    """
+
+    new_rows: list[tuple[str, int]]
+    pops: list[tuple[str, list[int]]]
+    reached_sizes: dict[str, set[int]]
+    results: list[tuple[list[str], bool]]
+
+
+def plan_queue_adds(
+    queues: list[QueueState],
+    requests: list[tuple[int, list[str]]],
+    player_role_ids: Callable[[int], set[int] | None],
+    is_in_game: Callable[[int], bool],
+) -> QueueAddPlan:
+    """
+    Work out what adding players to queues does without writing anything.
+
+    Requests are (player_id, queue_ids) and are applied in order, each player's
+    queues in the order given. Locked queues, queues the player is already in
+    and queues the player doesn't have a role for are skipped. When a queue
+    fills up it pops, its players are taken out of every other queue and the
+    rest of that player's queues are skipped, same as adding one queue at a
+    time would. A queue that is already full, e.g. because its pop failed
+    after the players were committed, pops first with the players who were
+    in it longest.
+
+    :player_role_ids: Role ids of a player, None if they aren't in the server.
+    Called at most once per request.
+    :is_in_game: Called at most once per request
+    """
+    queue_by_id = {queue.id: queue for queue in queues}
+    members: dict[str, dict[int, None]] = {
+        queue.id: dict(queue.player_ids) for queue in queues
+    }
+    new_rows: dict[tuple[str, int], None] = {}
+    reached_sizes: dict[str, set[int]] = defaultdict(set)
+    pops: list[tuple[str, list[int]]] = []
+    popped_player_ids: set[int] = set()
+    results: list[tuple[list[str], bool]] = []
+
+    def pop(queue_id: str, pop_player_ids: list[int]) -> None:
+        pops.append((queue_id, pop_player_ids))
+        popped_player_ids.update(pop_player_ids)
+        for queue_members in members.values():
+            for pop_player_id in pop_player_ids:
+                queue_members.pop(pop_player_id, None)
+
+    for queue in queues:
+        if not queue.is_locked and len(members[queue.id]) >= queue.size:
+            pop(queue.id, list(members[queue.id])[: queue.size])
+
+    for player_id, queue_ids in requests:
+        added_to: list[str] = []
+        queue_popped = False
+        if player_id in popped_player_ids or is_in_game(player_id):
+            results.append((added_to, queue_popped))
+            continue
+
+        role_ids: set[int] | None = None
+        role_ids_fetched = False
+        for queue_id in queue_ids:
+            queue = queue_by_id.get(queue_id)
+            if not queue or queue.is_locked or player_id in members[queue_id]:
+                continue
+            # Zero queue roles means no role restrictions
+            if len(queue.role_ids) > 0:
+                if not role_ids_fetched:
+                    role_ids = player_role_ids(player_id)
+                    role_ids_fetched = True
+                if not role_ids or len(queue.role_ids.intersection(role_ids)) == 0:
+                    continue
+
+            members[queue_id][player_id] = None
+            new_rows[(queue_id, player_id)] = None
+            if len(members[queue_id]) >= queue.size:  # Pop!
+                pop(queue_id, list(members[queue_id]))
+                queue_popped = True
+                break
+            reached_sizes[queue_id].add(len(members[queue_id]))
+            added_to.append(queue_id)
+        results.append((added_to, queue_popped))
+
+    return QueueAddPlan(list(new_rows), pops, dict(reached_sizes), results)
+
+
+class QueueStateManager:
+    def __init__(self):
+        self._queues: dict[str, QueueState] = {}
+        self._queue_ids_by_player_id: dict[int, set[str]] = defaultdict(set)
+        self._is_loaded = False
+
+    def load(self, session: SQLAlchemySession | None = None) -> None:
+        """
+        Rebuild everything from the database, one query per table
+        """
+        if session is None:
+            with Session() as session:
+                self.load(session)
+            return
+
+        queues: dict[str, QueueState] = {}
+        queue: Queue
+        for queue in session.query(Queue).order_by(Queue.created_at.asc()):  # type: ignore
+            queues[queue.id] = self._queue_state_from_model(queue)
+        queue_role: QueueRole
+        for queue_role in session.query(QueueRole):
+            if queue_role.queue_id in queues:
+                queues[queue_role.queue_id].role_ids.add(queue_role.role_id)
+        queue_ids_by_player_id: dict[int, set[str]] = defaultdict(set)
+        queue_player: QueuePlayer
+        for queue_player in session.query(QueuePlayer):
+            if queue_player.queue_id in queues:
+                queues[queue_player.queue_id].player_ids[queue_player.player_id] = None
+                queue_ids_by_player_id[queue_player.player_id].add(
+                    queue_player.queue_id
+                )
+
+        self._queues = queues
+        self._queue_ids_by_player_id = queue_ids_by_player_id
+        self._is_loaded = True
+        log.info(
+            f"[QueueStateManager.load] {len(queues)} queues, "
+            f"{len(queue_ids_by_player_id)} players in queue"
+        )
+
+    def invalidate(self) -> None:
+        """
+        Throw away the cache, it gets rebuilt the next time it's used. For when
+        the database was changed behind the cache's back.
+        """
+        self._is_loaded = False
+
+    def _ensure_loaded(self) -> None:
+        if not self._is_loaded:
+            self.load()
+
+    def _written_through(self, session: SQLAlchemySession) -> None:
+        session.info.setdefault(WRITERS_KEY, set()).add(self)
+
+    @staticmethod
+    def _queue_state_from_model(queue: Queue) -> QueueState:
+        return QueueState(
+            id=queue.id,
+            name=queue.name,
+            size=queue.size,
+            is_locked=queue.is_locked,
+            is_isolated=queue.is_isolated,
+            created_at=queue.created_at,
+        )
+
+    # Reads
+
+    def get(self, queue_id: str) -> QueueState | None:
+        self._ensure_loaded()
+        return self._queues.get(queue_id)
+
+    def queues(self) -> list[QueueState]:
+        """
+        All queues, oldest first
+        """
+        self._ensure_loaded()
+        return sorted(self._queues.values(), key=lambda q: q.created_at)
+
+    def queue_ids_for_player(self, player_id: int) -> set[str]:
+        self._ensure_loaded()
+        return set(self._queue_ids_by_player_id.get(player_id, ()))
+
+    def is_in_queue(self, queue_id: str, player_id: int) -> bool:
+        self._ensure_loaded()
+        return queue_id in self._queue_ids_by_player_id.get(player_id, ())
+
+    def status_strs(self) -> list[str]:
+        """
+        "name [players/size]" for every queue, oldest first
+        """
+        return [queue.status_str() for queue in self.queues()]
+
+    # Writes. Each one writes through to the database using the caller's
+    # session, the caller is still responsible for committing.
+
+    def sync_queue(self, queue: Queue) -> None:
+        """
+        Pick up a new queue, or changes to an existing queue's name, size or
+        flags. Players and roles are kept.
+        """
+        self._ensure_loaded()
+        queue_state = self._queues.get(queue.id)
+        if queue_state is None:
+            self._queues[queue.id] = self._queue_state_from_model(queue)
+            return
+        queue_state.name = queue.name
+        queue_state.size = queue.size
+        queue_state.is_locked = queue.is_locked
+        queue_state.is_isolated = queue.is_isolated
+
+    def remove_queue(self, queue_id: str) -> None:
+        self._ensure_loaded()
+        queue_state = self._queues.pop(queue_id, None)
+        if queue_state:
+            for player_id in queue_state.player_ids:
+                self._discard_membership(queue_id, player_id)
+
+    def add_role(self, queue_id: str, role_id: int) -> None:
+        self._ensure_loaded()
+        if queue_id in self._queues:
+            self._queues[queue_id].role_ids.add(role_id)
+
+    def remove_role(self, queue_id: str, role_id: int) -> None:
+        self._ensure_loaded()
+        if queue_id in self._queues:
+            self._queues[queue_id].role_ids.discard(role_id)
+
+    def add_player(
+        self, session: SQLAlchemySession, queue_id: str, player_id: int
+    ) -> bool:
+        """
+        :returns: False if the player is already in the queue
+        """
+        self._ensure_loaded()
+        queue_state = self._queues.get(queue_id)
+        if queue_state is None or player_id in queue_state.player_ids:
+            return False
+        session.add(QueuePlayer(queue_id=queue_id, player_id=player_id))
+        self._written_through(session)
+        queue_state.player_ids[player_id] = None
+        self._queue_ids_by_player_id[player_id].add(queue_id)
+        return True
+
+    def add_players(
+        self, session: SQLAlchemySession, rows: list[tuple[str, int]]
+    ) -> bool:
+        """
+        Insert (queue_id, player_id) rows with a single statement. Rows for
+        players already in the queue are skipped.
+
+        :returns: False if some of the rows were already in the database, the
+        cache is out of date then and the caller should roll back and reload
+        """
+        self._ensure_loaded()
+        values = []
+        for queue_id, player_id in rows:
+            queue_state = self._queues.get(queue_id)
+            if queue_state is None or player_id in queue_state.player_ids:
+                continue
+            values.append(
+                {"id": str(uuid4()), "queue_id": queue_id, "player_id": player_id}
+            )
+            queue_state.player_ids[player_id] = None
+            self._queue_ids_by_player_id[player_id].add(queue_id)
+        if not values:
+            return True
+        self._written_through(session)
+        inserted = session.execute(
+            pg_insert(QueuePlayer)
+            .values(values)
+            .on_conflict_do_nothing(index_elements=["queue_id", "player_id"])
+            .returning(QueuePlayer.id)
+        ).all()
+        return len(inserted) == len(values)
+
+    def remove_players(
+        self,
+        session: SQLAlchemySession,
+        player_ids: list[int] | set[int],
+        queue_ids: list[str] | set[str] | None = None,
+    ) -> list[str]:
+        """
+        Remove players from the given queues (all queues by default) with a
+        single delete
+
+        :returns: Ids of the queues at least one of the players was removed
+        from, oldest queue first
+        """
+        self._ensure_loaded()
+        player_ids = set(player_ids)
+        removed_from: set[str] = set()
+        for player_id in player_ids:
+            in_queue_ids = self._queue_ids_by_player_id.get(player_id, set())
+            if queue_ids is not None:
+                in_queue_ids = in_queue_ids.intersection(queue_ids)
+            removed_from.update(in_queue_ids)
+        if not removed_from:
+            return []
+
+        query = session.query(QueuePlayer).filter(
+            QueuePlayer.player_id.in_(player_ids)  # type: ignore
+        )
+        if queue_ids is not None:
+            query = query.filter(QueuePlayer.queue_id.in_(removed_from))  # type: ignore
+        query.delete(synchronize_session=False)
+        self._written_through(session)
+
+        for queue_id in removed_from:
+            for player_id in player_ids:
+                self._queues[queue_id].player_ids.pop(player_id, None)
+                self._discard_membership(queue_id, player_id)
+        return [queue.id for queue in self.queues() if queue.id in removed_from]
+
+    def remove_inactive_players(
+        self, session: SQLAlchemySession, inactive_since: datetime
+    ) -> set[int]:
+        """
+        Remove everyone whose last activity is before inactive_since from all
+        queues with a single DELETE ... RETURNING
+
+        :returns: Ids of the players that were removed
+        """
+        self._ensure_loaded()
+        rows = session.execute(
+            delete(QueuePlayer)
+            .where(
+                QueuePlayer.player_id.in_(  # type: ignore
+                    select(Player.id).where(Player.last_activity_at < inactive_since)
+                )
+            )
+            .returning(QueuePlayer.queue_id, QueuePlayer.player_id)
+            .execution_options(synchronize_session=False)
+        ).all()
+        self._written_through(session)
+        for queue_id, player_id in rows:
+            if queue_id in self._queues:
+                self._queues[queue_id].player_ids.pop(player_id, None)
+            self._discard_membership(queue_id, player_id)
+        return {player_id for _, player_id in rows}
+
+    def clear_queue(self, session: SQLAlchemySession, queue_id: str) -> None:
+        self._ensure_loaded()
+        session.query(QueuePlayer).filter(QueuePlayer.queue_id == queue_id).delete()
+        self._written_through(session)
+        queue_state = self._queues.get(queue_id)
+        if queue_state:
+            for player_id in queue_state.player_ids:
+                self._discard_membership(queue_id, player_id)
+            queue_state.player_ids.clear()
+
+    def _discard_membership(self, queue_id: str, player_id: int) -> None:
+        queue_ids = self._queue_ids_by_player_id.get(player_id)
+        if queue_ids is not None:
+            queue_ids.discard(queue_id)
+            if not queue_ids:
+                del self._queue_ids_by_player_id[player_id]
+
+
+@event.listens_for(SQLAlchemySession, "after_commit")
+def _after_commit(session: SQLAlchemySession) -> None:
+    session.info.pop(WRITERS_KEY, None)
+
+
+@event.listens_for(SQLAlchemySession, "after_transaction_end")
+def _after_transaction_end(session: SQLAlchemySession, transaction) -> None:
+    # Still set if the transaction rolled back or the session was closed
+    # without committing, the cache has changes the database doesn't
+    if transaction.parent is None:
+        for queue_state_manager in session.info.pop(WRITERS_KEY, ()):
+            queue_state_manager.invalidate()
+
+
+queue_state = QueueStateManager()
@@ -1,9 +1,12 @@
 # Module for Python queues used to handle concurrency - not to be confused with
 # the game queues
-from dataclasses import dataclass
-from queue import SimpleQueue
+import asyncio
+from collections import deque
+from dataclasses import dataclass, field
+from statistics import quantiles
+from timeit import default_timer
 
-add_player_queue: SimpleQueue = SimpleQueue()
+import discord_bots.config as config
 
 
 @dataclass
@@ -12,9 +15,129 @@ class AddPlayerQueueMessage:
     :should_print_status: Controls whether to print the status after adding
     players to queue. We want to print when someone manually adds, but when
     someone is buffered into it (via waitlist)
+    :enqueued_at: Set by AddPlayerQueue.put, used to measure how long the add
+    took end to end
     """
 
     player_id: int
     player_name: str
     queue_ids: list[str]
     should_print_status: bool
+    enqueued_at: float = field(default=0.0, compare=False)
+
+
+# How many recent latencies AddPlayerQueueStats keeps around for percentiles
+LATENCY_SAMPLES = 1000
+
+
+@dataclass
+class AddPlayerQueueStats:
+    """
+    :blocked_puts: How many puts had to wait because the queue was full
+    :put_wait_seconds: Total time puts spent waiting for room in the queue
+    :max_depth: Most messages that were ever waiting at once
+    :add_latencies: Seconds from put until the add was processed, for the
+    most recent adds
+    :pop_latencies: Same as add_latencies, for the adds that popped a queue
+    """
+
+    puts: int = 0
+    blocked_puts: int = 0
+    put_wait_seconds: float = 0.0
+    max_depth: int = 0
+    processed: int = 0
+    batches: int = 0
+    add_latencies: deque = field(default_factory=lambda: deque(maxlen=LATENCY_SAMPLES))
+    pop_latencies: deque = field(default_factory=lambda: deque(maxlen=LATENCY_SAMPLES))
+
+    def summary(self) -> str:
+        def percentiles(latencies: deque) -> str:
+            if len(latencies) < 2:
+                return "n/a"
+            cuts = quantiles(latencies, n=100)
+            return f"p50 {round(1000 * cuts[49], 1)}ms, p99 {round(1000 * cuts[98], 1)}ms"
+
+        return (
+            f"{self.processed} adds in {self.batches} batches, "
+            f"add latency {percentiles(self.add_latencies)}, "
+            f"pop latency {percentiles(self.pop_latencies)}, "
+            f"max depth {self.max_depth}, {self.blocked_puts}/{self.puts} puts blocked "
+            f"for {round(self.put_wait_seconds, 3)}s"
+        )
+
+
+class AddPlayerQueue:
+    """
+    Bounded queue of players waiting to be added to game queues.
+
+    There must only be one consumer (tasks.add_player_worker) so that adds and
+    pops happen strictly in the order players were put. The consumer wakes up
+    as soon as something is put instead of polling. When the queue is full
+    put() waits for room, which is recorded in stats.
+    """
+
+    def __init__(self, maxsize: int):
+        self._queue: asyncio.Queue[AddPlayerQueueMessage] = asyncio.Queue(maxsize)
+        self.is_closed = False
+        self.stats = AddPlayerQueueStats()
+
+    async def put(self, message: AddPlayerQueueMessage) -> bool:
+        """
+        :returns: False if the queue was closed for shutdown and the message
+        was dropped
+        """
+        if self.is_closed:
+            return False
+        message.enqueued_at = default_timer()
+        self.stats.puts += 1
+        if self._queue.full():
+            self.stats.blocked_puts += 1
+            await self._queue.put(message)
+            self.stats.put_wait_seconds += default_timer() - message.enqueued_at
+        else:
+            self._queue.put_nowait(message)
+        self.stats.max_depth = max(self.stats.max_depth, self._queue.qsize())
+        return True
+
+    async def get_batch(self) -> list[AddPlayerQueueMessage]:
+        """
+        Wait for at least one message, then take everything else that's
+        already waiting so it can be processed in one go
+        """
+        messages = [await self._queue.get()]
+        messages.extend(self.get_nowait_batch())
+        return messages
+
+    def get_nowait_batch(self) -> list[AddPlayerQueueMessage]:
+        messages: list[AddPlayerQueueMessage] = []
+        while not self._queue.empty():
+            messages.append(self._queue.get_nowait())
+        return messages
+
+    def task_done(self, messages: list[AddPlayerQueueMessage], popped: list[bool]) -> None:
+        """
+        Record that messages were processed, and whether each one popped a
+        queue
+        """
+        now = default_timer()
+        for message, queue_popped in zip(messages, popped):
+            latency = now - message.enqueued_at
+            self.stats.add_latencies.append(latency)
+            if queue_popped:
+                self.stats.pop_latencies.append(latency)
+            self._queue.task_done()
+        self.stats.processed += len(messages)
+        self.stats.batches += 1
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    def close(self) -> None:
+        """
+        Stop accepting new messages, anything already queued still gets
+        processed
+        """
+        self.is_closed = True
+
+
+add_player_queue = AddPlayerQueue(config.ADD_PLAYER_QUEUE_MAX_SIZE)
@@ -0,0 +1,414 @@
+# Rebuild everyone's ratings by replaying finished games in the order they
+# finished, either the whole history or from one game onward after its outcome
+# was edited.
+#
+# Games are streamed from the database with a server-side cursor and every
+# rating is kept in numpy arrays, one row per player for the global ratings and
+# one array per queue region, so nothing is queried per game or per player.
+# The new before/after columns of finished_game_player and the current player
+# and player_region_trueskill ratings are written back in batches, all in one
+# transaction.
+#
+# Ratings follow the same rules as finishgame (see game_ratings.rate_game):
+# games in a region use the player's rating in that region, falling back to
+# their global rating, and only update the region rating. Whether a game was
+# isolated isn't stored, so a game whose unrated ratings didn't change when it
+# was played is assumed to have been isolated and doesn't change anything when
+# replayed either. A player's first game starts from the ratings stored on it,
+# so starting ratings set outside of games are kept.
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from itertools import groupby
+from timeit import default_timer
+from typing import Iterable, Iterator
+from uuid import uuid4
+
+import numpy
+from sqlalchemy import (
+    BigInteger,
+    Float,
+    String,
+    column,
+    func,
+    select,
+    tuple_,
+    update,
+    values,
+)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.engine import Connection
+
+from discord_bots.game_ratings import rate_game
+from discord_bots.log import define_logger
+from discord_bots.models import (
+    FinishedGame,
+    FinishedGamePlayer,
+    Player,
+    PlayerRegionTrueskill,
+    QueueRegion,
+    engine,
+)
+
+log = define_logger(__name__)
+
+BATCH_SIZE = 10000
+# Advisory lock held exclusively by a replay and shared by finishgame
+RATINGS_LOCK_KEY = 0x726174696E6773
+
+# Columns of the rating arrays
+RATED_MU, RATED_SIGMA, UNRATED_MU, UNRATED_SIGMA = range(4)
+
+
+@dataclass
+class ReplayStats:
+    games: int = 0
+    game_players: int = 0
+    seconds: float = 0.0
+
+    @property
+    def games_per_second(self) -> float:
+        return self.games / self.seconds if self.seconds else 0.0
+
+
+class RatingReplay:
+    """
+    Everyone's current ratings while replaying games. Ratings are
+    (rated mu, rated sigma, unrated mu, unrated sigma) rows, NaN until the
+    player has one.
+    """
+
+    def __init__(self, player_ids: Iterable[int], queue_region_ids: Iterable[str]):
+        self._index: dict[int, int] = {
+            player_id: i for i, player_id in enumerate(player_ids)
+        }
+        self._player_ids = numpy.array(list(self._index), dtype=numpy.int64)
+        self._global = self._empty()
+        self._regions: dict[str, numpy.ndarray] = {
+            queue_region_id: self._empty() for queue_region_id in queue_region_ids
+        }
+        # Ratings changed by replayed games, the ones that need writing back
+        self._global_replayed = numpy.zeros(len(self._index), dtype=bool)
+        self._regions_replayed: dict[str, numpy.ndarray] = {
+            queue_region_id: numpy.zeros(len(self._index), dtype=bool)
+            for queue_region_id in self._regions
+        }
+
+    def _empty(self) -> numpy.ndarray:
+        return numpy.full((len(self._index), 4), numpy.nan)
+
+    def seed(
+        self,
+        player_id: int,
+        queue_region_id: str | None,
+        ratings: tuple[float, float, float, float],
+    ) -> None:
+        """
+        Set a player's rating from before the first replayed game
+        """
+        table = self._regions[queue_region_id] if queue_region_id else self._global
+        table[self._index[player_id]] = ratings
+
+    def replay_game(
+        self,
+        player_ids: list[int],
+        teams: list[int],
+        stored_before: numpy.ndarray,
+        winning_team: int,
+        is_rated: bool,
+        changes_ratings: bool = True,
+        queue_region_id: str | None = None,
+    ) -> tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        :stored_before: The ratings currently stored on the game, used for
+        players without a rating yet
+        :changes_ratings: False for isolated games
+        :returns: The new before and after ratings of each player
+        """
+        rows = numpy.array([self._index[player_id] for player_id in player_ids])
+        region = self._regions.get(queue_region_id) if queue_region_id else None
+        before = (region if region is not None else self._global)[rows]
+        if region is not None:
+            missing = numpy.isnan(before[:, RATED_MU])
+            before[missing] = self._global[rows[missing]]
+        missing = numpy.isnan(before[:, RATED_MU])
+        before[missing] = stored_before[missing]
+
+        is_isolated = not changes_ratings or len(set(teams)) < 2
+        game_ratings = rate_game(
+            player_ids,
+            teams,
+            before[:, [RATED_MU, RATED_SIGMA]],
+            before[:, [UNRATED_MU, UNRATED_SIGMA]],
+            winning_team,
+            is_rated,
+            is_isolated,
+        )
+        after = numpy.hstack([game_ratings.rated_after, game_ratings.unrated_after])
+
+        if region is not None:
+            region[rows] = after
+            self._regions_replayed[queue_region_id][rows] = True
+        else:
+            self._global[rows] = after
+            self._global_replayed[rows] = True
+        return before, after
+
+    def replayed_ratings(
+        self, queue_region_id: str | None = None
+    ) -> Iterator[tuple[int, float, float, float, float]]:
+        """
+        (player_id, rated mu, rated sigma, unrated mu, unrated sigma) for every
+        rating changed by a replayed game
+        """
+        if queue_region_id:
+            table, replayed = self._regions[queue_region_id], self._regions_replayed[queue_region_id]
+        else:
+            table, replayed = self._global, self._global_replayed
+        for player_id, ratings in zip(self._player_ids[replayed], table[replayed]):
+            yield (int(player_id), *map(float, ratings))
+
+    @property
+    def queue_region_ids(self) -> list[str]:
+        return list(self._regions)
+
+
+GAME_PLAYERS = (
+    select(
+        FinishedGamePlayer.finished_game_id,
+        FinishedGame.winning_team,
+        FinishedGame.is_rated,
+        FinishedGame.queue_region_name,
+        FinishedGamePlayer.id,
+        FinishedGamePlayer.player_id,
+        FinishedGamePlayer.team,
+        FinishedGamePlayer.rated_trueskill_mu_before,
+        FinishedGamePlayer.rated_trueskill_sigma_before,
+        FinishedGamePlayer.unrated_trueskill_mu_before,
+        FinishedGamePlayer.unrated_trueskill_sigma_before,
+        FinishedGamePlayer.unrated_trueskill_mu_after,
+        FinishedGamePlayer.unrated_trueskill_sigma_after,
+    )
+    .join(FinishedGame, FinishedGame.id == FinishedGamePlayer.finished_game_id)
+    .order_by(FinishedGame.finished_at, FinishedGame.id, FinishedGamePlayer.id)
+)
+
+# Each player's ratings after their last game before the first replayed one,
+# globally and in each region
+LAST_RATINGS = (
+    select(
+        FinishedGamePlayer.player_id,
+        FinishedGame.queue_region_name,
+        FinishedGamePlayer.rated_trueskill_mu_after,
+        FinishedGamePlayer.rated_trueskill_sigma_after,
+        FinishedGamePlayer.unrated_trueskill_mu_after,
+        FinishedGamePlayer.unrated_trueskill_sigma_after,
+        FinishedGame.finished_at,
+    )
+    .join(FinishedGame, FinishedGame.id == FinishedGamePlayer.finished_game_id)
+    .distinct(FinishedGamePlayer.player_id, FinishedGame.queue_region_name)
+    .order_by(
+        FinishedGamePlayer.player_id,
+        FinishedGame.queue_region_name,
+        FinishedGame.finished_at.desc(),
+        FinishedGame.id.desc(),
+    )
+)
+
+
+def _write_game_players(connection: Connection, rows: list[tuple]) -> None:
+    new_ratings = values(
+        column("id", String),
+        column("rated_trueskill_mu_before", Float),
+        column("rated_trueskill_sigma_before", Float),
+        column("unrated_trueskill_mu_before", Float),
+        column("unrated_trueskill_sigma_before", Float),
+        column("rated_trueskill_mu_after", Float),
+        column("rated_trueskill_sigma_after", Float),
+        column("unrated_trueskill_mu_after", Float),
+        column("unrated_trueskill_sigma_after", Float),
+        name="new_ratings",
+    ).data(rows)
+    connection.execute(
+        update(FinishedGamePlayer)
+        .where(FinishedGamePlayer.id == new_ratings.c.id)
+        .values(
+            {
+                name: new_ratings.c[name]
+                for name in new_ratings.c.keys()
+                if name != "id"
+            }
+        )
+    )
+
+
+def _write_players(connection: Connection, rows: list[tuple]) -> None:
+    new_ratings = values(
+        column("id", BigInteger),
+        column("rated_trueskill_mu", Float),
+        column("rated_trueskill_sigma", Float),
+        column("unrated_trueskill_mu", Float),
+        column("unrated_trueskill_sigma", Float),
+        name="new_ratings",
+    ).data(rows)
+    connection.execute(
+        update(Player)
+        .where(Player.id == new_ratings.c.id)
+        .values(
+            rated_trueskill_mu=new_ratings.c.rated_trueskill_mu,
+            rated_trueskill_sigma=new_ratings.c.rated_trueskill_sigma,
+            unrated_trueskill_mu=new_ratings.c.unrated_trueskill_mu,
+            unrated_trueskill_sigma=new_ratings.c.unrated_trueskill_sigma,
+        )
+    )
+
+
+def _write_region_ratings(
+    connection: Connection, queue_region_id: str, rows: list[tuple]
+) -> None:
+    created_at = datetime.now(timezone.utc)
+    stmt = pg_insert(PlayerRegionTrueskill).values(
+        [
+            {
+                "id": str(uuid4()),
+                "player_id": player_id,
+                "queue_region_id": queue_region_id,
+                "rated_trueskill_mu": rated_mu,
+                "rated_trueskill_sigma": rated_sigma,
+                "unrated_trueskill_mu": unrated_mu,
+                "unrated_trueskill_sigma": unrated_sigma,
+                "created_at": created_at,
+            }
+            for player_id, rated_mu, rated_sigma, unrated_mu, unrated_sigma in rows
+        ]
+    )
+    connection.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[
+                PlayerRegionTrueskill.player_id,
+                PlayerRegionTrueskill.queue_region_id,
+            ],
+            set_={
+                "rated_trueskill_mu": stmt.excluded.rated_trueskill_mu,
+                "rated_trueskill_sigma": stmt.excluded.rated_trueskill_sigma,
+                "unrated_trueskill_mu": stmt.excluded.unrated_trueskill_mu,
+                "unrated_trueskill_sigma": stmt.excluded.unrated_trueskill_sigma,
+            },
+        )
+    )
+
+
+def _batches(rows: Iterable[tuple]) -> Iterator[list[tuple]]:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def recompute_ratings(
+    from_finished_game_id: str | None = None, connection: Connection | None = None
+) -> ReplayStats:
+    """
+    Replay finished games and write back everyone's ratings
+
+    :from_finished_game_id: Replay this game and every game that finished
+    after it, starting from everyone's ratings after the games before it.
+    Everything is replayed if not passed in.
+    """
+    if connection is None:
+        with engine.begin() as connection:
+            return recompute_ratings(from_finished_game_id, connection)
+
+    start = default_timer()
+    # Games finished while replaying would be rated from ratings that are
+    # about to be overwritten. finishgame holds this lock shared while it
+    # rates a game, so this waits for games being finished and then keeps
+    # finishgame out until the replay commits.
+    connection.execute(select(func.pg_advisory_xact_lock(RATINGS_LOCK_KEY)))
+
+    queue_region_ids_by_name: dict[str, str] = {
+        name: queue_region_id
+        for queue_region_id, name in connection.execute(
+            select(QueueRegion.id, QueueRegion.name)
+        )
+    }
+    replay = RatingReplay(
+        connection.execute(select(Player.id)).scalars(),
+        queue_region_ids_by_name.values(),
+    )
+
+    game_players = GAME_PLAYERS
+    if from_finished_game_id:
+        finished_at = connection.execute(
+            select(FinishedGame.finished_at).where(
+                FinishedGame.id == from_finished_game_id
+            )
+        ).scalar_one()
+        after_start = tuple_(FinishedGame.finished_at, FinishedGame.id) >= tuple_(
+            finished_at, from_finished_game_id
+        )
+        game_players = game_players.where(after_start)
+        # Games in regions that no longer exist are replayed as global games,
+        # so seed in the order games finished to let the later one win
+        for row in sorted(
+            connection.execute(LAST_RATINGS.where(~after_start)),
+            key=lambda row: row.finished_at,
+        ):
+            replay.seed(
+                row.player_id,
+                queue_region_ids_by_name.get(row.queue_region_name),
+                (
+                    row.rated_trueskill_mu_after,
+                    row.rated_trueskill_sigma_after,
+                    row.unrated_trueskill_mu_after,
+                    row.unrated_trueskill_sigma_after,
+                ),
+            )
+
+    stats = ReplayStats()
+    pending_game_players: list[tuple] = []
+    result = connection.execution_options(
+        stream_results=True, max_row_buffer=BATCH_SIZE
+    ).execute(game_players)
+    for _, rows in groupby(result, key=lambda row: row.finished_game_id):
+        rows = list(rows)
+        first = rows[0]
+        stored = numpy.array([row[7:13] for row in rows], dtype=numpy.float64)
+        changes_ratings = not numpy.array_equal(stored[:, 2:4], stored[:, 4:6])
+        before, after = replay.replay_game(
+            [row.player_id for row in rows],
+            [row.team for row in rows],
+            stored[:, 0:4],
+            first.winning_team,
+            first.is_rated,
+            changes_ratings,
+            queue_region_ids_by_name.get(first.queue_region_name),
+        )
+        for row, row_before, row_after in zip(rows, before.tolist(), after.tolist()):
+            pending_game_players.append((row.id, *row_before, *row_after))
+        if len(pending_game_players) >= BATCH_SIZE:
+            _write_game_players(connection, pending_game_players)
+            pending_game_players = []
+
+        stats.games += 1
+        stats.game_players += len(rows)
+        if stats.games % BATCH_SIZE == 0:
+            log.info(f"[recompute_ratings] Replayed {stats.games} games")
+    if pending_game_players:
+        _write_game_players(connection, pending_game_players)
+
+    for batch in _batches(replay.replayed_ratings()):
+        _write_players(connection, batch)
+    for queue_region_id in replay.queue_region_ids:
+        for batch in _batches(replay.replayed_ratings(queue_region_id)):
+            _write_region_ratings(connection, queue_region_id, batch)
+
+    stats.seconds = default_timer() - start
+    log.info(
+        f"[recompute_ratings] Replayed {stats.games} games in {stats.seconds:.1f}s "
+        f"({stats.games_per_second:.0f} games/s)"
+    )
+    return stats
@@ -0,0 +1,315 @@
+# What-if rating simulations: replay the whole match history under different
+# trueskill settings and measure how well each one predicts the games that
+# followed, to tune DEFAULT_TRUESKILL_MU / SIGMA, beta and tau with data
+# instead of by feel.
+#
+# The history is decoded once into flat numpy arrays (see MatchLog) and saved
+# as .npy files that every worker memory-maps, so each parameter set runs on
+# its own process without copying or re-querying the match log. Like
+# rating_replay, only rated games that changed ratings when they were played
+# are replayed, and games in a region use the player's rating in that region,
+# falling back to their global rating.
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from itertools import groupby
+from tempfile import TemporaryDirectory
+
+import numpy
+import trueskill
+from sqlalchemy import select
+from sqlalchemy.engine import Connection
+
+from discord_bots.models import FinishedGame, FinishedGamePlayer, QueueRegion, engine
+
+CALIBRATION_BINS = 10
+# Keeps log loss finite for predictions of exactly 0 or 1
+EPSILON = 1e-12
+
+
+@dataclass
+class MatchLog:
+    """
+    Every replayable game, oldest first. The players of game i are rows
+    game_offsets[i] to game_offsets[i + 1] of player_indexes and teams.
+
+    :player_indexes: Dense player index, 0 to player_count - 1
+    :outcomes: 1 if team 0 won, 0 if team 1 won and 0.5 for a tie
+    :region_indexes: Index of the game's queue region, -1 without a region
+    :win_probabilities: The win_probability stored when the game was played
+    """
+
+    game_offsets: numpy.ndarray
+    player_indexes: numpy.ndarray
+    teams: numpy.ndarray
+    outcomes: numpy.ndarray
+    region_indexes: numpy.ndarray
+    win_probabilities: numpy.ndarray
+    player_count: int
+    region_count: int
+
+    ARRAYS = (
+        "game_offsets",
+        "player_indexes",
+        "teams",
+        "outcomes",
+        "region_indexes",
+        "win_probabilities",
+    )
+
+    @property
+    def game_count(self) -> int:
+        return len(self.outcomes)
+
+    def save(self, directory: str) -> None:
+        for name in self.ARRAYS:
+            numpy.save(os.path.join(directory, f"{name}.npy"), getattr(self, name))
+        numpy.save(
+            os.path.join(directory, "counts.npy"),
+            numpy.array([self.player_count, self.region_count]),
+        )
+
+    @classmethod
+    def open(cls, directory: str) -> "MatchLog":
+        """
+        Memory-map a match log written by save
+        """
+        player_count, region_count = numpy.load(os.path.join(directory, "counts.npy"))
+        return cls(
+            **{
+                name: numpy.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+                for name in cls.ARRAYS
+            },
+            player_count=int(player_count),
+            region_count=int(region_count),
+        )
+
+
+MATCH_LOG = (
+    select(
+        FinishedGamePlayer.finished_game_id,
+        FinishedGame.winning_team,
+        FinishedGame.queue_region_name,
+        FinishedGame.win_probability,
+        FinishedGamePlayer.player_id,
+        FinishedGamePlayer.team,
+        FinishedGamePlayer.unrated_trueskill_mu_before,
+        FinishedGamePlayer.unrated_trueskill_mu_after,
+    )
+    .join(FinishedGame, FinishedGame.id == FinishedGamePlayer.finished_game_id)
+    .where(FinishedGame.is_rated)
+    .order_by(FinishedGame.finished_at, FinishedGame.id, FinishedGamePlayer.id)
+)
+
+
+def load_match_log(connection: Connection | None = None) -> MatchLog:
+    """
+    Decode the rated match history into a MatchLog, streaming it with a
+    server-side cursor
+    """
+    if connection is None:
+        with engine.connect() as connection:
+            return load_match_log(connection)
+
+    region_indexes_by_name: dict[str, int] = {
+        name: i
+        for i, (name,) in enumerate(
+            connection.execute(select(QueueRegion.name).order_by(QueueRegion.name))
+        )
+    }
+    player_index_by_id: dict[int, int] = {}
+    game_offsets = [0]
+    player_indexes: list[int] = []
+    teams: list[int] = []
+    outcomes: list[float] = []
+    region_indexes: list[int] = []
+    win_probabilities: list[float] = []
+    result = connection.execution_options(stream_results=True).execute(MATCH_LOG)
+    for _, rows in groupby(result, key=lambda row: row.finished_game_id):
+        rows = list(rows)
+        first = rows[0]
+        # Same as rating_replay, isolated games and games with everyone on
+        # one team didn't change anyone's rating
+        if len({row.team for row in rows}) < 2 or all(
+            row.unrated_trueskill_mu_before == row.unrated_trueskill_mu_after
+            for row in rows
+        ):
+            continue
+        for row in rows:
+            if row.player_id not in player_index_by_id:
+                player_index_by_id[row.player_id] = len(player_index_by_id)
+            player_indexes.append(player_index_by_id[row.player_id])
+            teams.append(row.team)
+        game_offsets.append(len(player_indexes))
+        outcomes.append({0: 1.0, 1: 0.0}.get(first.winning_team, 0.5))
+        region_indexes.append(region_indexes_by_name.get(first.queue_region_name, -1))
+        win_probabilities.append(first.win_probability)
+
+    return MatchLog(
+        game_offsets=numpy.array(game_offsets, dtype=numpy.int64),
+        player_indexes=numpy.array(player_indexes, dtype=numpy.int32),
+        teams=numpy.array(teams, dtype=numpy.int8),
+        outcomes=numpy.array(outcomes, dtype=numpy.float64),
+        region_indexes=numpy.array(region_indexes, dtype=numpy.int16),
+        win_probabilities=numpy.array(win_probabilities, dtype=numpy.float64),
+        player_count=len(player_index_by_id),
+        region_count=len(region_indexes_by_name),
+    )
+
+
+@dataclass(frozen=True)
+class TrueskillParameters:
+    mu: float = 25.0
+    sigma: float = 25.0 / 3
+    beta: float = 25.0 / 6
+    tau: float = 25.0 / 300
+    draw_probability: float = 0.1
+
+    def __str__(self) -> str:
+        return (
+            f"mu={self.mu:g} sigma={self.sigma:g} beta={self.beta:g} "
+            f"tau={self.tau:g} draw_probability={self.draw_probability:g}"
+        )
+
+
+@dataclass
+class CalibrationBin:
+    """
+    Games whose predicted probability fell in [low, high)
+    """
+
+    low: float
+    high: float
+    games: int
+    mean_prediction: float
+    mean_outcome: float
+
+
+@dataclass
+class PredictionMetrics:
+    """
+    How well predicted team 0 win probabilities matched the outcomes. Ties
+    count as half a win.
+
+    :expected_calibration_error: Mean distance between prediction and
+    outcome per calibration bin, weighted by games
+    """
+
+    games: int
+    log_loss: float
+    brier_score: float
+    expected_calibration_error: float
+    calibration: list[CalibrationBin] = field(default_factory=list)
+
+
+def prediction_metrics(
+    predictions: numpy.ndarray, outcomes: numpy.ndarray, bins: int = CALIBRATION_BINS
+) -> PredictionMetrics:
+    games = len(predictions)
+    if games == 0:
+        return PredictionMetrics(0, math.nan, math.nan, math.nan)
+    clipped = numpy.clip(predictions, EPSILON, 1 - EPSILON)
+    log_loss = -numpy.mean(
+        outcomes * numpy.log(clipped) + (1 - outcomes) * numpy.log(1 - clipped)
+    )
+    brier_score = numpy.mean((predictions - outcomes) ** 2)
+
+    calibration = []
+    expected_calibration_error = 0.0
+    bin_indexes = numpy.minimum((predictions * bins).astype(int), bins - 1)
+    for i in range(bins):
+        in_bin = bin_indexes == i
+        bin_games = int(in_bin.sum())
+        if bin_games == 0:
+            continue
+        mean_prediction = float(predictions[in_bin].mean())
+        mean_outcome = float(outcomes[in_bin].mean())
+        calibration.append(
+            CalibrationBin(i / bins, (i + 1) / bins, bin_games, mean_prediction, mean_outcome)
+        )
+        expected_calibration_error += bin_games / games * abs(mean_prediction - mean_outcome)
+    return PredictionMetrics(
+        games, float(log_loss), float(brier_score), expected_calibration_error, calibration
+    )
+
+
+def simulate(match_log: MatchLog, parameters: TrueskillParameters) -> PredictionMetrics:
+    """
+    Replay the match log with the given trueskill settings, predicting each
+    game from the ratings before it
+    """
+    env = trueskill.TrueSkill(
+        mu=parameters.mu,
+        sigma=parameters.sigma,
+        beta=parameters.beta,
+        tau=parameters.tau,
+        draw_probability=parameters.draw_probability,
+    )
+    beta_squared = parameters.beta**2
+    # (mu, sigma) per player, NaN until they've played
+    global_ratings = numpy.full((match_log.player_count, 2), numpy.nan)
+    region_ratings = numpy.full(
+        (match_log.region_count, match_log.player_count, 2), numpy.nan
+    )
+    predictions = numpy.empty(match_log.game_count)
+    game_offsets = numpy.asarray(match_log.game_offsets)
+    for game in range(match_log.game_count):
+        start, end = game_offsets[game], game_offsets[game + 1]
+        players = numpy.asarray(match_log.player_indexes[start:end])
+        teams = numpy.asarray(match_log.teams[start:end])
+        region = int(match_log.region_indexes[game])
+
+        table = region_ratings[region] if region >= 0 else global_ratings
+        before = table[players]
+        if region >= 0:
+            missing = numpy.isnan(before[:, 0])
+            before[missing] = global_ratings[players[missing]]
+        missing = numpy.isnan(before[:, 0])
+        before[missing] = (parameters.mu, parameters.sigma)
+
+        team0 = teams == 0
+        delta_mu = before[team0, 0].sum() - before[~team0, 0].sum()
+        denom = math.sqrt(len(players) * beta_squared + (before[:, 1] ** 2).sum())
+        predictions[game] = 0.5 * (1 + math.erf(delta_mu / denom / math.sqrt(2)))
+
+        outcome = match_log.outcomes[game]
+        ranks = [0, 1] if outcome == 1 else [1, 0] if outcome == 0 else [0, 0]
+        team0_after, team1_after = env.rate(
+            [
+                [env.create_rating(mu, sigma) for mu, sigma in before[team0]],
+                [env.create_rating(mu, sigma) for mu, sigma in before[~team0]],
+            ],
+            ranks,
+        )
+        table[players[team0]] = [(rating.mu, rating.sigma) for rating in team0_after]
+        table[players[~team0]] = [(rating.mu, rating.sigma) for rating in team1_after]
+
+    return prediction_metrics(predictions, numpy.asarray(match_log.outcomes))
+
+
+def _simulate_saved(directory: str, parameters: TrueskillParameters) -> PredictionMetrics:
+    return simulate(MatchLog.open(directory), parameters)
+
+
+def run_simulations(
+    match_log: MatchLog,
+    parameter_sets: list[TrueskillParameters],
+    workers: int | None = None,
+) -> list[PredictionMetrics]:
+    """
+    Simulate every parameter set on a process pool
+
+    :returns: Metrics in the same order as parameter_sets
+    """
+    with TemporaryDirectory(prefix="rating-simulation-") as directory:
+        match_log.save(directory)
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        ) as pool:
+            return list(
+                pool.map(
+                    _simulate_saved, [directory] * len(parameter_sets), parameter_sets
+                )
+            )
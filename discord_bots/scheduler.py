@@ -0,0 +1,113 @@
+# Runs the waitlist processing exactly when a waitlist expires, instead of
+# polling the database every second to see whether one has. If processing
+# fails, the keys that were due are scheduled again with a backoff, so a
+# transient database or Discord error doesn't leave a waitlist behind until
+# the bot restarts.
+import asyncio
+import heapq
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable
+
+from discord_bots.log import define_logger
+
+log = define_logger(__name__)
+
+# Seconds until keys are retried after a failed call, doubled after every
+# failure in a row
+MIN_RETRY_DELAY = 5
+MAX_RETRY_DELAY = 300
+
+
+class DeadlineScheduler:
+    """
+    Keeps pending deadlines in a heap and calls a coroutine once the earliest
+    one has passed. Deadlines that are due together are handled by a single
+    call, the coroutine is expected to process everything that is due and to
+    raise if it couldn't.
+
+    Deadlines can be scheduled before start(), e.g. while loading them at
+    startup.
+    """
+
+    def __init__(self, name: str, min_retry_delay: float = MIN_RETRY_DELAY):
+        self.name = name
+        self.min_retry_delay = min_retry_delay
+        self._retry_delay = min_retry_delay
+        self._deadlines: list[tuple[datetime, str]] = []
+        self._keys: set[str] = set()
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+        self._callback: Callable[[], Awaitable[None]] | None = None
+
+    def schedule(self, key: str, deadline: datetime) -> None:
+        """
+        :key: Id of the thing expiring, a key is only scheduled once
+        :deadline: Naive datetimes are assumed to be UTC, like the ones that
+        come back from the database
+        """
+        if key in self._keys:
+            return
+        if deadline.tzinfo is None:
+            deadline = deadline.replace(tzinfo=timezone.utc)
+        self._keys.add(key)
+        heapq.heappush(self._deadlines, (deadline, key))
+        if self._wakeup:
+            self._wakeup.set()
+
+    def pending(self) -> int:
+        return len(self._deadlines)
+
+    def start(self, callback: Callable[[], Awaitable[None]]) -> None:
+        """
+        Start waiting on the deadlines unless already running
+        """
+        self._callback = callback
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_event_loop().create_task(self._run())
+
+    def _pop_due(self, now: datetime) -> list[str]:
+        due: list[str] = []
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, key = heapq.heappop(self._deadlines)
+            self._keys.discard(key)
+            due.append(key)
+        return due
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            if not self._deadlines:
+                await self._wakeup.wait()
+                continue
+
+            delay = (self._deadlines[0][0] - datetime.now(timezone.utc)).total_seconds()
+            if delay > 0:
+                try:
+                    # Wake up early if something is scheduled in the meantime,
+                    # it might be due sooner
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                    continue
+                except asyncio.TimeoutError:
+                    pass
+
+            due = self._pop_due(datetime.now(timezone.utc))
+            if not due:
+                continue
+            log.debug(f"[DeadlineScheduler] {self.name}: {len(due)} due")
+            try:
+                await self._callback()
+            except Exception:
+                log.exception(
+                    f"[DeadlineScheduler] Error processing {self.name}, retrying in {self._retry_delay}s"
+                )
+                retry_at = datetime.now(timezone.utc) + timedelta(seconds=self._retry_delay)
+                for key in due:
+                    self.schedule(key, retry_at)
+                self._retry_delay = min(self._retry_delay * 2, MAX_RETRY_DELAY)
+            else:
+                self._retry_delay = self.min_retry_delay
+
+
+queue_waitlist_scheduler = DeadlineScheduler("queue_waitlist")
+vote_passed_waitlist_scheduler = DeadlineScheduler("vote_passed_waitlist")
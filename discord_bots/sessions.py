@@ -0,0 +1,192 @@
+# Keeps database sessions from outliving the command or task that opened them.
+#
+# Event handlers (commands run inside on_message, see main.py) and tasks run
+# inside a session_scope: every Session created in the scope is closed when the
+# scope exits, which also rolls back anything left uncommitted, so an early
+# return or an exception can't leave a connection checked out or idle in
+# transaction.
+#
+# ConnectionLeakDetector watches the pool itself. It remembers where each
+# connection was checked out and logs that stack for any connection that has
+# been checked out for longer than SESSION_LEAK_SECONDS.
+import asyncio
+import traceback
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from functools import wraps
+from timeit import default_timer
+from typing import Awaitable, Callable, Iterator, TypeVar
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session as SQLAlchemySession
+
+import discord_bots.config as config
+from discord_bots.log import define_logger
+
+log = define_logger(__name__)
+
+T = TypeVar("T")
+
+
+@dataclass
+class _Scope:
+    task: asyncio.Task | None
+    sessions: list[SQLAlchemySession]
+
+
+_current_scope: ContextVar[_Scope | None] = ContextVar("session_scope", default=None)
+
+
+def _current_task() -> asyncio.Task | None:
+    try:
+        return asyncio.current_task()
+    except RuntimeError:
+        return None
+
+
+class ScopedSession(SQLAlchemySession):
+    """
+    Session that registers itself with the enclosing session_scope, if any
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        scope = _current_scope.get()
+        # Tasks started from inside a scope inherit its context, but they
+        # outlive it so their sessions are theirs to close
+        if scope is not None and scope.task is _current_task():
+            scope.sessions.append(self)
+
+
+@contextmanager
+def session_scope() -> Iterator[None]:
+    """
+    Close every session created inside the block once it exits, rolling back
+    whatever wasn't committed
+    """
+    scope = _Scope(_current_task(), [])
+    token = _current_scope.set(scope)
+    try:
+        yield
+    finally:
+        _current_scope.reset(token)
+        for session in scope.sessions:
+            try:
+                session.close()
+            except Exception:
+                log.exception("[session_scope] Error closing session")
+
+
+def closes_sessions(
+    coroutine_function: Callable[..., Awaitable[T]]
+) -> Callable[..., Awaitable[T]]:
+    """
+    Run a coroutine function (a task, an event handler) in its own
+    session_scope
+    """
+
+    @wraps(coroutine_function)
+    async def wrapper(*args, **kwargs) -> T:
+        with session_scope():
+            return await coroutine_function(*args, **kwargs)
+
+    return wrapper
+
+
+@dataclass
+class PoolStatus:
+    """
+    :checked_out: Connections in use right now, including overflow
+    :overflow: Connections open beyond size, negative while the pool hasn't
+    opened size connections yet
+    :longest_checkout_seconds: How long the oldest connection in use has been
+    checked out
+    """
+
+    size: int
+    max_overflow: int
+    checked_out: int
+    checked_in: int
+    overflow: int
+    longest_checkout_seconds: float
+
+    def __str__(self) -> str:
+        return (
+            f"{self.checked_out} checked out, {self.checked_in} idle, "
+            f"overflow {self.overflow}/{self.max_overflow}, pool size {self.size}, "
+            f"longest checkout {round(self.longest_checkout_seconds, 1)}s"
+        )
+
+
+@dataclass
+class _Checkout:
+    checked_out_at: float
+    stack: list[str]
+    is_reported: bool = False
+
+
+class ConnectionLeakDetector:
+    def __init__(self, threshold_seconds: float):
+        """
+        :threshold_seconds: Report connections checked out for longer than
+        this, 0 turns off recording where connections are checked out
+        """
+        self.threshold_seconds = threshold_seconds
+        self._checkouts: dict[int, _Checkout] = {}
+        self._engine: Engine | None = None
+
+    def attach(self, engine: Engine) -> None:
+        self._engine = engine
+        event.listen(engine, "checkout", self._on_checkout)
+        event.listen(engine, "checkin", self._on_checkin)
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy) -> None:
+        stack = traceback.format_stack()[:-1] if self.threshold_seconds > 0 else []
+        self._checkouts[id(connection_record)] = _Checkout(default_timer(), stack)
+
+    def _on_checkin(self, dbapi_connection, connection_record) -> None:
+        self._checkouts.pop(id(connection_record), None)
+
+    def pool_status(self) -> PoolStatus:
+        pool = self._engine.pool
+        now = default_timer()
+        return PoolStatus(
+            size=pool.size(),
+            max_overflow=pool._max_overflow,
+            checked_out=pool.checkedout(),
+            checked_in=pool.checkedin(),
+            overflow=pool.overflow(),
+            longest_checkout_seconds=max(
+                (now - checkout.checked_out_at for checkout in self._checkouts.values()),
+                default=0.0,
+            ),
+        )
+
+    def check(self) -> int:
+        """
+        Log the stack of every connection that has been checked out for
+        longer than the threshold, once per checkout
+
+        :returns: Number of connections over the threshold
+        """
+        if self.threshold_seconds <= 0:
+            return 0
+        now = default_timer()
+        leaked = 0
+        for checkout in list(self._checkouts.values()):
+            seconds = now - checkout.checked_out_at
+            if seconds <= self.threshold_seconds:
+                continue
+            leaked += 1
+            if not checkout.is_reported:
+                checkout.is_reported = True
+                log.warning(
+                    f"[ConnectionLeakDetector] Connection checked out for {round(seconds)}s, "
+                    f"checked out at:\n{''.join(checkout.stack)}"
+                )
+        return leaked
+
+
+connection_leak_detector = ConnectionLeakDetector(config.SESSION_LEAK_SECONDS)
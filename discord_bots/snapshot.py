@@ -0,0 +1,152 @@
+# Everything the status style commands print, loaded at once: queues and who
+# is in them, queue regions, in-progress games with both teams, the current
+# map and the map vote tallies. Loading takes the same number of queries no
+# matter how many queues, games or votes there are, and rendering from it
+# doesn't touch the database.
+from collections import defaultdict
+from dataclasses import dataclass, field
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session as SQLAlchemySession
+
+from discord_bots.models import (
+    CurrentMap,
+    InProgressGame,
+    InProgressGamePlayer,
+    Map,
+    MapVote,
+    Player,
+    Queue,
+    QueueRegion,
+    SkipMapVote,
+)
+from discord_bots.queue_state import queue_state
+
+
+@dataclass
+class GameSnapshot:
+    game: InProgressGame
+    team0_players: list[Player] = field(default_factory=list)
+    team1_players: list[Player] = field(default_factory=list)
+
+
+@dataclass
+class SystemSnapshot:
+    """
+    :queues: All queues, oldest first
+    :players_by_queue_id: Players in each queue, in the order they were added
+    :games_by_queue_id: In-progress games for each queue, games without a
+    queue are left out
+    :maps: All maps, ordered by rotation index
+    :map_votes: voteable_map_id -> number of votes
+    """
+
+    queues: list[Queue]
+    players_by_queue_id: dict[str, list[Player]]
+    queue_regions_by_id: dict[str, QueueRegion]
+    games_by_queue_id: dict[str, list[GameSnapshot]]
+    current_map: CurrentMap | None
+    maps: list[Map]
+    skip_map_votes: int
+    map_votes: dict[str, int]
+
+    @property
+    def current_map_full(self) -> Map | None:
+        if self.current_map is None:
+            return None
+        return next(
+            (map for map in self.maps if map.id == self.current_map.map_id), None
+        )
+
+    def queue_status_strs(self) -> list[str]:
+        """
+        "name [players/size]" for every queue, oldest first, marking queues
+        with a game in progress
+        """
+        queue_statuses = []
+        for queue in self.queues:
+            status = f"{queue.name} [{len(self.players_by_queue_id[queue.id])}/{queue.size}]"
+            if queue.id in self.games_by_queue_id:
+                status += " *(In game)*"
+            queue_statuses.append(status)
+        return queue_statuses
+
+
+def load_system_snapshot(session: SQLAlchemySession) -> SystemSnapshot:
+    queues: list[Queue] = (
+        session.query(Queue).order_by(Queue.created_at.asc()).all()  # type: ignore
+    )
+    queue_regions_by_id: dict[str, QueueRegion] = {
+        queue_region.id: queue_region for queue_region in session.query(QueueRegion)
+    }
+
+    # Queue membership comes from the in-memory queue state, only the names
+    # need the database
+    player_ids_by_queue_id: dict[str, list[int]] = {}
+    for queue in queues:
+        cached_queue = queue_state.get(queue.id)
+        player_ids_by_queue_id[queue.id] = (
+            list(cached_queue.player_ids) if cached_queue else []
+        )
+    queued_player_ids = {
+        player_id
+        for player_ids in player_ids_by_queue_id.values()
+        for player_id in player_ids
+    }
+    players_by_id: dict[int, Player] = {}
+    if queued_player_ids:
+        players_by_id = {
+            player.id: player
+            for player in session.query(Player).filter(
+                Player.id.in_(queued_player_ids)  # type: ignore
+            )
+        }
+    players_by_queue_id = {
+        queue_id: [
+            players_by_id[player_id]
+            for player_id in player_ids
+            if player_id in players_by_id
+        ]
+        for queue_id, player_ids in player_ids_by_queue_id.items()
+    }
+
+    games_by_id: dict[str, GameSnapshot] = {
+        game.id: GameSnapshot(game)
+        for game in session.query(InProgressGame).order_by(
+            InProgressGame.created_at.asc()  # type: ignore
+        )
+    }
+    for in_progress_game_id, team, player in session.query(
+        InProgressGamePlayer.in_progress_game_id, InProgressGamePlayer.team, Player
+    ).join(Player, Player.id == InProgressGamePlayer.player_id):
+        game_snapshot = games_by_id.get(in_progress_game_id)
+        if game_snapshot is None:
+            continue
+        if team == 0:
+            game_snapshot.team0_players.append(player)
+        elif team == 1:
+            game_snapshot.team1_players.append(player)
+    games_by_queue_id: dict[str, list[GameSnapshot]] = defaultdict(list)
+    for game_snapshot in games_by_id.values():
+        if game_snapshot.game.queue_id:
+            games_by_queue_id[game_snapshot.game.queue_id].append(game_snapshot)
+
+    current_map: CurrentMap | None = session.query(CurrentMap).first()
+    maps: list[Map] = session.query(Map).order_by(Map.rotation_index.asc()).all()  # type: ignore
+    skip_map_votes: int = session.query(func.count(SkipMapVote.id)).scalar()
+    map_votes: dict[str, int] = dict(
+        session.query(MapVote.voteable_map_id, func.count(MapVote.id)).group_by(
+            MapVote.voteable_map_id
+        )
+    )
+
+    return SystemSnapshot(
+        queues=queues,
+        players_by_queue_id=players_by_queue_id,
+        queue_regions_by_id=queue_regions_by_id,
+        games_by_queue_id=dict(games_by_queue_id),
+        current_map=current_map,
+        maps=maps,
+        skip_map_votes=skip_map_votes,
+        map_votes=map_votes,
+    )
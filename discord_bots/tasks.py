@@ -2,6 +2,7 @@
 # use queues to be able to execute discord actions from child threads.
 # https://stackoverflow.com/a/67996748
 
+import asyncio
 from collections import defaultdict
 from datetime import datetime, timedelta, timezone
 from random import shuffle
@@ -10,11 +11,13 @@ from discord.colour import Colour
 from discord.ext import tasks
 from discord.member import Member
 from discord.utils import escape_markdown
+from sqlalchemy import delete, select
 
 import discord_bots.config as config
+from .activity import activity_tracker
 from .bot import bot
 from .commands import (
-    add_player_to_queue,
+    add_players_to_queues,
     is_in_game,
 )
 from .log import define_logger
@@ -24,7 +27,6 @@ from .models import (
     MapVote,
     Player,
     Queue,
-    QueuePlayer,
     QueueWaitlist,
     QueueWaitlistPlayer,
     Session,
@@ -33,187 +35,228 @@ from .models import (
     VotePassedWaitlistPlayer,
     Map,
 )
+from .queue_state import queue_state
+from .sessions import closes_sessions, connection_leak_detector
+from .scheduler import queue_waitlist_scheduler, vote_passed_waitlist_scheduler
+from .snapshot import SystemSnapshot, load_system_snapshot
 from .queues import AddPlayerQueueMessage, add_player_queue
 from .utils import send_message, update_current_map_to_next_map_in_rotation, get_current_map_readonly
 
 log = define_logger(__name__)
 
 
+@tasks.loop(seconds=config.ACTIVITY_FLUSH_SECONDS)
+async def activity_flush_task():
+    try:
+        activity_tracker.flush()
+    except Exception:
+        log.exception("Error in scheduled task")
+
+
+@tasks.loop(seconds=30)
+async def connection_leak_task():
+    try:
+        leaked = connection_leak_detector.check()
+        pool_status = connection_leak_detector.pool_status()
+        if leaked or pool_status.overflow > 0:
+            log.warning(f"[connection_leak_task] {leaked} connections over the threshold, {pool_status}")
+        else:
+            log.debug(f"[connection_leak_task] {pool_status}")
+    except Exception:
+        log.exception("Error in scheduled task")
+
+
 @tasks.loop(minutes=1)
+@closes_sessions
 async def afk_timer_task():
     try:
+        # Activity that's still buffered must count, or players who are
+        # active would be swept
+        activity_tracker.flush()
         with Session() as session:
             channel = bot.get_channel(config.CHANNEL_ID)
             timeout = datetime.now(timezone.utc) - timedelta(minutes=config.AFK_TIME_MINUTES)
-
-            player: Player
-            for player in (
-                    session.query(Player)
-                            .join(QueuePlayer)
-                            .filter(Player.last_activity_at < timeout, QueuePlayer.player_id == Player.id)
-            ):
-                queue_player = (
-                    session.query(QueuePlayer)
-                    .filter(QueuePlayer.player_id == player.id)
-                    .first()
+            inactive_player_ids = select(Player.id).where(Player.last_activity_at < timeout)
+
+            # One statement per table, all in one transaction
+            removed_from_queue_ids = queue_state.remove_inactive_players(session, timeout)
+            votes_removed_ids: set[int] = set()
+            for vote_model in (MapVote, SkipMapVote):
+                votes_removed_ids.update(
+                    session.execute(
+                        delete(vote_model)
+                        .where(vote_model.player_id.in_(inactive_player_ids))
+                        .returning(vote_model.player_id)
+                        .execution_options(synchronize_session=False)
+                    ).scalars()
                 )
-                if queue_player:
-                    member: Member | None = channel.guild.get_member(player.id)
-                    # TODO if not a member, send without mention (likely left the server)
-                    if member:
-                        await send_message(
-                            channel,
-                            content=member.mention,
-                            embed_content=False,
-                            embed_description=f"{escape_markdown(player.name)} was removed from all queues for being inactive for {config.AFK_TIME_MINUTES} minutes",
-                            colour=Colour.red(),
-                        )
-                    session.query(QueuePlayer).filter(
-                        QueuePlayer.player_id == player.id
-                    ).delete()
-                    session.commit()
-
-            votes_removed_sent = False
-            for player in (
-                    session.query(Player)
-                            .join(MapVote)
-                            .filter(Player.last_activity_at < timeout, MapVote.player_id == Player.id)
-            ):
-                map_votes: list[MapVote] = (
-                    session.query(MapVote).filter(MapVote.player_id == player.id).all()
-                )
-                if len(map_votes) > 0:
-                    member: Member | None = channel.guild.get_member(player.id)
-                    if member:
-                        await send_message(
-                            channel,
-                            content=member.mention,
-                            embed_content=False,
-                            embed_description=f"{escape_markdown(player.name)}'s votes removed for being inactive for {config.AFK_TIME_MINUTES} minutes",
-                            colour=Colour.red(),
-                        )
-                        votes_removed_sent = True
-                    session.query(MapVote).filter(MapVote.player_id == player.id).delete()
-                    session.commit()
-
-            for player in (
-                    session.query(Player)
-                            .join(SkipMapVote)
-                            .filter(Player.last_activity_at < timeout, SkipMapVote.player_id == Player.id)
-            ):
-                skip_map_votes: list[SkipMapVote] = (
-                    session.query(SkipMapVote).filter(SkipMapVote.player_id == player.id).all()
-                )
-                if len(skip_map_votes) > 0:
-                    # So we don't send this message twice
-                    if not votes_removed_sent:
-                        member: Member | None = channel.guild.get_member(player.id)
-                        if member:
-                            await send_message(
-                                channel,
-                                content=member.mention,
-                                embed_content=False,
-                                embed_description=f"{escape_markdown(player.name)}'s votes removed for being inactive for {config.AFK_TIME_MINUTES} minutes",
-                                colour=Colour.red(),
-                            )
-                    session.query(SkipMapVote).filter(
-                        SkipMapVote.player_id == player.id
-                    ).delete()
-                    session.commit()
+            if not removed_from_queue_ids and not votes_removed_ids:
+                return
+            # Plain columns, they're read after the session is closed
+            players: list[tuple[int, str]] = (
+                session.query(Player.id, Player.name)
+                .filter(Player.id.in_(removed_from_queue_ids | votes_removed_ids))
+                .order_by(Player.name)
+                .all()
+            )
+            session.commit()
+
+        lines: list[str] = []
+        queue_names = [
+            escape_markdown(name) for player_id, name in players if player_id in removed_from_queue_ids
+        ]
+        if queue_names:
+            lines.append(
+                f"{', '.join(queue_names)} removed from all queues for being inactive for {config.AFK_TIME_MINUTES} minutes"
+            )
+        vote_names = [
+            escape_markdown(name) for player_id, name in players if player_id in votes_removed_ids
+        ]
+        if vote_names:
+            lines.append(
+                f"{', '.join(vote_names)}'s votes removed for being inactive for {config.AFK_TIME_MINUTES} minutes"
+            )
+        # Players that aren't members any more likely left the server, they're
+        # listed but not mentioned
+        mentions = []
+        for player_id, _ in players:
+            member: Member | None = channel.guild.get_member(player_id)
+            if member:
+                mentions.append(member.mention)
+        await send_message(
+            channel,
+            content=" ".join(mentions) or None,
+            embed_content=False,
+            embed_description="\n".join(lines),
+            colour=Colour.red(),
+        )
     except Exception:
         log.exception("Error in scheduled task")
 
 
-@tasks.loop(seconds=1)
-async def queue_waitlist_task():
+async def enqueue_waitlisted_players(
+        session, queue_ids_by_player_id: dict[int, list[str]]
+) -> None:
+    """
+    Put one add message per waitlisted player on the add player queue, in a
+    random order. Players that are back in a game are skipped, the caller
+    deletes their waitlist rows along with everyone else's.
     """
-    Move players in the waitlist into the queues. Pop queues if needed.
+    player_ids = list(queue_ids_by_player_id)
+    shuffle(player_ids)
+    players_by_id: dict[int, Player] = {
+        player.id: player
+        for player in session.query(Player).filter(Player.id.in_(player_ids))  # type: ignore
+    }
+    for player_id in player_ids:
+        if player_id not in players_by_id or is_in_game(player_id):
+            continue
+        await add_player_queue.put(
+            AddPlayerQueueMessage(
+                player_id,
+                players_by_id[player_id].name,
+                queue_ids_by_player_id[player_id],
+                False,
+            )
+        )
 
-    This exists as a task so that it happens on the main thread. Sqlite doesn't
-    like to do writes on a second thread.
 
-    TODO: Tests for this method
+def start_waitlist_schedulers() -> None:
     """
-    try:
-        with Session() as session:
-            queues: list[Queue] = session.query(Queue).order_by(Queue.created_at.asc())  # type: ignore
-            queue_waitlist: QueueWaitlist
-            for queue_waitlist in session.query(QueueWaitlist).filter(
-                    QueueWaitlist.end_waitlist_at < datetime.now(timezone.utc)
-            ):
-                queue_waitlist_players: list[QueueWaitlistPlayer]
-                queue_waitlist_players = (
-                    session.query(QueueWaitlistPlayer)
-                    .filter(QueueWaitlistPlayer.queue_waitlist_id == queue_waitlist.id)
-                    .all()
-                )
-                qwp_by_queue_id: dict[str, list[QueueWaitlistPlayer]] = defaultdict(list)
-                for qwp in queue_waitlist_players:
-                    if qwp.queue_id:
-                        qwp_by_queue_id[qwp.queue_id].append(qwp)
-
-                # Ensure that we process the queues in the order the queues were created
-                for queue in queues:
-                    qwps_for_queue = qwp_by_queue_id[queue.id]
-                    shuffle(qwps_for_queue)
-                    for queue_waitlist_player in qwps_for_queue:
-                        if is_in_game(queue_waitlist_player.player_id):
-                            session.delete(queue_waitlist_player)
-                            continue
-
-                        player = session.query(Player).filter(Player.id == queue_waitlist_player.player_id).first()
-
-                        add_player_queue.put(
-                            AddPlayerQueueMessage(
-                                queue_waitlist_player.player_id,
-                                player.name,
-                                # TODO: This is sucky to do it one at a time
-                                [queue.id],
-                                False
-                            )
-                        )
-                for igp_channel in session.query(InProgressGameChannel).filter(
-                        InProgressGameChannel.in_progress_game_id
-                        == queue_waitlist.in_progress_game_id
-                ):
-                    voice_channel = bot.get_channel(igp_channel.channel_id)
-                    if voice_channel:
-                        await voice_channel.delete()
-                    session.delete(igp_channel)
-                session.query(QueueWaitlistPlayer).filter(
-                    QueueWaitlistPlayer.queue_waitlist_id == queue_waitlist.id
-                ).delete()
-                session.delete(queue_waitlist)
-                session.query(InProgressGame).filter(
-                    InProgressGame.id == queue_waitlist.in_progress_game_id
-                ).delete()
-            session.commit()
-    except Exception:
-        log.exception("Error in scheduled task")
+    Schedule every waitlist that's still in the database and start waiting on
+    them. Waitlists created after this are scheduled where they're created.
+    """
+    with Session() as session:
+        queue_waitlist: QueueWaitlist
+        for queue_waitlist in session.query(QueueWaitlist):
+            queue_waitlist_scheduler.schedule(
+                queue_waitlist.id, queue_waitlist.end_waitlist_at
+            )
+        vpw: VotePassedWaitlist
+        for vpw in session.query(VotePassedWaitlist):
+            vote_passed_waitlist_scheduler.schedule(vpw.id, vpw.end_waitlist_at)
+    queue_waitlist_scheduler.start(process_queue_waitlists)
+    vote_passed_waitlist_scheduler.start(process_vote_passed_waitlists)
 
 
-@tasks.loop(seconds=1)
-async def vote_passed_waitlist_task():
+@closes_sessions
+async def process_queue_waitlists():
     """
-    Move players in the waitlist into the queues. Pop queues if needed.
+    Move players in the expired waitlists into the queues. Pop queues if
+    needed.
 
-    This exists as a task so that it happens on the main thread. Sqlite doesn't
-    like to do writes on a second thread.
+    Called by queue_waitlist_scheduler as soon as a waitlist expires, on the
+    main thread since Sqlite doesn't like to do writes on a second thread.
+    Raises if the waitlists couldn't be processed, so they're retried.
 
     TODO: Tests for this method
     """
-    try:
-        with Session() as session:
-            vpw: VotePassedWaitlist | None = (
-                session.query(VotePassedWaitlist)
-                .filter(VotePassedWaitlist.end_waitlist_at < datetime.now(timezone.utc))
-                .first()
+    with Session() as session:
+        queues: list[Queue] = session.query(Queue).order_by(Queue.created_at.asc())  # type: ignore
+        queue_waitlist: QueueWaitlist
+        for queue_waitlist in session.query(QueueWaitlist).filter(
+                QueueWaitlist.end_waitlist_at <= datetime.now(timezone.utc)
+        ):
+            queue_waitlist_players: list[QueueWaitlistPlayer]
+            queue_waitlist_players = (
+                session.query(QueueWaitlistPlayer)
+                .filter(QueueWaitlistPlayer.queue_waitlist_id == queue_waitlist.id)
+                .all()
             )
-            if not vpw:
-                return
+            qwp_by_queue_id: dict[str, list[QueueWaitlistPlayer]] = defaultdict(list)
+            for qwp in queue_waitlist_players:
+                if qwp.queue_id:
+                    qwp_by_queue_id[qwp.queue_id].append(qwp)
+
+            # One message per player with all of their queues, in the
+            # order the queues were created
+            queue_ids_by_player_id: dict[int, list[str]] = defaultdict(list)
+            for queue in queues:
+                for queue_waitlist_player in qwp_by_queue_id[queue.id]:
+                    queue_ids_by_player_id[queue_waitlist_player.player_id].append(queue.id)
+            await enqueue_waitlisted_players(session, queue_ids_by_player_id)
+            for igp_channel in session.query(InProgressGameChannel).filter(
+                    InProgressGameChannel.in_progress_game_id
+                    == queue_waitlist.in_progress_game_id
+            ):
+                voice_channel = bot.get_channel(igp_channel.channel_id)
+                if voice_channel:
+                    await voice_channel.delete()
+                session.delete(igp_channel)
+            session.query(QueueWaitlistPlayer).filter(
+                QueueWaitlistPlayer.queue_waitlist_id == queue_waitlist.id
+            ).delete()
+            session.delete(queue_waitlist)
+            session.query(InProgressGame).filter(
+                InProgressGame.id == queue_waitlist.in_progress_game_id
+            ).delete()
+        session.commit()
 
-            queues: list[Queue] = session.query(Queue).order_by(Queue.created_at.asc())  # type: ignore
 
+@closes_sessions
+async def process_vote_passed_waitlists():
+    """
+    Move players in the expired vote passed waitlists into the queues. Pop
+    queues if needed.
+
+    Called by vote_passed_waitlist_scheduler as soon as a waitlist expires, on
+    the main thread since Sqlite doesn't like to do writes on a second thread.
+    Raises if the waitlists couldn't be processed, so they're retried.
+
+    TODO: Tests for this method
+    """
+    with Session() as session:
+        vpws: list[VotePassedWaitlist] = (
+            session.query(VotePassedWaitlist)
+            .filter(VotePassedWaitlist.end_waitlist_at <= datetime.now(timezone.utc))
+            .all()
+        )
+        if not vpws:
+            return
+
+        queues: list[Queue] = session.query(Queue).order_by(Queue.created_at.asc())  # type: ignore
+
+        for vpw in vpws:
             # TODO: Do we actually need to filter by id?
             vote_passed_waitlist_players: list[VotePassedWaitlistPlayer] = (
                 session.query(VotePassedWaitlistPlayer)
@@ -226,37 +269,25 @@ async def vote_passed_waitlist_task():
                     vote_passed_waitlist_player
                 )
 
-            # Ensure that we process the queues in the order the queues were created
+            # One message per player with all of their queues, in the
+            # order the queues were created
+            queue_ids_by_player_id: dict[int, list[str]] = defaultdict(list)
             for queue in queues:
-                vpwps_for_queue = vpwp_by_queue_id[queue.id]
-                shuffle(vpwps_for_queue)
-                for vote_passed_waitlist_player in vpwps_for_queue:
-                    if is_in_game(vote_passed_waitlist_player.player_id):
-                        session.delete(vote_passed_waitlist_player)
-                        continue
-
-                    player = session.query(Player).filter(Player.id == vote_passed_waitlist_player.player_id).first()
-
-                    add_player_queue.put(
-                        AddPlayerQueueMessage(
-                            vote_passed_waitlist_player.player_id,
-                            player.name,
-                            # TODO: This is sucky to do it one at a time
-                            [queue.id],
-                            False
-                        )
+                for vote_passed_waitlist_player in vpwp_by_queue_id[queue.id]:
+                    queue_ids_by_player_id[vote_passed_waitlist_player.player_id].append(
+                        queue.id
                     )
+            await enqueue_waitlisted_players(session, queue_ids_by_player_id)
 
             session.query(VotePassedWaitlistPlayer).filter(
                 VotePassedWaitlistPlayer.vote_passed_waitlist_id == vpw.id
             ).delete()
             session.delete(vpw)
-            session.commit()
-    except Exception:
-        log.exception("Error in scheduled task")
+        session.commit()
 
 
 @tasks.loop(minutes=1)
+@closes_sessions
 async def map_rotation_task():
     """
     Rotate the map automatically, stopping on the 0th map
@@ -283,68 +314,91 @@ async def map_rotation_task():
         log.exception("Error in scheduled task")
 
 
-@tasks.loop(seconds=1)
-async def add_player_task():
+_add_player_worker: asyncio.Task | None = None
+
+
+def start_add_player_worker() -> None:
+    """
+    Start add_player_worker unless it's already running. on_ready can fire
+    more than once, e.g. after a reconnect.
     """
-    Handle adding players in a task that pulls messages off of a queue.
+    global _add_player_worker
+    if _add_player_worker is None or _add_player_worker.done():
+        _add_player_worker = bot.loop.create_task(add_player_worker())
+
+
+async def add_player_worker():
+    """
+    Handle adding players in a single coroutine that pulls messages off of a
+    queue.
 
     This helps with concurrency issues since players can be added from multiple
-    sources (waitlist vs normal add command)
+    sources (waitlist vs normal add command). It wakes up as soon as a message
+    is put, and takes everything that's waiting at that point as one batch.
+
+    When the bot shuts down the worker is cancelled. It stops accepting new
+    messages and processes whatever is already queued before exiting.
     """
+    messages: list[AddPlayerQueueMessage] = []
     try:
-        with Session() as session:
-            queues: list[Queue] = session.query(Queue).all()
-            queue_by_id: dict[str, Queue] = {queue.id: queue for queue in queues}
-            while not add_player_queue.empty():
-                queues_added_to: list[str] = []
-                message: AddPlayerQueueMessage = add_player_queue.get()
-                queue_popped = False
-                queue_ids = message.queue_ids.copy()
-                if config.POP_RANDOM_QUEUE:
-                    shuffle(queue_ids)
-                for queue_id in queue_ids:
-                    queue: Queue = queue_by_id[queue_id]
-                    if queue.is_locked:
-                        continue
-
-                    added_to_queue, queue_popped = await add_player_to_queue(queue.id, message.player_id)
-                    if queue_popped:
-                        break
-                    if added_to_queue:
-                        queues_added_to.append(queue.name)
-
-                if not queue_popped and message.should_print_status:
-                    queue_statuses = []
-                    queue: Queue
-                    for queue in queues:
-                        queue_players = (
-                            session
-                            .query(QueuePlayer)
-                            .filter(QueuePlayer.queue_id == queue.id)
-                            .all()
-                        )
-
-                        in_progress_games: list[InProgressGame] = (
-                            session.query(InProgressGame)
-                            .filter(InProgressGame.queue_id == queue.id)
-                            .all()
-                        )
-
-                        if len(in_progress_games) > 0:
-                            queue_statuses.append(
-                                f"{queue.name} [{len(queue_players)}/{queue.size}] *(In game)*"
-                            )
-                        else:
-                            queue_statuses.append(
-                                f"{queue.name} [{len(queue_players)}/{queue.size}]"
-                            )
-
-                    channel = bot.get_channel(config.CHANNEL_ID)
-                    await send_message(
-                        channel,
-                        content=f"{message.player_name} added to: {', '.join(queues_added_to)}",
-                        embed_description=" ".join(queue_statuses),
-                        colour=Colour.green(),
-                    )
+        while True:
+            messages = await add_player_queue.get_batch()
+            await process_add_player_messages(messages)
+            messages = []
+    except asyncio.CancelledError:
+        add_player_queue.close()
+        if messages:
+            # Cancelled part way through a batch, some of it may have been
+            # written already so it's not safe to run it again
+            log.warning(
+                f"[add_player_worker] Shut down while adding players: "
+                f"{[message.player_id for message in messages]}"
+            )
+        remaining = add_player_queue.get_nowait_batch()
+        if remaining:
+            log.info(f"[add_player_worker] Draining {len(remaining)} adds before shutting down")
+            await process_add_player_messages(remaining)
+        log.info(f"[add_player_worker] {add_player_queue.stats.summary()}")
+        raise
+
+
+@closes_sessions
+async def process_add_player_messages(messages: list[AddPlayerQueueMessage]) -> None:
+    """
+    Add a batch of players and print the queue status for manual adds
+    """
+    popped = [False] * len(messages)
+    try:
+        requests: list[tuple[int, list[str]]] = []
+        for message in messages:
+            queue_ids = message.queue_ids.copy()
+            if config.POP_RANDOM_QUEUE:
+                shuffle(queue_ids)
+            requests.append((message.player_id, queue_ids))
+        results = await add_players_to_queues(requests)
+        popped = [queue_popped for _, queue_popped in results]
+
+        snapshot: SystemSnapshot | None = None
+        for message, (queue_ids_added_to, queue_popped) in zip(messages, results):
+            if not queue_popped and message.should_print_status:
+                if snapshot is None:
+                    with Session() as session:
+                        snapshot = load_system_snapshot(session)
+                queues_added_to = [
+                    queue_state.get(queue_id).name for queue_id in queue_ids_added_to
+                ]
+
+                channel = bot.get_channel(config.CHANNEL_ID)
+                await send_message(
+                    channel,
+                    content=f"{message.player_name} added to: {', '.join(queues_added_to)}",
+                    embed_description=" ".join(snapshot.queue_status_strs()),
+                    colour=Colour.green(),
+                )
     except Exception:
-        log.exception("Error in scheduled task")
+        log.exception("Error in add player worker")
+    finally:
+        add_player_queue.task_done(messages, popped)
+        log.debug(
+            f"[add_player_worker] {len(messages)} adds, {add_player_queue.qsize()} waiting"
+        )
@@ -0,0 +1,719 @@
+# Team balancing helpers. Nothing in here touches the database or discord so
+# the functions can be used from commands, tasks and scripts alike.
+import asyncio
+import heapq
+import multiprocessing
+from itertools import combinations, islice
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from math import comb, exp, sqrt
+from timeit import default_timer
+
+import numpy
+from trueskill import Rating
+
+import discord_bots.config as config
+from discord_bots.log import define_logger
+
+log = define_logger(__name__)
+
+# Must match the BETA used in utils.win_probability
+BETA = 4.1666
+
+# Solvers that can be assigned to a queue, see solve_team_split
+TEAM_SOLVERS = ["auto", "exhaustive", "exact", "heuristic"]
+
+# Past this many players the exhaustive search takes longer than the meet in
+# the middle search, and the tie breaking stops mattering
+EXHAUSTIVE_MAX_SIZE = 20
+
+# Queues up to this size are cheap enough to balance on a thread, bigger ones
+# go to the process pool so they don't hold the GIL away from the bot
+THREAD_POOL_MAX_SIZE = 12
+
+# How many splits get_best_and_worst_team_indices scores at a time
+SPLIT_CHUNK_SIZE = 2 ** 16
+
+# Relative width of the band around the most even split that gets re-scored
+# with the exact cdf. Anything outside of it can't win a tie.
+TIE_TOLERANCE = 1e-9
+
+
+def combination_indices(n: int, k: int) -> numpy.ndarray:
+    """
+    All combinations of range(n) of size k as a (C(n, k), k) matrix, in the
+    same (lexicographic) order that itertools.combinations produces them
+    """
+    cache: dict[tuple[int, int], numpy.ndarray] = {}
+
+    def build(m: int, r: int) -> numpy.ndarray:
+        if (m, r) in cache:
+            return cache[(m, r)]
+        if r == 0:
+            result = numpy.zeros((1, 0), dtype=numpy.uint8)
+        else:
+            blocks = []
+            for first in range(m - r + 1):
+                rest = build(m - first - 1, r - 1) + (first + 1)
+                head = numpy.full((rest.shape[0], 1), first, dtype=numpy.uint8)
+                blocks.append(numpy.hstack((head, rest)))
+            result = (
+                numpy.vstack(blocks)
+                if blocks
+                else numpy.zeros((0, r), dtype=numpy.uint8)
+            )
+        cache[(m, r)] = result
+        return result
+
+    return build(n, k)
+
+
+def half_combination_indices(n: int, k: int) -> numpy.ndarray:
+    """
+    The first half of combination_indices(n, k).
+
+    We only take half the combinations because they end up repeating. i.e.
+    [1,2] vs [3,4] is the same as [3,4] vs [1,2]. When the teams are even the
+    first half is exactly the combinations that contain player 0, so we can
+    skip building the second half entirely.
+    """
+    if n == 2 * k and k > 0:
+        rest = combination_indices(n - 1, k - 1) + 1
+        head = numpy.zeros((rest.shape[0], 1), dtype=numpy.uint8)
+        return numpy.hstack((head, rest))
+    all_combinations = combination_indices(n, k)
+    return all_combinations[: all_combinations.shape[0] // 2]
+
+
+def complement_indices(n: int, team0: numpy.ndarray) -> numpy.ndarray:
+    """
+    For each row of team0, the indices of range(n) not in that row, ascending
+    """
+    rows = team0.shape[0]
+    in_team0 = numpy.zeros((rows, n), dtype=bool)
+    in_team0[numpy.arange(rows)[:, None], team0] = True
+    return numpy.nonzero(~in_team0)[1].reshape(rows, n - team0.shape[1]).astype(
+        numpy.uint8
+    )
+
+
+def _sequential_sum(values: numpy.ndarray, indices: numpy.ndarray) -> numpy.ndarray:
+    """
+    Row sums of values[indices], added left to right like the builtin sum() so
+    that the results are bit for bit identical to the scalar code path
+    """
+    total = numpy.zeros(indices.shape[0], dtype=numpy.float64)
+    for column in range(indices.shape[1]):
+        total += values[indices[:, column]]
+    return total
+
+
+def split_z_scores(
+    mus: numpy.ndarray, sigmas: numpy.ndarray, team0: numpy.ndarray
+) -> numpy.ndarray:
+    """
+    Score every candidate split in one pass. Row i of team0 holds the indices
+    of the first team, the rest of the players make up the second team.
+
+    :returns: The argument passed to the normal cdf by utils.win_probability
+    for each split
+    """
+    n = mus.shape[0]
+    team1 = complement_indices(n, team0)
+    sigmas_squared = sigmas * sigmas
+    delta_mu = _sequential_sum(mus, team0) - _sequential_sum(mus, team1)
+    sum_sigma = _sequential_sum(sigmas_squared, team0)
+    for column in range(team1.shape[1]):
+        sum_sigma += sigmas_squared[team1[:, column]]
+    denom = numpy.sqrt(n * (BETA * BETA) + sum_sigma)
+    return delta_mu / denom
+
+
+# trueskill's built in backend approximates erfc with a polynomial that is off
+# from the real erfc by up to ~1e-7. The bot never configures another backend,
+# so the kernel below uses the same polynomial to keep win probabilities the
+# same as trueskill.global_env().cdf rather than switching to math.erfc.
+_ERFC_COEFFICIENTS = (
+    -1.26551223,
+    1.00002368,
+    0.37409196,
+    0.09678418,
+    -0.18628806,
+    0.27886807,
+    -1.13520398,
+    1.48851587,
+    -0.82215223,
+    0.17087277,
+)
+_SQRT_2 = sqrt(2)
+
+
+def normal_cdf(x: float) -> float:
+    """
+    trueskill.global_env().cdf without going through the backend lookup
+    """
+    y = -x / _SQRT_2
+    z = abs(y)
+    t = 1.0 / (1.0 + z / 2.0)
+    c = _ERFC_COEFFICIENTS
+    r = t * exp(-z * z + c[0] + t * (c[1] + t * (c[2] + t * (c[3] + t * (
+        c[4] + t * (c[5] + t * (c[6] + t * (c[7] + t * (c[8] + t * c[9])))))))))
+    return 0.5 * (2.0 - r if y < 0 else r)
+
+
+def normal_cdf_array(x: numpy.ndarray) -> numpy.ndarray:
+    """
+    normal_cdf for every element of x at once
+    """
+    y = -numpy.asarray(x, dtype=numpy.float64) / _SQRT_2
+    z = numpy.abs(y)
+    t = 1.0 / (1.0 + z / 2.0)
+    c = _ERFC_COEFFICIENTS
+    polynomial = numpy.full_like(t, c[9])
+    for coefficient in c[8:0:-1]:
+        polynomial = coefficient + t * polynomial
+    r = t * numpy.exp(-z * z + c[0] + t * polynomial)
+    return 0.5 * numpy.where(y < 0, 2.0 - r, r)
+
+
+def rating_prefix_sums(
+    mus: list[float], sigmas: list[float]
+) -> tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Running totals of mu and sigma squared, with a leading 0 so that the sum of
+    players i through j - 1 is sums[j] - sums[i]
+    """
+    mu_sums = numpy.zeros(len(mus) + 1, dtype=numpy.float64)
+    sigma_squared_sums = numpy.zeros(len(sigmas) + 1, dtype=numpy.float64)
+    numpy.cumsum(mus, out=mu_sums[1:])
+    numpy.cumsum(numpy.square(sigmas, dtype=numpy.float64), out=sigma_squared_sums[1:])
+    return mu_sums, sigma_squared_sums
+
+
+def prefix_sum_win_probability(
+    mu_sums: numpy.ndarray, sigma_squared_sums: numpy.ndarray, team_size: int
+) -> float:
+    """
+    Win probability for the first team_size players against the rest, given the
+    output of rating_prefix_sums. Same formula as utils.win_probability.
+    """
+    size = mu_sums.shape[0] - 1
+    team0_mu = mu_sums[team_size]
+    team1_mu = mu_sums[size] - team0_mu
+    denom = sqrt(size * (BETA * BETA) + float(sigma_squared_sums[size]))
+    return normal_cdf(float(team0_mu - team1_mu) / denom)
+
+
+def get_even_team_indices(
+    ratings: list[Rating], team_size: int
+) -> tuple[list[int], float]:
+    """
+    Vectorized version of the search get_even_teams used to do one split at a
+    time. Picks the same teams: the first split (in itertools.combinations
+    order) with the win probability closest to 50%.
+
+    :returns: indices into ratings, the first team_size entries are the first
+    team and the remaining entries the second team, and the win probability
+    for the first team. Returns an empty list if no split was found.
+    """
+    n = len(ratings)
+    if n == 0 or team_size <= 0 or comb(n, team_size) < 2:
+        return [], 0.0
+
+    # Rating stores pi / tau and recomputes mu and sigma from them, so read the
+    # values back out rather than using what was passed into Rating()
+    mus = numpy.array([r.mu for r in ratings], dtype=numpy.float64)
+    sigmas = numpy.array([r.sigma for r in ratings], dtype=numpy.float64)
+
+    team0 = half_combination_indices(n, team_size)
+    z = split_z_scores(mus, sigmas, team0)
+
+    # The cdf is monotonic so the most even split has the smallest |z|. Only
+    # the splits that are (nearly) tied for that get scored with the real cdf,
+    # and each distinct z only needs to be scored once.
+    abs_z = numpy.abs(z)
+    best_abs_z = abs_z.min()
+    candidates = numpy.flatnonzero(
+        abs_z <= best_abs_z + TIE_TOLERANCE * (1 + best_abs_z)
+    )
+    unique_z, inverse = numpy.unique(z[candidates], return_inverse=True)
+    evenness = numpy.array([abs(0.50 - normal_cdf(value)) for value in unique_z])[
+        inverse
+    ]
+    best = int(numpy.argmin(evenness))
+    # Mirrors the starting point of the old search, a win probability of 0
+    if evenness[best] >= abs(0.50 - 0.0):
+        return [], 0.0
+
+    row = int(candidates[best])
+    team0_indices = [int(i) for i in team0[row]]
+    in_team0 = set(team0_indices)
+    team1_indices = [i for i in range(n) if i not in in_team0]
+    return team0_indices + team1_indices, normal_cdf(float(unique_z[inverse[best]]))
+
+
+def _keep_smallest(
+    scores: numpy.ndarray,
+    positions: numpy.ndarray,
+    rows: numpy.ndarray,
+    count: int,
+) -> tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+    """
+    The count entries with the smallest score, ties going to the earliest
+    position
+    """
+    order = numpy.lexsort((positions, scores))[:count]
+    return scores[order], positions[order], rows[order]
+
+
+def get_best_and_worst_team_indices(
+    ratings: list[Rating], team_size: int, n_best: int, n_worst: int
+) -> tuple[list[tuple[float, list[int]]], list[tuple[float, list[int]]]]:
+    """
+    The n_best most even and n_worst least even splits, found in a single pass.
+
+    Splits are streamed as index tuples and scored a chunk at a time, only the
+    current winners are kept between chunks, so memory stays bounded no matter
+    how many players there are.
+
+    :returns: (evenness, indices) for the best splits, most even first, and for
+    the worst splits, least even first. As with get_even_team_indices the
+    first team_size indices are the first team.
+    """
+    n = len(ratings)
+    if n == 0 or team_size <= 0 or comb(n, team_size) < 2:
+        return [], []
+    mus = numpy.array([r.mu for r in ratings], dtype=numpy.float64)
+    sigmas = numpy.array([r.sigma for r in ratings], dtype=numpy.float64)
+
+    empty_rows = numpy.zeros((0, team_size), dtype=numpy.uint8)
+    best = (numpy.zeros(0), numpy.zeros(0, dtype=numpy.int64), empty_rows)
+    worst = (numpy.zeros(0), numpy.zeros(0, dtype=numpy.int64), empty_rows)
+
+    # We only take half the combinations because they end up repeating. i.e.
+    # [1,2] vs [3,4] is the same as [3,4] vs [1,2]
+    split_count = comb(n, team_size) // 2
+    splits = islice(combinations(range(n), team_size), split_count)
+    start = 0
+    while True:
+        chunk = list(islice(splits, SPLIT_CHUNK_SIZE))
+        if not chunk:
+            break
+        rows = numpy.array(chunk, dtype=numpy.uint8)
+        positions = numpy.arange(start, start + len(chunk), dtype=numpy.int64)
+        start += len(chunk)
+        # The cdf is monotonic so ranking by abs(z) ranks by evenness
+        abs_z = numpy.abs(split_z_scores(mus, sigmas, rows))
+        best = _keep_smallest(
+            numpy.concatenate((best[0], abs_z)),
+            numpy.concatenate((best[1], positions)),
+            numpy.vstack((best[2], rows)),
+            n_best,
+        )
+        worst = _keep_smallest(
+            numpy.concatenate((worst[0], -abs_z)),
+            numpy.concatenate((worst[1], positions)),
+            numpy.vstack((worst[2], rows)),
+            n_worst,
+        )
+
+    def materialize(
+        kept: tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray], direction: int
+    ) -> list[tuple[float, list[int]]]:
+        results = []
+        if kept[2].shape[0] == 0:
+            return results
+        kept_evenness = numpy.abs(
+            0.50 - normal_cdf_array(split_z_scores(mus, sigmas, kept[2]))
+        )
+        for evenness, position, row in zip(kept_evenness, kept[1], kept[2]):
+            team0 = [int(i) for i in row]
+            in_team0 = set(team0)
+            team1 = [i for i in range(n) if i not in in_team0]
+            results.append((float(evenness), int(position), team0 + team1))
+        results.sort(key=lambda x: (direction * x[0], x[1]))
+        return [(evenness, indices) for evenness, _, indices in results]
+
+    return materialize(best, 1), materialize(worst, -1)
+
+
+@dataclass
+class TeamSplit:
+    """
+    :indices: Indices into the ratings, the first team_size entries are the
+    first team and the remaining entries the second team
+    :win_probability: Win probability for the first team
+    :solver: The solver that actually ran (never "auto")
+    :is_optimal: Whether the split is proven to be the most even one. Only the
+    heuristic can return a split that isn't.
+    :evenness: abs(0.5 - win_probability), 0 is a perfectly even game
+    """
+
+    indices: list[int]
+    win_probability: float
+    solver: str
+    is_optimal: bool
+    evenness: float
+
+
+def split_win_probability(
+    mus: numpy.ndarray, sigmas: numpy.ndarray, team0: list[int], team1: list[int]
+) -> float:
+    """
+    utils.win_probability for players given by index
+    """
+    delta_mu = sum(mus[i] for i in team0) - sum(mus[i] for i in team1)
+    sum_sigma = sum(sigmas[i] ** 2 for i in team0 + team1)
+    denom = sqrt(len(mus) * (BETA * BETA) + sum_sigma)
+    return normal_cdf(float(delta_mu / denom))
+
+
+def _subset_sums(values: numpy.ndarray) -> tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Sum and size of every subset of values. Subset i contains value j when bit
+    j of i is set.
+    """
+    sums = numpy.zeros(1, dtype=numpy.float64)
+    sizes = numpy.zeros(1, dtype=numpy.int8)
+    for value in values:
+        sums = numpy.concatenate((sums, sums + value))
+        sizes = numpy.concatenate((sizes, sizes + 1))
+    return sums, sizes
+
+
+def _mask_to_indices(mask: int, offset: int) -> list[int]:
+    indices = []
+    position = 0
+    while mask:
+        if mask & 1:
+            indices.append(offset + position)
+        mask >>= 1
+        position += 1
+    return indices
+
+
+def meet_in_the_middle_team0(mus: numpy.ndarray, team_size: int) -> list[int]:
+    """
+    Exact search for the team of team_size players whose mu sum is closest to
+    half of the total.
+
+    The delta between the teams is the only thing that changes from one split
+    to another (the sigma sum always covers every player), so the most even
+    split is the one with the smallest abs(delta_mu). Every subset of each half
+    of the players is enumerated, and for each subset of the first half the
+    best complement in the second half is found with a binary search, which is
+    O(2^(n/2) * n) rather than O(C(n, n/2)).
+    """
+    n = len(mus)
+    half = n // 2
+    target = mus.sum() / 2
+    left_sums, left_sizes = _subset_sums(mus[:half])
+    right_sums, right_sizes = _subset_sums(mus[half:])
+
+    best_delta = numpy.inf
+    best_left_mask = 0
+    best_right_mask = 0
+    for left_size in range(0, min(half, team_size) + 1):
+        right_size = team_size - left_size
+        if right_size > n - half:
+            continue
+        left_masks = numpy.flatnonzero(left_sizes == left_size)
+        right_masks = numpy.flatnonzero(right_sizes == right_size)
+        right_order = numpy.argsort(right_sums[right_masks], kind="stable")
+        right_masks = right_masks[right_order]
+        sorted_right_sums = right_sums[right_masks]
+        wanted = target - left_sums[left_masks]
+        positions = numpy.searchsorted(sorted_right_sums, wanted)
+        for neighbour in (positions - 1, positions):
+            valid = (neighbour >= 0) & (neighbour < len(sorted_right_sums))
+            if not valid.any():
+                continue
+            deltas = numpy.full(len(left_masks), numpy.inf)
+            deltas[valid] = numpy.abs(
+                sorted_right_sums[neighbour[valid]] - wanted[valid]
+            )
+            i = int(numpy.argmin(deltas))
+            if deltas[i] < best_delta:
+                best_delta = deltas[i]
+                best_left_mask = int(left_masks[i])
+                best_right_mask = int(right_masks[neighbour[i]])
+
+    return _mask_to_indices(best_left_mask, 0) + _mask_to_indices(
+        best_right_mask, half
+    )
+
+
+def _differencing_team0(mus: numpy.ndarray, team_size: int) -> list[int]:
+    """
+    Balanced Karmarkar-Karp. Players are sorted and paired up, each pair has
+    to be split across the teams, and the pair differences are then
+    partitioned with the usual largest differencing method.
+
+    Falls back to a greedy assignment when the teams can't be made the same
+    size with at most one empty slot.
+    """
+    n = len(mus)
+    order = list(numpy.argsort(-mus, kind="stable"))
+    padding = n - 2 * team_size
+    if padding not in (0, 1):
+        team0: list[int] = []
+        team0_sum = team1_sum = 0.0
+        for i in order:
+            if len(team0) < team_size and (
+                team0_sum <= team1_sum or n - len(team0) == team_size
+            ):
+                team0.append(int(i))
+                team0_sum += mus[i]
+            else:
+                team1_sum += mus[i]
+        return team0
+
+    # An empty slot with a rating of 0 evens out the head count, whichever
+    # side it ends up on is the smaller team
+    values = list(mus) + [0.0] * padding
+    dummy = n if padding else None
+    order = sorted(range(len(values)), key=lambda i: -values[i])
+    heap: list[tuple[float, int, list[int], list[int]]] = []
+    for count, pair in enumerate(range(0, len(order), 2)):
+        larger, smaller = order[pair], order[pair + 1]
+        heapq.heappush(
+            heap, (-(values[larger] - values[smaller]), count, [larger], [smaller])
+        )
+    count = len(heap)
+    while len(heap) > 1:
+        difference0, _, plus0, minus0 = heapq.heappop(heap)
+        difference1, _, plus1, minus1 = heapq.heappop(heap)
+        count += 1
+        heapq.heappush(
+            heap, (difference0 - difference1, count, plus0 + minus1, minus0 + plus1)
+        )
+    _, _, plus, minus = heap[0]
+    if dummy is not None and dummy in minus:
+        plus, minus = minus, plus
+    return [i for i in plus if i != dummy]
+
+
+def _improve_with_swaps(
+    mus: numpy.ndarray, team0: list[int], deadline: float
+) -> list[int]:
+    """
+    Swap the pair of players that shrinks abs(delta_mu) the most until no swap
+    helps or we run out of time
+    """
+    in_team0 = numpy.zeros(len(mus), dtype=bool)
+    in_team0[team0] = True
+    while default_timer() < deadline:
+        team0_indices = numpy.flatnonzero(in_team0)
+        team1_indices = numpy.flatnonzero(~in_team0)
+        if len(team0_indices) == 0 or len(team1_indices) == 0:
+            break
+        delta = mus[team0_indices].sum() - mus[team1_indices].sum()
+        # Swapping i out of team0 for j changes delta by 2 * (mus[j] - mus[i]),
+        # so we want mus[i] - mus[j] as close to delta / 2 as possible
+        team1_order = numpy.argsort(mus[team1_indices], kind="stable")
+        team1_sorted = mus[team1_indices][team1_order]
+        wanted = mus[team0_indices] - delta / 2
+        positions = numpy.searchsorted(team1_sorted, wanted)
+        best_new_delta = abs(delta)
+        best_swap = None
+        for neighbour in (positions - 1, positions):
+            valid = (neighbour >= 0) & (neighbour < len(team1_sorted))
+            for i in numpy.flatnonzero(valid):
+                j = neighbour[i]
+                new_delta = abs(delta - 2 * (mus[team0_indices[i]] - team1_sorted[j]))
+                if new_delta < best_new_delta:
+                    best_new_delta = new_delta
+                    best_swap = (team0_indices[i], team1_indices[team1_order[j]])
+        if best_swap is None:
+            break
+        in_team0[best_swap[0]] = False
+        in_team0[best_swap[1]] = True
+    return [int(i) for i in numpy.flatnonzero(in_team0)]
+
+
+def heuristic_team0(
+    mus: numpy.ndarray, team_size: int, time_limit_seconds: float
+) -> list[int]:
+    """
+    Bounded time search for large queues, the result is not guaranteed to be
+    the most even split
+    """
+    deadline = default_timer() + time_limit_seconds
+    return _improve_with_swaps(mus, _differencing_team0(mus, team_size), deadline)
+
+
+def solve_team_split(
+    ratings: list[Rating],
+    team_size: int,
+    solver: str = "auto",
+    exact_max_size: int | None = None,
+    time_limit_seconds: float | None = None,
+) -> TeamSplit:
+    """
+    Find the most even split of the players into a team of team_size players
+    and a team of the rest.
+
+    :solver: One of TEAM_SOLVERS
+        - exhaustive: score every split, this is what get_even_teams always did
+          and picks the same teams down to tie breaking
+        - exact: meet in the middle search, also finds the most even split but
+          scales to much larger queues
+        - heuristic: differencing plus local swaps, bounded by
+          time_limit_seconds
+        - auto: exhaustive for small queues, exact up to exact_max_size players
+          and heuristic past that
+    """
+    if solver not in TEAM_SOLVERS:
+        raise ValueError(f"Unknown team solver: {solver}")
+    if exact_max_size is None:
+        exact_max_size = config.TEAM_SOLVER_EXACT_MAX_SIZE
+    if time_limit_seconds is None:
+        time_limit_seconds = config.TEAM_SOLVER_TIME_LIMIT_SECONDS
+
+    n = len(ratings)
+    if solver == "auto":
+        if n <= EXHAUSTIVE_MAX_SIZE:
+            solver = "exhaustive"
+        elif n <= exact_max_size:
+            solver = "exact"
+        else:
+            solver = "heuristic"
+
+    if solver == "exhaustive":
+        indices, win_prob = get_even_team_indices(ratings, team_size)
+        return TeamSplit(indices, win_prob, solver, True, abs(0.50 - win_prob))
+
+    mus = numpy.array([r.mu for r in ratings], dtype=numpy.float64)
+    sigmas = numpy.array([r.sigma for r in ratings], dtype=numpy.float64)
+    if n == 0 or team_size <= 0 or team_size >= n:
+        return TeamSplit([], 0.0, solver, True, 0.5)
+    if solver == "exact":
+        team0 = meet_in_the_middle_team0(mus, team_size)
+    else:
+        team0 = heuristic_team0(mus, team_size, time_limit_seconds)
+    team0 = sorted(team0)
+    in_team0 = set(team0)
+    team1 = [i for i in range(n) if i not in in_team0]
+    win_prob = split_win_probability(mus, sigmas, team0, team1)
+    return TeamSplit(
+        team0 + team1, win_prob, solver, solver == "exact", abs(0.50 - win_prob)
+    )
+
+
+def solve_team_split_from_tuples(
+    ratings: list[tuple[float, float]],
+    team_size: int,
+    solver: str,
+    exact_max_size: int,
+    time_limit_seconds: float,
+) -> TeamSplit:
+    """
+    solve_team_split for (mu, sigma) tuples. This is what runs on the worker
+    pools, so it only takes plain values that are cheap to pickle.
+    """
+    return solve_team_split(
+        [Rating(mu, sigma) for mu, sigma in ratings],
+        team_size,
+        solver,
+        exact_max_size,
+        time_limit_seconds,
+    )
+
+
+_process_pool: ProcessPoolExecutor | None = None
+_thread_pool: ThreadPoolExecutor | None = None
+_in_flight: dict[str, int] = {"process": 0, "thread": 0}
+
+
+def _get_pool(kind: str) -> Executor:
+    global _process_pool, _thread_pool
+    if kind == "process":
+        if _process_pool is None:
+            # Don't fork the bot process, it has the discord connection and
+            # database pool open
+            _process_pool = ProcessPoolExecutor(
+                max_workers=config.TEAM_SOLVER_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _process_pool
+    if _thread_pool is None:
+        _thread_pool = ThreadPoolExecutor(
+            max_workers=config.TEAM_SOLVER_WORKERS,
+            thread_name_prefix="team-solver",
+        )
+    return _thread_pool
+
+
+def shutdown_team_pools():
+    global _process_pool, _thread_pool
+    if _process_pool:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
+    if _thread_pool:
+        _thread_pool.shutdown(wait=False, cancel_futures=True)
+        _thread_pool = None
+
+
+def _fallback_team_split(
+    ratings: list[tuple[float, float]], team_size: int, reason: str
+) -> TeamSplit:
+    log.warning(f"[compute_team_split] {reason}, using the heuristic solver inline")
+    return solve_team_split_from_tuples(
+        ratings,
+        team_size,
+        "heuristic",
+        config.TEAM_SOLVER_EXACT_MAX_SIZE,
+        config.TEAM_SOLVER_FALLBACK_TIME_LIMIT_SECONDS,
+    )
+
+
+async def compute_team_split(
+    ratings: list[tuple[float, float]],
+    team_size: int,
+    solver: str = "auto",
+    timeout_seconds: float | None = None,
+) -> TeamSplit:
+    """
+    Run solve_team_split off of the event loop so the bot keeps responding
+    while a big queue pops.
+
+    Small queues run on a thread pool, everything else on a process pool. If
+    every worker of the pool is already busy, or the solver doesn't finish
+    within timeout_seconds, the heuristic solver runs inline with a short time
+    limit instead so the pop is never blocked for long.
+
+    :ratings: (mu, sigma) per player
+    """
+    if timeout_seconds is None:
+        timeout_seconds = config.TEAM_SOLVER_TIMEOUT_SECONDS
+    kind = "thread" if len(ratings) <= THREAD_POOL_MAX_SIZE else "process"
+    if _in_flight[kind] >= config.TEAM_SOLVER_WORKERS:
+        return _fallback_team_split(ratings, team_size, f"{kind} pool saturated")
+
+    _in_flight[kind] += 1
+    try:
+        future = asyncio.get_running_loop().run_in_executor(
+            _get_pool(kind),
+            solve_team_split_from_tuples,
+            ratings,
+            team_size,
+            solver,
+            config.TEAM_SOLVER_EXACT_MAX_SIZE,
+            config.TEAM_SOLVER_TIME_LIMIT_SECONDS,
+        )
+    except Exception:
+        _in_flight[kind] -= 1
+        raise
+
+    def release(_):
+        _in_flight[kind] -= 1
+
+    # A timed out job keeps its worker until it finishes, so only free up the
+    # slot once the job is actually done rather than when we stop waiting
+    future.add_done_callback(release)
+    try:
+        return await asyncio.wait_for(asyncio.shield(future), timeout_seconds)
+    except asyncio.TimeoutError:
+        return _fallback_team_split(
+            ratings, team_size, f"{solver} solver timed out after {timeout_seconds}s"
+        )
@@ -2,6 +2,7 @@
 import itertools
 import math
 import os
+import re
 import statistics
 from datetime import datetime, timezone
 from random import choice
@@ -11,7 +12,7 @@ import imgkit
 from PIL import Image
 from discord import Colour, DMChannel, Embed, GroupChannel, TextChannel
 from discord.ext.commands.context import Context
-from trueskill import Rating, global_env
+from trueskill import Rating
 
 from discord_bots.bot import bot
 from discord_bots.config import CHANNEL_ID, STATS_DIR, STATS_HEIGHT, STATS_WIDTH, RANDOM_MAP_ROTATION
@@ -24,6 +25,7 @@ from discord_bots.models import (
     Session,
     SkipMapVote,
 )
+from discord_bots.teams import normal_cdf
 
 log = define_logger(__name__)
 
@@ -36,6 +38,26 @@ def is_really_numeric(s: str) -> bool:
         return False
 
 
+def ilike(value: str, pattern: str) -> bool:
+    """
+    Match a value against an SQL ILIKE pattern, for filtering rows that are
+    already in memory the way Column.ilike would. "%" matches any run of
+    characters, "_" any one character and a backslash escapes the next one.
+    """
+    regex = ""
+    chars = iter(pattern)
+    for char in chars:
+        if char == "\\":
+            regex += re.escape(next(chars, "\\"))
+        elif char == "%":
+            regex += ".*"
+        elif char == "_":
+            regex += "."
+        else:
+            regex += re.escape(char)
+    return re.fullmatch(regex, value, re.IGNORECASE | re.DOTALL) is not None
+
+
 def get_current_map_readonly() -> tuple[CurrentMap, Map] | tuple[None, None]:
     """
     !WARNING! The objects are no longer tracked by the session. Treat them as immutable.
@@ -177,9 +199,8 @@ def win_probability(team0: list[Rating], team1: list[Rating]) -> float:
     sum_sigma = sum(r.sigma ** 2 for r in itertools.chain(team0, team1))
     size = len(team0) + len(team1)
     denom = math.sqrt(size * (BETA * BETA) + sum_sigma)
-    trueskill = global_env()
 
-    return trueskill.cdf(delta_mu / denom)
+    return normal_cdf(delta_mu / denom)
 
 
 def update_current_map(map_id: str) -> None:
@@ -0,0 +1,61 @@
+"""
+Benchmark the team balancing search for queue sizes 2 through 24.
+
+The old one-split-at-a-time search is only timed up to REFERENCE_MAX_SIZE
+players since it takes minutes past that.
+
+Usage: python scripts/bench_even_teams.py
+"""
+from itertools import combinations
+from math import comb
+from random import Random
+from timeit import default_timer
+
+from trueskill import Rating
+
+from discord_bots.teams import get_even_team_indices
+from discord_bots.utils import win_probability
+
+REFERENCE_MAX_SIZE = 20
+SEED = 1
+
+
+def reference_even_team_indices(ratings: list[Rating], team_size: int):
+    best_win_prob_so_far: float = 0.0
+    best_teams_so_far: list[int] = []
+    indices = list(range(len(ratings)))
+    all_combinations = list(combinations(indices, team_size))
+    for team0 in all_combinations[: len(all_combinations) // 2]:
+        team1 = [i for i in indices if i not in team0]
+        win_prob = win_probability(
+            [ratings[i] for i in team0], [ratings[i] for i in team1]
+        )
+        if abs(0.50 - win_prob) < abs(0.50 - best_win_prob_so_far):
+            best_win_prob_so_far = win_prob
+            best_teams_so_far = list(team0) + team1
+    return best_teams_so_far, best_win_prob_so_far
+
+
+def timed(fn, *args):
+    start = default_timer()
+    result = fn(*args)
+    return result, default_timer() - start
+
+
+rng = Random(SEED)
+print("players,splits,reference_ms,vectorized_ms,speedup,identical")
+for size in range(2, 25, 2):
+    ratings = [Rating(rng.uniform(10, 40), rng.uniform(1, 8.3)) for _ in range(size)]
+    team_size = size // 2
+    splits = comb(size, team_size) // 2
+    vectorized, vectorized_time = timed(get_even_team_indices, ratings, team_size)
+    if size <= REFERENCE_MAX_SIZE:
+        reference, reference_time = timed(
+            reference_even_team_indices, ratings, team_size
+        )
+        print(
+            f"{size},{splits},{round(1000 * reference_time, 2)},{round(1000 * vectorized_time, 2)},"
+            f"{round(reference_time / vectorized_time, 1)},{reference == vectorized}"
+        )
+    else:
+        print(f"{size},{splits},,{round(1000 * vectorized_time, 2)},,")
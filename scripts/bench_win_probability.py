@@ -0,0 +1,86 @@
+"""
+Micro-benchmark the win probability kernel against the old
+utils.win_probability, which went through trueskill.global_env().cdf on every
+call.
+
+Usage: python scripts/bench_win_probability.py
+"""
+import itertools
+import math
+from random import Random
+from timeit import timeit
+
+import numpy
+from trueskill import Rating, global_env
+
+from discord_bots.teams import (
+    normal_cdf_array,
+    prefix_sum_win_probability,
+    rating_prefix_sums,
+)
+
+BETA = 4.1666
+CALLS = 20000
+SEED = 1
+
+
+def reference_win_probability(team0: list[Rating], team1: list[Rating]) -> float:
+    delta_mu = sum(r.mu for r in team0) - sum(r.mu for r in team1)
+    sum_sigma = sum(r.sigma**2 for r in itertools.chain(team0, team1))
+    size = len(team0) + len(team1)
+    denom = math.sqrt(size * (BETA * BETA) + sum_sigma)
+    trueskill = global_env()
+    return trueskill.cdf(delta_mu / denom)
+
+
+rng = Random(SEED)
+print("players,reference_us,kernel_us,vectorized_us,max_abs_difference")
+for size in [2, 4, 8, 12, 16, 24, 32]:
+    team_size = size // 2
+    ratings = [
+        [Rating(rng.uniform(10, 40), rng.uniform(1, 8.3)) for _ in range(size)]
+        for _ in range(CALLS)
+    ]
+    mus = [[r.mu for r in game] for game in ratings]
+    sigmas = [[r.sigma for r in game] for game in ratings]
+
+    reference = [
+        reference_win_probability(game[:team_size], game[team_size:])
+        for game in ratings
+    ]
+    reference_time = timeit(
+        lambda: [
+            reference_win_probability(game[:team_size], game[team_size:])
+            for game in ratings
+        ],
+        number=1,
+    )
+
+    prefix_sums = [rating_prefix_sums(m, s) for m, s in zip(mus, sigmas)]
+    kernel = [prefix_sum_win_probability(m, s, team_size) for m, s in prefix_sums]
+    kernel_time = timeit(
+        lambda: [prefix_sum_win_probability(m, s, team_size) for m, s in prefix_sums],
+        number=1,
+    )
+
+    # Every game scored at once, the way the balancing search uses the kernel
+    mu_matrix = numpy.array(mus)
+    sigma_squared_matrix = numpy.square(numpy.array(sigmas))
+
+    def vectorized():
+        delta_mu = mu_matrix[:, :team_size].sum(axis=1) - mu_matrix[
+            :, team_size:
+        ].sum(axis=1)
+        denom = numpy.sqrt(size * (BETA * BETA) + sigma_squared_matrix.sum(axis=1))
+        return normal_cdf_array(delta_mu / denom)
+
+    vectorized_time = timeit(vectorized, number=1)
+    difference = max(
+        numpy.max(numpy.abs(numpy.array(kernel) - reference)),
+        numpy.max(numpy.abs(vectorized() - reference)),
+    )
+    print(
+        f"{size},{round(1e6 * reference_time / CALLS, 3)},"
+        f"{round(1e6 * kernel_time / CALLS, 3)},"
+        f"{round(1e6 * vectorized_time / CALLS, 3)},{difference:.2e}"
+    )
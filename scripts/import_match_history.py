@@ -1,152 +1,56 @@
-import json
-from datetime import datetime
-from uuid import uuid4
+"""
+Import match history from the old bot's JSON export, see
+discord_bots.match_import.
 
-from trueskill import Rating, rate
+Every player and finished game is deleted first. If an import is
+interrupted, run it again with --resume to keep what was committed and
+continue after the last imported match. Matches are committed
+--chunk-size at a time (1000 by default).
 
-from discord_bots.models import FinishedGame, FinishedGamePlayer, Player, Session
-from discord_bots.utils import win_probability
+Usage: python scripts/import_match_history.py [path] [--resume] [--chunk-size=N]
+"""
+import os
+import sys
 
-DATA_FILE = "out.json"
-
-data = json.load(open(DATA_FILE))
-
-session = Session()
-
-session.query(FinishedGamePlayer).delete()
-session.query(FinishedGame).delete()
-session.query(Player).delete()
-
-for i, match in enumerate(data):
-    print(i, len(data), i / len(data))
-    if match["queue"]["name"] == "bottest":
-        continue
-
-    team1_players = []
-    team2_players = []
-    for json_player in match["players"]:
-        player: Player
-        player_id = json_player["user"]["id"]
-        player = (
-            session.query(Player).filter(Player.id == json_player["user"]["id"]).first()
-        )
-        if not player:
-            player = Player(id=player_id, name=json_player["user"]["name"])
-            session.add(player)
-
-        if json_player["team"] == 1:
-            team1_players.append(player)
-        else:
-            team2_players.append(player)
-
-    rated_team1_ratings = list(
-        map(
-            lambda x: Rating(x.rated_trueskill_mu, x.rated_trueskill_sigma),
-            team1_players,
-        )
-    )
-    rated_team2_ratings = list(
-        map(
-            lambda x: Rating(x.rated_trueskill_mu, x.rated_trueskill_sigma),
-            team2_players,
-        )
-    )
-    unrated_team1_ratings = list(
-        map(
-            lambda x: Rating(x.unrated_trueskill_mu, x.unrated_trueskill_sigma),
-            team1_players,
-        )
-    )
-    unrated_team2_ratings = list(
-        map(
-            lambda x: Rating(x.unrated_trueskill_mu, x.unrated_trueskill_sigma),
-            team2_players,
-        )
-    )
+from discord_bots.match_import import CHUNK_SIZE, ImportStats, import_json_match_history
 
-    outcome = None
-    if match["winningTeam"] == 0:
-        outcome = [0, 0]
-    elif match["winningTeam"] == 1:
-        outcome = [0, 1]
-    elif match["winningTeam"] == 2:
-        outcome = [1, 0]
-    is_rated = match["queue"]["name"] != "LTunrated"
-    try:
-        if is_rated:
-            rated_team1_new_ratings, rated_team2_new_ratings = rate(
-                [rated_team1_ratings, rated_team2_ratings], outcome
-            )
-        else:
-            rated_team1_new_ratings, rated_team2_new_ratings = (
-                rated_team1_ratings,
-                rated_team2_ratings,
+DATA_FILE = "out.json"
+PROGRESS_BAR_WIDTH = 40
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    path = args[0] if args else DATA_FILE
+    resume = "--resume" in sys.argv
+    chunk_size = CHUNK_SIZE
+    for arg in sys.argv[1:]:
+        if arg.startswith("--chunk-size="):
+            chunk_size = int(arg.removeprefix("--chunk-size="))
+    if not os.path.exists(path):
+        print(__doc__)
+        sys.exit(1)
+
+    size = os.path.getsize(path)
+    with open(path, "rb") as file:
+
+        def show_progress(stats: ImportStats) -> None:
+            done = file.tell() / size if size else 1
+            filled = int(done * PROGRESS_BAR_WIDTH)
+            print(
+                f"\r[{'#' * filled}{'.' * (PROGRESS_BAR_WIDTH - filled)}] {done:4.0%} "
+                f"{stats.matches} matches, {stats.matches_per_second:.0f} matches/s",
+                end="",
+                file=sys.stderr,
             )
-    except Exception as e:
-        print(e, match)
-        print(e)
-        continue
 
-    unrated_team1_new_ratings, unrated_team2_new_ratings = rate(
-        [unrated_team1_ratings, unrated_team2_ratings], outcome
+        stats = import_json_match_history(file, resume, chunk_size, show_progress)
+    print(file=sys.stderr)
+    print(
+        f"Imported {stats.imported} matches ({stats.game_players} players, "
+        f"{stats.skipped} skipped) in {stats.seconds:.1f}s, "
+        f"{stats.matches_per_second:.0f} matches/s"
     )
 
-    win_prob = win_probability(rated_team1_ratings, rated_team2_ratings)
-
-    finished_game = FinishedGame(
-        average_trueskill=0.0,
-        game_id=str(uuid4()),
-        finished_at=datetime.fromtimestamp(match["completionTimestamp"] // 1000),
-        is_rated=is_rated,
-        map_full_name="",
-        map_short_name="",
-        queue_name=match["queue"]["name"],
-        started_at=datetime.fromtimestamp(match["timestamp"] // 1000),
-        win_probability=win_prob,
-        winning_team=match["winningTeam"] - 1,
-    )
-    session.add(finished_game)
-
-    for i, player in enumerate(team1_players):
-        finished_game_player = FinishedGamePlayer(
-            finished_game_id=finished_game.id,
-            player_id=player.id,
-            player_name=player.name,
-            team=0,
-            rated_trueskill_mu_before=rated_team1_ratings[i].mu,
-            rated_trueskill_sigma_before=rated_team1_ratings[i].sigma,
-            rated_trueskill_mu_after=rated_team1_new_ratings[i].mu,
-            rated_trueskill_sigma_after=rated_team1_new_ratings[i].sigma,
-            unrated_trueskill_mu_before=unrated_team1_ratings[i].mu,
-            unrated_trueskill_sigma_before=unrated_team1_ratings[i].sigma,
-            unrated_trueskill_mu_after=unrated_team1_new_ratings[i].mu,
-            unrated_trueskill_sigma_after=unrated_team1_new_ratings[i].sigma,
-        )
-        player.rated_trueskill_mu = rated_team1_new_ratings[i].mu
-        player.rated_trueskill_sigma = rated_team1_new_ratings[i].sigma
-        player.unrated_trueskill_mu = unrated_team1_new_ratings[i].mu
-        player.unrated_trueskill_sigma = unrated_team1_new_ratings[i].sigma
-        session.add(finished_game_player)
-
-    for i, player in enumerate(team2_players):
-        finished_game_player = FinishedGamePlayer(
-            finished_game_id=finished_game.id,
-            player_id=player.id,
-            player_name=player.name,
-            team=1,
-            rated_trueskill_mu_before=rated_team2_ratings[i].mu,
-            rated_trueskill_sigma_before=rated_team2_ratings[i].sigma,
-            rated_trueskill_mu_after=rated_team2_new_ratings[i].mu,
-            rated_trueskill_sigma_after=rated_team2_new_ratings[i].sigma,
-            unrated_trueskill_mu_before=unrated_team2_ratings[i].mu,
-            unrated_trueskill_sigma_before=unrated_team2_ratings[i].sigma,
-            unrated_trueskill_mu_after=unrated_team2_new_ratings[i].mu,
-            unrated_trueskill_sigma_after=unrated_team2_new_ratings[i].sigma,
-        )
-        player.rated_trueskill_mu = rated_team2_new_ratings[i].mu
-        player.rated_trueskill_sigma = rated_team2_new_ratings[i].sigma
-        player.unrated_trueskill_mu = unrated_team2_new_ratings[i].mu
-        player.unrated_trueskill_sigma = unrated_team2_new_ratings[i].sigma
-        session.add(finished_game_player)
 
-    session.commit()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+"""
+Back up or restore the match history as a columnar .npz archive, see
+discord_bots.match_archive.
+
+export writes every finished game, finished game player and the current
+player and region ratings to the archive. import merges an archive into the
+database: games already there are kept, ratings are replaced and new games
+are counted in everyone's stats. Restart the bot after an import, its
+leaderboard and other in-memory state is only loaded on startup. The
+archive is plain NumPy, so it can also be loaded with numpy.load for offline
+analysis.
+
+Usage: python scripts/match_archive.py export|import <path>
+"""
+import sys
+from timeit import default_timer
+
+from discord_bots.match_archive import export_match_history, import_match_history
+
+
+def main():
+    if len(sys.argv) < 3 or sys.argv[1] not in ("export", "import"):
+        print(__doc__)
+        sys.exit(1)
+    command, path = sys.argv[1], sys.argv[2]
+
+    start = default_timer()
+    if command == "export":
+        export_match_history(path)
+        print(f"Exported to {path} in {default_timer() - start:.1f}s")
+    else:
+        row_counts = import_match_history(path)
+        for table_name, row_count in row_counts.items():
+            print(f"{table_name}: {row_count} rows")
+        print(f"Imported {path} in {default_timer() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+"""
+Replay finished games and rebuild everyone's ratings, see
+discord_bots.rating_replay.
+
+Pass a finished game's game id (or the start of it) to only replay that game
+and the games that finished after it, e.g. after editing its outcome.
+
+Usage: python scripts/recompute_ratings.py [game_id]
+"""
+import sys
+
+from discord_bots.models import FinishedGame, Session
+from discord_bots.rating_replay import recompute_ratings
+
+
+def main():
+    from_finished_game_id = None
+    if len(sys.argv) > 1:
+        with Session() as session:
+            finished_game = (
+                session.query(FinishedGame)
+                .filter(FinishedGame.game_id.startswith(sys.argv[1]))
+                .first()
+            )
+            if not finished_game:
+                print(f"Could not find game: {sys.argv[1]}")
+                sys.exit(1)
+            from_finished_game_id = finished_game.id
+
+    stats = recompute_ratings(from_finished_game_id)
+    print(
+        f"Replayed {stats.games} games ({stats.game_players} players) in "
+        f"{stats.seconds:.1f}s, {stats.games_per_second:.0f} games/s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Replay the rated match history under a grid of trueskill settings and report
+how well each one predicts the games, see discord_bots.rating_simulation.
+
+The first row is the win_probability stored on each game when it was played,
+as a baseline. Edit the grid below to try other values. Prints one CSV row
+per parameter set, and the calibration table of each with --calibration.
+
+Usage: python scripts/simulate_ratings.py [workers] [--calibration]
+"""
+import sys
+from itertools import product
+from timeit import default_timer
+
+from discord_bots.models import default_trueskill_mu, default_trueskill_sigma
+from discord_bots.rating_simulation import (
+    PredictionMetrics,
+    TrueskillParameters,
+    load_match_log,
+    prediction_metrics,
+    run_simulations,
+)
+
+MUS = [default_trueskill_mu]
+SIGMAS = [default_trueskill_sigma, default_trueskill_sigma * 0.75, default_trueskill_sigma * 0.5]
+BETAS = [default_trueskill_mu / 6, default_trueskill_mu / 8, default_trueskill_mu / 4]
+TAUS = [default_trueskill_mu / 300, default_trueskill_mu / 100]
+DRAW_PROBABILITIES = [0.1]
+
+
+def print_row(label: str, metrics: PredictionMetrics, show_calibration: bool) -> None:
+    print(
+        f"{label},{metrics.games},{metrics.log_loss:.5f},{metrics.brier_score:.5f},"
+        f"{metrics.expected_calibration_error:.5f}"
+    )
+    if show_calibration:
+        for calibration_bin in metrics.calibration:
+            print(
+                f"# [{calibration_bin.low:.1f}, {calibration_bin.high:.1f}) "
+                f"games={calibration_bin.games} "
+                f"predicted={calibration_bin.mean_prediction:.3f} "
+                f"observed={calibration_bin.mean_outcome:.3f}"
+            )
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    workers = int(args[0]) if args else None
+    show_calibration = "--calibration" in sys.argv
+
+    start = default_timer()
+    match_log = load_match_log()
+    print(
+        f"Loaded {match_log.game_count} games, {match_log.player_count} players in "
+        f"{default_timer() - start:.1f}s",
+        file=sys.stderr,
+    )
+    parameter_sets = [
+        TrueskillParameters(mu, sigma, beta, tau, draw_probability)
+        for mu, sigma, beta, tau, draw_probability in product(
+            MUS, SIGMAS, BETAS, TAUS, DRAW_PROBABILITIES
+        )
+    ]
+
+    start = default_timer()
+    results = run_simulations(match_log, parameter_sets, workers)
+    print(
+        f"Simulated {len(parameter_sets)} parameter sets in {default_timer() - start:.1f}s",
+        file=sys.stderr,
+    )
+
+    print("parameters,games,log_loss,brier_score,expected_calibration_error")
+    print_row(
+        "stored win_probability",
+        prediction_metrics(match_log.win_probabilities, match_log.outcomes),
+        show_calibration,
+    )
+    for parameters, metrics in sorted(
+        zip(parameter_sets, results), key=lambda result: result[1].log_loss
+    ):
+        print_row(str(parameters), metrics, show_calibration)
+
+
+if __name__ == "__main__":
+    main()
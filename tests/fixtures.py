@@ -8,6 +8,8 @@ from math import floor
 from random import random
 from uuid import uuid4
 
+from sqlalchemy import or_
+
 from discord_bots.config import TRIBES_VOICE_CATEGORY_CHANNEL_ID
 from discord_bots.models import (
     AdminRole,
@@ -19,16 +21,21 @@ from discord_bots.models import (
     InProgressGamePlayer,
     MapVote,
     Player,
+    PlayerDailyStats,
+    PlayerRegionTrueskill,
     Queue,
     QueuePlayer,
+    QueueRegion,
     QueueRole,
     QueueWaitlistPlayer,
-    RotationMap,
     Session,
     SkipMapVote,
-    VoteableMap,
     engine,
 )
+from discord_bots.in_game import in_game_index
+from discord_bots.leaderboard import leaderboard_service
+from discord_bots.permissions import permission_cache
+from discord_bots.queue_state import queue_state
 
 
 # Mock discord models so we can invoke tests
@@ -124,6 +131,10 @@ class Member:
         """
         return TEST_GUILD
 
+    @property
+    def mention(self) -> str:
+        return f"<@{self.id}>"
+
     async def send(*args, **kwargs):
         pass
 
@@ -134,14 +145,127 @@ izza = Member("izza")
 lyon = Member("lyon")
 
 
-def setup_tests():
+def create_test_tables():
     Base.metadata.create_all(engine)
+
+
+def delete_test_data(
+    player_ids: list[int],
+    queue_names: list[str] | None = None,
+    queue_region_names: list[str] | None = None,
+):
+    """
+    Delete the rows a test created: its players and everything that refers to
+    them, games they played included, and its queues and regions by name.
+    Rows belonging to other tests are left alone.
+    """
+    with Session() as session:
+        queue_ids = [
+            queue_id
+            for queue_id, in session.query(Queue.id).filter(
+                Queue.name.in_(queue_names or [])
+            )
+        ]
+        queue_region_ids = [
+            queue_region_id
+            for queue_region_id, in session.query(QueueRegion.id).filter(
+                QueueRegion.name.in_(queue_region_names or [])
+            )
+        ]
+        finished_game_ids = [
+            finished_game_id
+            for finished_game_id, in session.query(FinishedGamePlayer.finished_game_id)
+            .filter(FinishedGamePlayer.player_id.in_(player_ids))
+            .distinct()
+        ]
+        in_progress_game_ids = [
+            in_progress_game_id
+            for in_progress_game_id, in session.query(
+                InProgressGamePlayer.in_progress_game_id
+            )
+            .filter(InProgressGamePlayer.player_id.in_(player_ids))
+            .distinct()
+        ] + [
+            in_progress_game_id
+            for in_progress_game_id, in session.query(InProgressGame.id).filter(
+                InProgressGame.queue_id.in_(queue_ids)
+            )
+        ]
+
+        session.query(FinishedGamePlayer).filter(
+            FinishedGamePlayer.finished_game_id.in_(finished_game_ids)
+        ).delete(synchronize_session=False)
+        session.query(FinishedGame).filter(
+            FinishedGame.id.in_(finished_game_ids)
+        ).delete(synchronize_session=False)
+        session.query(InProgressGamePlayer).filter(
+            InProgressGamePlayer.in_progress_game_id.in_(in_progress_game_ids)
+        ).delete(synchronize_session=False)
+        session.query(InProgressGame).filter(
+            InProgressGame.id.in_(in_progress_game_ids)
+        ).delete(synchronize_session=False)
+        session.query(QueuePlayer).filter(
+            or_(
+                QueuePlayer.player_id.in_(player_ids),
+                QueuePlayer.queue_id.in_(queue_ids),
+            )
+        ).delete(synchronize_session=False)
+        session.query(QueueRole).filter(QueueRole.queue_id.in_(queue_ids)).delete(
+            synchronize_session=False
+        )
+        session.query(Queue).filter(Queue.id.in_(queue_ids)).delete(
+            synchronize_session=False
+        )
+        session.query(PlayerDailyStats).filter(
+            PlayerDailyStats.player_id.in_(player_ids)
+        ).delete(synchronize_session=False)
+        session.query(PlayerRegionTrueskill).filter(
+            or_(
+                PlayerRegionTrueskill.player_id.in_(player_ids),
+                PlayerRegionTrueskill.queue_region_id.in_(queue_region_ids),
+            )
+        ).delete(synchronize_session=False)
+        session.query(QueueRegion).filter(QueueRegion.id.in_(queue_region_ids)).delete(
+            synchronize_session=False
+        )
+        session.query(Player).filter(Player.id.in_(player_ids)).delete(
+            synchronize_session=False
+        )
+        session.commit()
+
+
+def create_game(player_ids: list[int], queue_id: str | None = None) -> str:
+    """
+    Start a game with the players alternating between teams
+
+    :returns: The in progress game's id
+    """
+    with Session() as session:
+        game = InProgressGame(
+            average_trueskill=0,
+            map_full_name="",
+            map_short_name="",
+            queue_id=queue_id,
+            win_probability=0.5,
+        )
+        session.add(game)
+        session.flush()
+        for i, player_id in enumerate(player_ids):
+            session.add(
+                InProgressGamePlayer(
+                    in_progress_game_id=game.id, player_id=player_id, team=i % 2
+                )
+            )
+        session.commit()
+        return game.id
+
+
+def setup_tests():
+    create_test_tables()
     session = Session()
     # TODO: Is there a single command to just do this
     session.query(SkipMapVote).delete()
     session.query(MapVote).delete()
-    session.query(RotationMap).delete()
-    session.query(VoteableMap).delete()
     session.query(CurrentMap).delete()
     session.query(AdminRole).delete()
     session.query(QueueWaitlistPlayer).delete()
@@ -159,3 +283,7 @@ def setup_tests():
     TEST_GUILD._members = [opsayo, stork, izza, lyon]
 
     session.commit()
+    queue_state.invalidate()
+    permission_cache.invalidate()
+    in_game_index.invalidate()
+    leaderboard_service.invalidate()
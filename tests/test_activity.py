@@ -0,0 +1,62 @@
+from datetime import datetime, timedelta, timezone
+
+from pytest import fixture
+
+from discord_bots.activity import ActivityTracker
+from discord_bots.models import Player, Session
+
+from .fixtures import create_test_tables, delete_test_data
+
+PLAYER_IDS = [2001, 2002]
+
+
+@fixture(autouse=True)
+def database():
+    create_test_tables()
+    delete_test_data(PLAYER_IDS)
+    with Session() as session:
+        session.add(Player(id=PLAYER_IDS[0], name="old name"))
+        session.commit()
+    yield
+    delete_test_data(PLAYER_IDS)
+
+
+def test_record_should_buffer_known_players_until_flush():
+    seen_at = datetime.now(timezone.utc) + timedelta(minutes=1)
+    activity_tracker = ActivityTracker()
+    activity_tracker.record(PLAYER_IDS[0], "new name", seen_at - timedelta(seconds=30))
+    activity_tracker.record(PLAYER_IDS[0], "new name", seen_at)
+    assert activity_tracker.pending() == 1
+    with Session() as session:
+        assert session.query(Player).get(PLAYER_IDS[0]).name == "old name"
+
+    assert activity_tracker.flush() == 1
+    assert activity_tracker.pending() == 0
+    with Session() as session:
+        player = session.query(Player).get(PLAYER_IDS[0])
+        assert player.name == "new name"
+        assert player.last_activity_at == seen_at.replace(tzinfo=None)
+
+
+def test_record_should_write_new_players_right_away():
+    activity_tracker = ActivityTracker()
+    activity_tracker.record(PLAYER_IDS[1], "newcomer")
+
+    assert activity_tracker.pending() == 0
+    with Session() as session:
+        player = session.query(Player).get(PLAYER_IDS[1])
+        assert player.name == "newcomer"
+        assert not player.is_admin
+
+
+def test_record_without_name_update_should_only_name_new_players():
+    activity_tracker = ActivityTracker()
+    activity_tracker.record(PLAYER_IDS[0], "reaction name", update_name=False)
+    activity_tracker.record(PLAYER_IDS[1], "newcomer", update_name=False)
+
+    assert activity_tracker.flush() == 1
+    with Session() as session:
+        player = session.query(Player).get(PLAYER_IDS[0])
+        assert player.name == "old name"
+        assert player.last_activity_at is not None
+        assert session.query(Player).get(PLAYER_IDS[1]).name == "newcomer"
@@ -0,0 +1,45 @@
+from pytest import fixture
+
+from discord_bots.custom_commands import CustomCommandRegistry
+from discord_bots.models import CustomCommand, Session
+
+from .fixtures import create_test_tables
+
+COMMAND_NAMES = ["rules", "maps"]
+
+
+def delete_commands():
+    with Session() as session:
+        session.query(CustomCommand).filter(CustomCommand.name.in_(COMMAND_NAMES)).delete(
+            synchronize_session=False
+        )
+        session.commit()
+
+
+@fixture(autouse=True)
+def database():
+    create_test_tables()
+    delete_commands()
+    with Session() as session:
+        session.add(CustomCommand("rules", "Be nice"))
+        session.commit()
+    yield
+    delete_commands()
+
+
+def test_get_should_not_see_changes_until_invalidated():
+    custom_command_registry = CustomCommandRegistry()
+    assert custom_command_registry.get("rules") == "Be nice"
+    assert custom_command_registry.get("maps") is None
+
+    with Session() as session:
+        session.add(CustomCommand("maps", "Katabatic"))
+        session.commit()
+    assert custom_command_registry.get("maps") is None
+
+    with Session() as session:
+        session.query(CustomCommand).filter(CustomCommand.name == "rules").delete()
+        custom_command_registry.invalidate(session)
+        session.commit()
+    assert custom_command_registry.get("maps") == "Katabatic"
+    assert custom_command_registry.get("rules") is None
@@ -0,0 +1,137 @@
+from datetime import datetime, timezone
+
+import numpy
+import pytest
+from pytest import fixture
+from trueskill import Rating, rate
+
+from discord_bots.game_ratings import rate_game, write_game_ratings
+from discord_bots.models import (
+    FinishedGame,
+    FinishedGamePlayer,
+    Player,
+    PlayerRegionTrueskill,
+    QueueRegion,
+    Session,
+)
+
+from .fixtures import create_test_tables, delete_test_data
+
+PLAYER_IDS = [8001, 8002, 8003, 8004]
+REGION_NAME = "game ratings"
+TEAMS = [0, 1, 0, 1]
+RATINGS = [(30.0, 5.0), (25.0, 6.0), (20.0, 7.0), (15.0, 8.0)]
+
+
+def test_rate_game_should_match_trueskill():
+    game_ratings = rate_game(PLAYER_IDS, TEAMS, RATINGS, RATINGS, 1, True, False)
+
+    team0_after, team1_after = rate(
+        [
+            [Rating(*RATINGS[0]), Rating(*RATINGS[2])],
+            [Rating(*RATINGS[1]), Rating(*RATINGS[3])],
+        ],
+        [1, 0],
+    )
+    expected = [team0_after[0], team1_after[0], team0_after[1], team1_after[1]]
+    assert numpy.allclose(
+        game_ratings.rated_after, [(rating.mu, rating.sigma) for rating in expected]
+    )
+    assert numpy.array_equal(game_ratings.rated_after, game_ratings.unrated_after)
+    assert game_ratings.rated_before.tolist() == [list(rating) for rating in RATINGS]
+
+
+def test_rate_game_should_only_change_unrated_for_unrated_queues():
+    game_ratings = rate_game(PLAYER_IDS, TEAMS, RATINGS, RATINGS, -1, False, False)
+
+    assert numpy.array_equal(game_ratings.rated_after, game_ratings.rated_before)
+    assert not numpy.array_equal(game_ratings.unrated_after, game_ratings.unrated_before)
+
+
+def test_rate_game_should_not_change_isolated_or_solo_games():
+    isolated = rate_game(PLAYER_IDS, TEAMS, RATINGS, RATINGS, 0, True, True)
+    solo = rate_game(PLAYER_IDS[:1], TEAMS[:1], RATINGS[:1], RATINGS[:1], 0, True, False)
+
+    for game_ratings in (isolated, solo):
+        assert numpy.array_equal(game_ratings.rated_after, game_ratings.rated_before)
+        assert numpy.array_equal(game_ratings.unrated_after, game_ratings.unrated_before)
+
+
+@fixture
+def database():
+    create_test_tables()
+    delete_test_data(PLAYER_IDS, queue_region_names=[REGION_NAME])
+    with Session() as session:
+        for player_id in PLAYER_IDS:
+            session.add(Player(id=player_id, name=f"player{player_id}"))
+        session.commit()
+    yield
+    delete_test_data(PLAYER_IDS, queue_region_names=[REGION_NAME])
+
+
+def create_finished_game(session) -> FinishedGame:
+    finished_game = FinishedGame(
+        average_trueskill=0,
+        finished_at=datetime.now(timezone.utc),
+        game_id="game",
+        is_rated=True,
+        map_full_name="",
+        map_short_name="",
+        queue_name="LTpug",
+        queue_region_name=None,
+        started_at=datetime.now(timezone.utc),
+        team0_name="",
+        team1_name="",
+        win_probability=0.5,
+        winning_team=0,
+    )
+    session.add(finished_game)
+    session.flush()
+    return finished_game
+
+
+@pytest.mark.usefixtures("database")
+def test_write_game_ratings_should_update_players_and_upsert_regions():
+    game_ratings = rate_game(PLAYER_IDS, TEAMS, RATINGS, RATINGS, 0, True, False)
+    with Session() as session:
+        queue_region = QueueRegion(REGION_NAME)
+        session.add(queue_region)
+        session.add(
+            PlayerRegionTrueskill(
+                player_id=PLAYER_IDS[0],
+                queue_region_id=queue_region.id,
+                rated_trueskill_mu=1,
+                rated_trueskill_sigma=1,
+                unrated_trueskill_mu=1,
+                unrated_trueskill_sigma=1,
+            )
+        )
+        players = [session.query(Player).get(player_id) for player_id in PLAYER_IDS]
+        finished_game = create_finished_game(session)
+        write_game_ratings(session, finished_game.id, players, game_ratings)
+        write_game_ratings(
+            session, finished_game.id, players, game_ratings, queue_region.id
+        )
+        session.commit()
+        queue_region_id = queue_region.id
+        finished_game_id = finished_game.id
+
+    with Session() as session:
+        player = session.query(Player).get(PLAYER_IDS[0])
+        prts = (
+            session.query(PlayerRegionTrueskill)
+            .filter(PlayerRegionTrueskill.queue_region_id == queue_region_id)
+            .all()
+        )
+        fgp_count = (
+            session.query(FinishedGamePlayer)
+            .filter(FinishedGamePlayer.finished_game_id == finished_game_id)
+            .count()
+        )
+
+    assert player.rated_trueskill_mu == pytest.approx(game_ratings.rated_after[0][0])
+    assert len(prts) == len(PLAYER_IDS)
+    assert {prt.player_id: prt.rated_trueskill_mu for prt in prts}[
+        PLAYER_IDS[0]
+    ] == pytest.approx(game_ratings.rated_after[0][0])
+    assert fgp_count == 2 * len(PLAYER_IDS)
@@ -0,0 +1,45 @@
+from pytest import fixture
+
+from discord_bots.in_game import InGameIndex
+from discord_bots.models import Player, Session
+
+from .fixtures import create_game, create_test_tables, delete_test_data
+
+PLAYER_IDS = [4001, 4002, 4003]
+
+
+@fixture(autouse=True)
+def database():
+    create_test_tables()
+    delete_test_data(PLAYER_IDS)
+    with Session() as session:
+        for player_id in PLAYER_IDS:
+            session.add(Player(id=player_id, name=f"player{player_id}"))
+        session.commit()
+    yield
+    delete_test_data(PLAYER_IDS)
+
+
+def test_load_should_match_database():
+    game_id = create_game(PLAYER_IDS[:2])
+
+    in_game_index = InGameIndex()
+
+    assert in_game_index.game_id_for_player(PLAYER_IDS[0]) == game_id
+    assert in_game_index.is_in_game(PLAYER_IDS[1])
+    assert not in_game_index.is_in_game(PLAYER_IDS[2])
+
+
+def test_writes_should_track_games_and_substitutes():
+    game_id = create_game(PLAYER_IDS[:2])
+    in_game_index = InGameIndex()
+
+    in_game_index.substitute(game_id, PLAYER_IDS[1], PLAYER_IDS[2])
+    assert not in_game_index.is_in_game(PLAYER_IDS[1])
+    assert in_game_index.game_id_for_player(PLAYER_IDS[2]) == game_id
+
+    in_game_index.remove_game(game_id)
+    assert not any(in_game_index.is_in_game(player_id) for player_id in PLAYER_IDS)
+
+    in_game_index.add_game("other", [PLAYER_IDS[1]])
+    assert in_game_index.game_id_for_player(PLAYER_IDS[1]) == "other"
@@ -0,0 +1,140 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from pytest import fixture
+
+from discord_bots.leaderboard import LeaderboardEntry, LeaderboardService, Ranking
+from discord_bots.models import (
+    FinishedGame,
+    FinishedGamePlayer,
+    Player,
+    PlayerRegionTrueskill,
+    QueueRegion,
+    Session,
+)
+
+from .fixtures import create_test_tables, delete_test_data
+
+PLAYER_IDS = [6001, 6002, 6003]
+REGION_NAME = "leaderboard test region"
+
+
+def entry(player_id: int, mu: float, sigma: float = 1.0) -> LeaderboardEntry:
+    return LeaderboardEntry(player_id, f"player{player_id}", mu, sigma)
+
+
+def test_ranking_should_sort_by_leaderboard_trueskill():
+    ranking = Ranking()
+    ranking.update(entry(1, 20))
+    ranking.update(entry(2, 30))
+    ranking.update(entry(3, 30, sigma=2))
+
+    assert [e.player_id for e in ranking.top(2)] == [2, 3]
+    assert ranking.rank(1) == 3
+    assert ranking.rank(4) is None
+
+
+def test_ranking_update_should_move_player():
+    ranking = Ranking()
+    for player_id, mu in [(1, 20), (2, 25), (3, 30)]:
+        ranking.update(entry(player_id, mu))
+
+    ranking.update(entry(1, 40))
+    ranking.remove(3)
+
+    assert [e.player_id for e in ranking.top(10)] == [1, 2]
+    assert len(ranking) == 2
+
+
+@fixture
+def database():
+    create_test_tables()
+    delete_test_data(PLAYER_IDS, queue_region_names=[REGION_NAME])
+    yield
+    delete_test_data(PLAYER_IDS, queue_region_names=[REGION_NAME])
+
+
+@pytest.mark.usefixtures("database")
+def test_leaderboard_service_should_load_active_players_and_roll_off():
+    now = datetime.now(timezone.utc)
+    with Session() as session:
+        for i, player_id in enumerate(PLAYER_IDS):
+            session.add(
+                Player(id=player_id, name=f"player{player_id}", rated_trueskill_mu=20 + i)
+            )
+        for days_ago, player_ids in [(1, PLAYER_IDS[:2]), (200, PLAYER_IDS[2:])]:
+            finished_game = FinishedGame(
+                average_trueskill=0,
+                finished_at=now - timedelta(days=days_ago),
+                game_id="game",
+                is_rated=True,
+                map_full_name="",
+                map_short_name="",
+                queue_name="LTpug",
+                queue_region_name=None,
+                started_at=now - timedelta(days=days_ago),
+                team0_name="",
+                team1_name="",
+                win_probability=0.5,
+                winning_team=0,
+            )
+            session.add(finished_game)
+            session.flush()
+            for player_id in player_ids:
+                session.add(
+                    FinishedGamePlayer(
+                        finished_game_id=finished_game.id,
+                        player_id=player_id,
+                        player_name=f"player{player_id}",
+                        team=0,
+                        rated_trueskill_mu_before=0,
+                        rated_trueskill_sigma_before=0,
+                        rated_trueskill_mu_after=0,
+                        rated_trueskill_sigma_after=0,
+                        unrated_trueskill_mu_before=0,
+                        unrated_trueskill_sigma_before=0,
+                        unrated_trueskill_mu_after=0,
+                        unrated_trueskill_sigma_after=0,
+                    )
+                )
+        session.commit()
+
+    leaderboard_service = LeaderboardService(days_until_inactive=90)
+    assert [e.player_id for e in leaderboard_service.top(10)] == [PLAYER_IDS[1], PLAYER_IDS[0]]
+
+    leaderboard_service.record_game(
+        now, [entry(PLAYER_IDS[2], 30)], "region", {PLAYER_IDS[2]: (50.0, 1.0)}
+    )
+    assert leaderboard_service.rank(PLAYER_IDS[2]) == 1
+    assert leaderboard_service.rank(PLAYER_IDS[2], "region") == 1
+
+    assert leaderboard_service.roll_off(now + timedelta(days=90)) == 3
+    assert leaderboard_service.top(10, "region") == []
+
+
+@pytest.mark.usefixtures("database")
+def test_leaderboard_service_should_restore_regions_of_returning_players():
+    now = datetime.now(timezone.utc)
+    with Session() as session:
+        other_region = QueueRegion(name=REGION_NAME)
+        session.add(other_region)
+        session.add(Player(id=PLAYER_IDS[0], name=f"player{PLAYER_IDS[0]}"))
+        session.flush()
+        other_region_id = other_region.id
+        session.add(
+            PlayerRegionTrueskill(
+                player_id=PLAYER_IDS[0],
+                queue_region_id=other_region_id,
+                rated_trueskill_mu=40,
+                rated_trueskill_sigma=1,
+                unrated_trueskill_mu=40,
+                unrated_trueskill_sigma=1,
+            )
+        )
+        session.commit()
+    leaderboard_service = LeaderboardService(days_until_inactive=90)
+    leaderboard_service.load()
+
+    leaderboard_service.record_game(now, [entry(PLAYER_IDS[0], 30)], "region", {})
+
+    assert leaderboard_service.rank(PLAYER_IDS[0], other_region_id) == 1
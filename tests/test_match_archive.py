@@ -0,0 +1,165 @@
+import os
+from datetime import date, datetime
+
+import numpy
+import pytest
+from pytest import fixture
+
+from discord_bots.match_archive import (
+    _copy_chunks,
+    export_match_history,
+    import_match_history,
+)
+from discord_bots.models import (
+    FinishedGame,
+    FinishedGamePlayer,
+    Player,
+    PlayerRegionTrueskill,
+    Session,
+)
+from discord_bots.player_stats import get_player_stats
+
+from .fixtures import create_test_tables, delete_test_data
+
+PLAYER_IDS = [3101, 3102]
+
+
+def test_copy_chunks_should_encode_nulls_and_escape_strings(tmp_path):
+    table = PlayerRegionTrueskill.__table__
+    columns = {
+        "id": numpy.array(["a", "b"]),
+        "player_id": numpy.array([1, 2], dtype=numpy.int64),
+        "queue_region_id": numpy.array(["region\ttab", ""]),
+        "rated_trueskill_mu": numpy.array([25.0, 30.5]),
+        "rated_trueskill_sigma": numpy.array([8.3, 5.0]),
+        "unrated_trueskill_mu": numpy.array([25.0, 20.0]),
+        "unrated_trueskill_sigma": numpy.array([8.3, 6.0]),
+        "created_at": numpy.array(
+            [datetime(2022, 1, 2, 3, 4, 5), "NaT"], dtype="datetime64[us]"
+        ),
+    }
+    for column in table.columns:
+        numpy.save(os.path.join(tmp_path, f"{table.name}.{column.name}.npy"), columns[column.name])
+        if column.nullable:
+            numpy.save(
+                os.path.join(tmp_path, f"{table.name}.{column.name}.null.npy"),
+                numpy.isnat(columns[column.name])
+                if column.name == "created_at"
+                else numpy.zeros(2, dtype=bool),
+            )
+
+    rows = [row for chunk in _copy_chunks(table, str(tmp_path)) for row in chunk]
+
+    assert len(rows) == 2
+    by_column = dict(
+        zip(
+            [column.name for column in table.columns],
+            zip(*[row.rstrip("\n").split("\t") for row in rows]),
+        )
+    )
+    assert by_column["player_id"] == ("1", "2")
+    assert by_column["queue_region_id"] == ("region\\ttab", "")
+    assert by_column["rated_trueskill_mu"] == ("25.0", "30.5")
+    assert by_column["created_at"] == ("2022-01-02T03:04:05.000000", "\\N")
+
+
+@fixture
+def database():
+    create_test_tables()
+    delete_test_data(PLAYER_IDS)
+    with Session() as session:
+        session.add(Player(id=PLAYER_IDS[0], name="one", rated_trueskill_mu=30))
+        session.add(
+            Player(id=PLAYER_IDS[1], name="two", last_activity_at=datetime(2022, 1, 1))
+        )
+        finished_game = FinishedGame(
+            average_trueskill=25,
+            finished_at=datetime(2022, 1, 1, 1),
+            game_id="game",
+            is_rated=True,
+            map_full_name="",
+            map_short_name="",
+            queue_name="LTpug",
+            queue_region_name=None,
+            started_at=datetime(2022, 1, 1),
+            team0_name="Team 0",
+            team1_name="Team 1",
+            win_probability=0.5,
+            winning_team=0,
+        )
+        session.add(finished_game)
+        session.flush()
+        for player_id, team in zip(PLAYER_IDS, [0, 1]):
+            session.add(
+                FinishedGamePlayer(
+                    finished_game_id=finished_game.id,
+                    player_id=player_id,
+                    player_name=str(player_id),
+                    team=team,
+                    rated_trueskill_mu_before=25,
+                    rated_trueskill_sigma_before=8.3,
+                    rated_trueskill_mu_after=26,
+                    rated_trueskill_sigma_after=8,
+                    unrated_trueskill_mu_before=25,
+                    unrated_trueskill_sigma_before=8.3,
+                    unrated_trueskill_mu_after=26,
+                    unrated_trueskill_sigma_after=8,
+                )
+            )
+        session.commit()
+    yield
+    delete_test_data(PLAYER_IDS)
+
+
+def history() -> list:
+    """
+    This test's players, their games and game players
+    """
+    with Session() as session:
+        finished_game_ids = session.query(FinishedGamePlayer.finished_game_id).filter(
+            FinishedGamePlayer.player_id.in_(PLAYER_IDS)
+        )
+        return [
+            sorted(
+                (player.id, player.name, player.last_activity_at, player.rated_trueskill_mu)
+                for player in session.query(Player).filter(Player.id.in_(PLAYER_IDS))
+            ),
+            sorted(
+                (fg.id, fg.game_id, fg.finished_at, fg.queue_region_name, fg.team0_name)
+                for fg in session.query(FinishedGame).filter(
+                    FinishedGame.id.in_(finished_game_ids.scalar_subquery())
+                )
+            ),
+            sorted(
+                (fgp.id, fgp.finished_game_id, fgp.player_id, fgp.rated_trueskill_mu_after)
+                for fgp in session.query(FinishedGamePlayer).filter(
+                    FinishedGamePlayer.player_id.in_(PLAYER_IDS)
+                )
+            ),
+        ]
+
+
+@pytest.mark.usefixtures("database")
+def test_import_should_restore_exported_history(tmp_path):
+    path = str(tmp_path / "history.npz")
+    exported = history()
+    # The archive has every row in the database, not just this test's
+    with Session() as session:
+        player_count = session.query(Player).count()
+        finished_game_player_count = session.query(FinishedGamePlayer).count()
+    export_match_history(path)
+
+    delete_test_data(PLAYER_IDS[1:])
+    with Session() as session:
+        session.query(Player).filter(Player.id == PLAYER_IDS[0]).update(
+            {"rated_trueskill_mu": 0}
+        )
+        session.commit()
+    row_counts = import_match_history(path)
+
+    assert row_counts["player"] == player_count
+    assert row_counts["finished_game_player"] == finished_game_player_count
+    assert history() == exported
+    with Session() as session:
+        lifetime, _ = get_player_stats(session, PLAYER_IDS[0], date(2022, 1, 1))
+    assert (lifetime.wins, lifetime.losses, lifetime.ties) == (1, 0, 0)
@@ -0,0 +1,133 @@
+import io
+import json
+from datetime import datetime, timezone
+
+import pytest
+from pytest import fixture
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from discord_bots.match_import import (
+    ImportStats,
+    import_json_match_history,
+    imported_finished_game_id,
+    imported_match_index,
+    iter_json_array,
+)
+from discord_bots.models import Base, FinishedGame, Player, Session, engine
+from discord_bots.player_stats import get_player_stats
+
+PLAYER_IDS = [9100, 9101, 9102, 9103]
+# A fresh import deletes every player and finished game, so the import test
+# gets tables of its own in this schema
+SCHEMA = "test_match_import"
+
+
+def test_iter_json_array_should_parse_items_across_reads():
+    items = [{"name": "Zoë", "players": [1, 2]}, 12345, "a, b]", [], None, {}]
+    data = json.dumps(items, ensure_ascii=False, indent=2).encode()
+
+    for read_size in (1, 2, 7, len(data)):
+        assert list(iter_json_array(io.BytesIO(data), read_size)) == items
+    assert list(iter_json_array(io.BytesIO(b" [ ] "))) == []
+    with pytest.raises(ValueError):
+        list(iter_json_array(io.BytesIO(b'[{"a": 1}, {"b"'), 4))
+
+
+def test_imported_finished_game_ids_should_sort_by_match_index():
+    ids = [imported_finished_game_id(index) for index in (0, 9, 10, 255, 70000)]
+
+    assert sorted(ids) == ids
+    assert [imported_match_index(finished_game_id) for finished_game_id in ids] == [
+        0,
+        9,
+        10,
+        255,
+        70000,
+    ]
+    assert len(ids[0]) == 36
+
+
+def match(timestamp: int, winning_team: int, queue_name: str = "LTpug") -> dict:
+    return {
+        "queue": {"name": queue_name},
+        "timestamp": timestamp * 1000,
+        "completionTimestamp": (timestamp + 600) * 1000,
+        "winningTeam": winning_team,
+        "players": [
+            {"user": {"id": player_id, "name": f"player{i}"}, "team": 1 + i % 2}
+            for i, player_id in enumerate(PLAYER_IDS)
+        ],
+    }
+
+
+MATCHES = [
+    match(1640995200, 1),
+    match(1640998800, 2, "bottest"),
+    match(1641002400, 0, "LTunrated"),
+    match(1641006000, 2),
+    match(1641009600, 1),
+]
+
+
+class Interrupted(Exception):
+    pass
+
+
+def interrupt(stats: ImportStats) -> None:
+    raise Interrupted
+
+
+def ratings(connection: Connection) -> list[float]:
+    with Session(bind=connection) as session:
+        return [
+            rating
+            for player in session.query(Player).order_by(Player.id)
+            for rating in (player.rated_trueskill_mu, player.unrated_trueskill_mu)
+        ]
+
+
+@fixture
+def connection():
+    """
+    A connection whose search_path only has a schema of its own
+    """
+    with engine.connect() as connection:
+        with connection.begin():
+            connection.execute(text(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE"))
+            connection.execute(text(f"CREATE SCHEMA {SCHEMA}"))
+            connection.execute(text(f"SET search_path TO {SCHEMA}"))
+            Base.metadata.create_all(connection)
+        try:
+            yield connection
+        finally:
+            with connection.begin():
+                connection.execute(text("SET search_path TO DEFAULT"))
+                connection.execute(text(f"DROP SCHEMA {SCHEMA} CASCADE"))
+
+
+def test_import_should_resume_after_last_committed_match(connection):
+    data = json.dumps(MATCHES).encode()
+    stats = import_json_match_history(io.BytesIO(data), chunk_size=2, connection=connection)
+    assert stats.imported == 4
+    assert stats.skipped == 1
+    imported = ratings(connection)
+
+    with pytest.raises(Interrupted):
+        import_json_match_history(
+            io.BytesIO(data), chunk_size=2, on_chunk=interrupt, connection=connection
+        )
+    with Session(bind=connection) as session:
+        assert session.query(FinishedGame).count() == 1
+    stats = import_json_match_history(
+        io.BytesIO(data), resume=True, chunk_size=2, connection=connection
+    )
+
+    # Picks up after the first game, the skipped bottest match is read again
+    assert stats.matches == 4
+    assert ratings(connection) == pytest.approx(imported)
+    with Session(bind=connection) as session:
+        assert session.query(FinishedGame).count() == 4
+        lifetime, _ = get_player_stats(session, PLAYER_IDS[0], datetime.now(timezone.utc).date())
+    # 2 wins, a loss and a tie, counted once across the interrupted import
+    assert (lifetime.wins, lifetime.losses, lifetime.ties) == (2, 1, 1)
@@ -0,0 +1,64 @@
+from pytest import fixture
+
+from discord_bots.models import AdminRole, Player, Session
+from discord_bots.permissions import PermissionCache
+
+from .fixtures import create_test_tables, delete_test_data
+
+ADMIN_ID, BANNED_ID, PLAYER_ID = 3001, 3002, 3003
+ADMIN_ROLE_ID = 42
+
+
+def delete_admin_role():
+    with Session() as session:
+        session.query(AdminRole).filter(AdminRole.role_id == ADMIN_ROLE_ID).delete()
+        session.commit()
+
+
+@fixture(autouse=True)
+def database():
+    create_test_tables()
+    delete_admin_role()
+    delete_test_data([ADMIN_ID, BANNED_ID, PLAYER_ID])
+    with Session() as session:
+        session.add(Player(id=ADMIN_ID, name="admin", is_admin=True))
+        session.add(Player(id=BANNED_ID, name="banned", is_banned=True))
+        session.add(Player(id=PLAYER_ID, name="player"))
+        session.add(AdminRole(ADMIN_ROLE_ID))
+        session.commit()
+    yield
+    delete_admin_role()
+    delete_test_data([ADMIN_ID, BANNED_ID, PLAYER_ID])
+
+
+def test_permissions_should_match_database():
+    permission_cache = PermissionCache(ttl_seconds=300)
+
+    assert permission_cache.is_admin(ADMIN_ID)
+    assert not permission_cache.is_admin(PLAYER_ID)
+    assert permission_cache.is_admin(PLAYER_ID, {1, ADMIN_ROLE_ID})
+    assert permission_cache.is_banned(BANNED_ID)
+    assert not permission_cache.is_banned(ADMIN_ID)
+
+
+def test_writes_should_update_without_reloading():
+    permission_cache = PermissionCache(ttl_seconds=300)
+    permission_cache.load()
+    delete_admin_role()
+
+    permission_cache.set_banned(PLAYER_ID, True)
+    permission_cache.set_admin(ADMIN_ID, False)
+    assert permission_cache.is_banned(PLAYER_ID)
+    assert not permission_cache.is_admin(ADMIN_ID)
+    # Not reloaded yet
+    assert permission_cache.is_admin(PLAYER_ID, {ADMIN_ROLE_ID})
+
+    permission_cache.remove_admin_role(ADMIN_ROLE_ID)
+    assert not permission_cache.is_admin(PLAYER_ID, {ADMIN_ROLE_ID})
+
+
+def test_should_reload_once_expired():
+    permission_cache = PermissionCache(ttl_seconds=0)
+    permission_cache.set_banned(PLAYER_ID, True)
+
+    assert not permission_cache.is_banned(PLAYER_ID)
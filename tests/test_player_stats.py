@@ -0,0 +1,75 @@
+from datetime import datetime, timedelta, timezone
+
+from pytest import fixture
+
+from discord_bots.models import Player, Session
+from discord_bots.player_stats import (
+    get_player_stats,
+    get_rating_percentile,
+    record_game_outcome,
+)
+
+from .fixtures import create_test_tables, delete_test_data
+
+PLAYER_IDS = [5001, 5002, 5003]
+
+
+@fixture(autouse=True)
+def database():
+    create_test_tables()
+    delete_test_data(PLAYER_IDS)
+    with Session() as session:
+        for i, player_id in enumerate(PLAYER_IDS):
+            session.add(
+                Player(
+                    id=player_id,
+                    name=f"player{player_id}",
+                    rated_trueskill_mu=20 + i,
+                    rated_trueskill_sigma=5,
+                )
+            )
+        session.commit()
+    yield
+    delete_test_data(PLAYER_IDS)
+
+
+def test_record_game_outcome_should_count_windows_and_edits():
+    now = datetime.now(timezone.utc)
+    player_teams = [(PLAYER_IDS[0], 0), (PLAYER_IDS[1], 1)]
+    with Session() as session:
+        record_game_outcome(session, now, player_teams, 0)
+        record_game_outcome(session, now, player_teams, -1)
+        record_game_outcome(session, now - timedelta(days=40), player_teams, 1)
+        # The tie was actually a loss for team 0
+        record_game_outcome(session, now, player_teams, 1, old_winning_team=-1)
+        session.commit()
+
+        lifetime, windows = get_player_stats(session, PLAYER_IDS[0], now.date())
+
+    assert (lifetime.wins, lifetime.losses, lifetime.ties) == (1, 2, 0)
+    assert (windows[7].wins, windows[7].losses, windows[7].ties) == (1, 1, 0)
+    assert windows[30].total == 2
+    assert windows[90].total == 3
+    assert windows[7].win_rate == 50.0
+
+
+def test_get_player_stats_should_be_empty_without_games():
+    with Session() as session:
+        lifetime, windows = get_player_stats(
+            session, PLAYER_IDS[2], datetime.now(timezone.utc).date()
+        )
+
+    assert lifetime.total == 0
+    assert all(window.total == 0 for window in windows.values())
+
+
+def test_get_rating_percentile_should_count_higher_rated_players():
+    with Session() as session:
+        players = session.query(Player).filter(Player.id.in_(PLAYER_IDS)).all()
+        percentiles = {
+            player.id: get_rating_percentile(session, player) for player in players
+        }
+
+    # Other players in the database may have played as well
+    assert percentiles[PLAYER_IDS[2]] < percentiles[PLAYER_IDS[1]]
+    assert percentiles[PLAYER_IDS[1]] < percentiles[PLAYER_IDS[0]]
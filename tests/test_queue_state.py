@@ -0,0 +1,201 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from pytest import fixture
+
+from discord_bots.models import Player, Queue, QueuePlayer, QueueRole, Session
+from discord_bots.queue_state import QueueState, QueueStateManager, plan_queue_adds
+
+from .fixtures import create_test_tables, delete_test_data
+
+PLAYER_IDS = [1001, 1002, 1003]
+QUEUE_NAMES = ["LTpug", "LTgold"]
+
+
+@fixture
+def database():
+    create_test_tables()
+    delete_test_data(PLAYER_IDS, QUEUE_NAMES)
+    with Session() as session:
+        for player_id in PLAYER_IDS:
+            session.add(Player(id=player_id, name=f"player{player_id}"))
+        session.commit()
+    yield
+    delete_test_data(PLAYER_IDS, QUEUE_NAMES)
+
+
+def create_queue(name: str, size: int) -> Queue:
+    with Session(expire_on_commit=False) as session:
+        queue = Queue(name=name, size=size)
+        session.add(queue)
+        session.commit()
+        return queue
+
+
+@pytest.mark.usefixtures("database")
+def test_load_should_match_database():
+    queue = create_queue("LTpug", 2)
+    with Session() as session:
+        session.add(QueuePlayer(queue_id=queue.id, player_id=PLAYER_IDS[0]))
+        session.add(QueueRole(queue.id, 42))
+        session.commit()
+
+    queue_state = QueueStateManager()
+    queue_state.load()
+
+    cached_queue = queue_state.get(queue.id)
+    assert list(cached_queue.player_ids) == [PLAYER_IDS[0]]
+    assert cached_queue.role_ids == {42}
+    assert queue_state.queue_ids_for_player(PLAYER_IDS[0]) == {queue.id}
+    assert queue_state.status_strs() == ["LTpug [1/2]"]
+
+
+@pytest.mark.usefixtures("database")
+def test_add_player_should_write_through_and_detect_pop():
+    queue = create_queue("LTpug", 2)
+    queue_state = QueueStateManager()
+    with Session() as session:
+        assert queue_state.add_player(session, queue.id, PLAYER_IDS[0])
+        assert not queue_state.add_player(session, queue.id, PLAYER_IDS[0])
+        assert not queue_state.get(queue.id).is_full
+        assert queue_state.add_player(session, queue.id, PLAYER_IDS[1])
+        session.commit()
+
+        assert queue_state.get(queue.id).is_full
+        assert session.query(QueuePlayer).filter(QueuePlayer.queue_id == queue.id).count() == 2
+
+
+@pytest.mark.usefixtures("database")
+def test_remove_players_should_remove_from_every_queue_in_one_write():
+    lt_pug = create_queue("LTpug", 10)
+    lt_gold = create_queue("LTgold", 10)
+    queue_state = QueueStateManager()
+    with Session() as session:
+        for queue in (lt_pug, lt_gold):
+            for player_id in PLAYER_IDS:
+                queue_state.add_player(session, queue.id, player_id)
+        session.commit()
+
+        removed_from = queue_state.remove_players(session, PLAYER_IDS[:2], [lt_gold.id])
+        session.commit()
+        assert removed_from == [lt_gold.id]
+        assert list(queue_state.get(lt_gold.id).player_ids) == [PLAYER_IDS[2]]
+        assert len(queue_state.get(lt_pug.id).player_ids) == 3
+
+        removed_from = queue_state.remove_players(session, [PLAYER_IDS[2]])
+        session.commit()
+        assert removed_from == [lt_pug.id, lt_gold.id]
+        assert queue_state.queue_ids_for_player(PLAYER_IDS[2]) == set()
+
+    reloaded = QueueStateManager()
+    reloaded.load()
+    assert reloaded.status_strs() == queue_state.status_strs()
+
+
+@pytest.mark.usefixtures("database")
+def test_remove_inactive_players_should_only_remove_inactive_players():
+    queue = create_queue("LTpug", 10)
+    queue_state = QueueStateManager()
+    now = datetime.now(timezone.utc)
+    with Session() as session:
+        for player_id in PLAYER_IDS:
+            queue_state.add_player(session, queue.id, player_id)
+        session.query(Player).filter(Player.id.in_(PLAYER_IDS[:2])).update(
+            {Player.last_activity_at: now - timedelta(hours=1)},
+            synchronize_session=False,
+        )
+        session.commit()
+
+        removed = queue_state.remove_inactive_players(session, now - timedelta(minutes=45))
+        session.commit()
+        assert removed == set(PLAYER_IDS[:2])
+        assert list(queue_state.get(queue.id).player_ids) == [PLAYER_IDS[2]]
+        assert session.query(QueuePlayer).filter(QueuePlayer.queue_id == queue.id).count() == 1
+
+
+@pytest.mark.usefixtures("database")
+def test_rolled_back_writes_should_reload_the_cache():
+    queue = create_queue("LTpug", 10)
+    queue_state = QueueStateManager()
+    with Session() as session:
+        queue_state.add_player(session, queue.id, PLAYER_IDS[0])
+        assert list(queue_state.get(queue.id).player_ids) == [PLAYER_IDS[0]]
+        session.rollback()
+
+    assert list(queue_state.get(queue.id).player_ids) == []
+
+    with Session() as session:
+        queue_state.add_player(session, queue.id, PLAYER_IDS[1])
+        session.commit()
+    assert list(queue_state.get(queue.id).player_ids) == [PLAYER_IDS[1]]
+
+
+def make_queue(name: str, size: int, player_ids=(), role_ids=(), is_locked=False):
+    return QueueState(
+        id=name,
+        name=name,
+        size=size,
+        is_locked=is_locked,
+        is_isolated=False,
+        created_at=datetime(2023, 1, 1) + timedelta(minutes=len(name)),
+        role_ids=set(role_ids),
+        player_ids=dict.fromkeys(player_ids),
+    )
+
+
+def test_plan_queue_adds_should_add_to_every_eligible_queue():
+    queues = [
+        make_queue("a", 4, player_ids=[1]),
+        make_queue("b", 4, role_ids=[99]),
+        make_queue("c", 4, is_locked=True),
+        make_queue("d", 4, player_ids=[2]),
+    ]
+    role_lookups = []
+
+    def player_role_ids(player_id):
+        role_lookups.append(player_id)
+        return set()
+
+    plan = plan_queue_adds(
+        queues, [(2, ["a", "b", "c", "d"])], player_role_ids, lambda _: False
+    )
+
+    assert plan.results == [(["a"], False)]
+    assert plan.new_rows == [("a", 2)]
+    assert plan.pops == []
+    assert plan.reached_sizes == {"a": {2}}
+    assert role_lookups == [2]
+
+
+def test_plan_queue_adds_should_stop_at_the_first_queue_that_pops():
+    queues = [make_queue("a", 4, player_ids=[1]), make_queue("b", 2, player_ids=[1])]
+
+    plan = plan_queue_adds(
+        queues, [(2, ["b", "a"]), (1, ["a"]), (3, ["a"])], lambda _: set(), lambda _: False
+    )
+
+    assert plan.pops == [("b", [1, 2])]
+    # Player 2 never makes it into a, and player 1 is in a game for the
+    # second request
+    assert plan.results == [([], True), ([], False), (["a"], False)]
+    assert plan.new_rows == [("b", 2), ("a", 3)]
+
+
+def test_plan_queue_adds_should_skip_players_in_game():
+    plan = plan_queue_adds(
+        [make_queue("a", 4)], [(1, ["a"]), (2, ["a"])], lambda _: set(), lambda p: p == 1
+    )
+
+    assert plan.results == [([], False), (["a"], False)]
+    assert plan.new_rows == [("a", 2)]
+
+
+def test_plan_queue_adds_should_pop_queues_left_full():
+    queues = [make_queue("a", 2, player_ids=[1, 2, 3]), make_queue("b", 4, player_ids=[2])]
+
+    plan = plan_queue_adds(queues, [(4, ["b"])], lambda _: set(), lambda _: False)
+
+    assert plan.pops == [("a", [1, 2])]
+    assert plan.results == [(["b"], False)]
+    assert plan.new_rows == [("b", 4)]
+    assert plan.reached_sizes == {"b": {1}}
@@ -0,0 +1,77 @@
+import asyncio
+
+import pytest
+
+from discord_bots.queues import AddPlayerQueue, AddPlayerQueueMessage
+
+
+def message(player_id: int) -> AddPlayerQueueMessage:
+    return AddPlayerQueueMessage(player_id, f"player{player_id}", ["queue"], True)
+
+
+@pytest.mark.asyncio
+async def test_get_batch_should_return_everything_waiting_in_order():
+    queue = AddPlayerQueue(10)
+    for player_id in range(3):
+        await queue.put(message(player_id))
+
+    batch = await queue.get_batch()
+
+    assert [m.player_id for m in batch] == [0, 1, 2]
+    assert queue.qsize() == 0
+    assert queue.stats.max_depth == 3
+
+
+@pytest.mark.asyncio
+async def test_get_batch_should_wake_up_on_put():
+    queue = AddPlayerQueue(10)
+    consumer = asyncio.create_task(queue.get_batch())
+    await asyncio.sleep(0)
+    assert not consumer.done()
+
+    await queue.put(message(1))
+
+    batch = await asyncio.wait_for(consumer, timeout=1)
+    assert [m.player_id for m in batch] == [1]
+
+
+@pytest.mark.asyncio
+async def test_put_should_wait_for_room_when_full():
+    queue = AddPlayerQueue(1)
+    await queue.put(message(1))
+    blocked_put = asyncio.create_task(queue.put(message(2)))
+    await asyncio.sleep(0)
+    assert not blocked_put.done()
+
+    batch = await queue.get_batch()
+    await asyncio.wait_for(blocked_put, timeout=1)
+
+    assert [m.player_id for m in batch] == [1]
+    assert [m.player_id for m in queue.get_nowait_batch()] == [2]
+    assert queue.stats.blocked_puts == 1
+    assert queue.stats.puts == 2
+
+
+@pytest.mark.asyncio
+async def test_task_done_should_record_latency():
+    queue = AddPlayerQueue(10)
+    await queue.put(message(1))
+    await queue.put(message(2))
+
+    batch = await queue.get_batch()
+    queue.task_done(batch, [False, True])
+
+    assert queue.stats.processed == 2
+    assert len(queue.stats.add_latencies) == 2
+    assert len(queue.stats.pop_latencies) == 1
+    assert "2 adds in 1 batches" in queue.stats.summary()
+
+
+@pytest.mark.asyncio
+async def test_put_after_close_should_drop_message():
+    queue = AddPlayerQueue(10)
+    await queue.put(message(1))
+    queue.close()
+
+    assert not await queue.put(message(2))
+    assert [m.player_id for m in queue.get_nowait_batch()] == [1]
@@ -0,0 +1,139 @@
+from datetime import datetime, timedelta, timezone
+
+import numpy
+import pytest
+from pytest import fixture
+
+from discord_bots.game_ratings import rate_game
+from discord_bots.models import FinishedGame, FinishedGamePlayer, Player, Session
+from discord_bots.rating_replay import RatingReplay, recompute_ratings
+
+from .fixtures import create_test_tables, delete_test_data
+
+PLAYER_IDS = [9001, 9002, 9003, 9004]
+TEAMS = [0, 1, 0, 1]
+DEFAULT = numpy.array([[25.0, 8.3, 25.0, 8.3]] * 4)
+
+
+def test_replay_game_should_start_from_stored_ratings_and_chain():
+    replay = RatingReplay(PLAYER_IDS, [])
+    stored = numpy.array([[30.0, 5.0, 20.0, 6.0]] * 4)
+
+    before, after = replay.replay_game(PLAYER_IDS, TEAMS, stored, 0, True)
+    second_before, _ = replay.replay_game(PLAYER_IDS, TEAMS, DEFAULT, 1, True)
+
+    expected = rate_game(PLAYER_IDS, TEAMS, stored[:, :2], stored[:, 2:], 0, True, False)
+    assert numpy.array_equal(before, stored)
+    assert numpy.allclose(after[:, :2], expected.rated_after)
+    assert numpy.allclose(after[:, 2:], expected.unrated_after)
+    assert numpy.array_equal(second_before, after)
+    assert [rating[0] for rating in replay.replayed_ratings()] == PLAYER_IDS
+
+
+def test_replay_game_should_fall_back_to_global_ratings_in_regions():
+    replay = RatingReplay(PLAYER_IDS, ["region"])
+    _, global_after = replay.replay_game(PLAYER_IDS[:2], TEAMS[:2], DEFAULT[:2], 0, True)
+
+    before, _ = replay.replay_game(
+        PLAYER_IDS, TEAMS, DEFAULT, 0, True, queue_region_id="region"
+    )
+
+    assert numpy.array_equal(before[:2], global_after)
+    assert numpy.array_equal(before[2:], DEFAULT[2:])
+    assert len(list(replay.replayed_ratings("region"))) == 4
+    assert len(list(replay.replayed_ratings())) == 2
+
+
+def test_replay_game_should_not_change_isolated_games():
+    replay = RatingReplay(PLAYER_IDS, [])
+
+    before, after = replay.replay_game(
+        PLAYER_IDS, TEAMS, DEFAULT, 0, True, changes_ratings=False
+    )
+
+    assert numpy.array_equal(before, after)
+
+
+@fixture
+def database():
+    create_test_tables()
+    delete_test_data(PLAYER_IDS)
+    with Session() as session:
+        for player_id in PLAYER_IDS:
+            session.add(Player(id=player_id, name=f"player{player_id}"))
+        session.commit()
+    yield
+    delete_test_data(PLAYER_IDS)
+
+
+def create_finished_game(finished_at: datetime, winning_team: int) -> str:
+    with Session() as session:
+        finished_game = FinishedGame(
+            average_trueskill=0,
+            finished_at=finished_at,
+            game_id="game",
+            is_rated=True,
+            map_full_name="",
+            map_short_name="",
+            queue_name="LTpug",
+            queue_region_name=None,
+            started_at=finished_at,
+            team0_name="",
+            team1_name="",
+            win_probability=0.5,
+            winning_team=winning_team,
+        )
+        session.add(finished_game)
+        session.flush()
+        for player_id, team in zip(PLAYER_IDS, TEAMS):
+            session.add(
+                FinishedGamePlayer(
+                    finished_game_id=finished_game.id,
+                    player_id=player_id,
+                    player_name=f"player{player_id}",
+                    team=team,
+                    rated_trueskill_mu_before=25,
+                    rated_trueskill_sigma_before=8.3,
+                    rated_trueskill_mu_after=25,
+                    rated_trueskill_sigma_after=8.3,
+                    unrated_trueskill_mu_before=25,
+                    unrated_trueskill_sigma_before=8.3,
+                    # Anything different from before, so it isn't taken for an
+                    # isolated game
+                    unrated_trueskill_mu_after=0,
+                    unrated_trueskill_sigma_after=0,
+                )
+            )
+        session.commit()
+        return finished_game.id
+
+
+def player_ratings() -> list[float]:
+    with Session() as session:
+        return [
+            player.rated_trueskill_mu
+            for player in session.query(Player)
+            .filter(Player.id.in_(PLAYER_IDS))
+            .order_by(Player.id)
+        ]
+
+
+@pytest.mark.usefixtures("database")
+def test_recompute_ratings_from_game_should_match_full_recompute():
+    now = datetime.now(timezone.utc)
+    create_finished_game(now - timedelta(hours=2), 0)
+    edited_game_id = create_finished_game(now - timedelta(hours=1), 0)
+    create_finished_game(now, 1)
+
+    stats = recompute_ratings()
+    assert stats.games == 3
+
+    with Session() as session:
+        session.query(FinishedGame).get(edited_game_id).winning_team = 1
+        session.commit()
+    stats = recompute_ratings(edited_game_id)
+    assert stats.games == 2
+    from_edited_game = player_ratings()
+
+    recompute_ratings()
+    assert player_ratings() == pytest.approx(from_edited_game)
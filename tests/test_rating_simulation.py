@@ -0,0 +1,85 @@
+from random import Random
+
+import numpy
+import pytest
+import trueskill
+
+from discord_bots.rating_simulation import (
+    MatchLog,
+    TrueskillParameters,
+    prediction_metrics,
+    run_simulations,
+    simulate,
+)
+
+
+def match_log(games: int, seed: int = 1) -> MatchLog:
+    rng = Random(seed)
+    player_indexes = []
+    teams = []
+    for _ in range(games):
+        player_indexes += rng.sample(range(20), 4)
+        teams += [0, 1, 0, 1]
+    return MatchLog(
+        game_offsets=numpy.arange(0, 4 * games + 1, 4),
+        player_indexes=numpy.array(player_indexes, dtype=numpy.int32),
+        teams=numpy.array(teams, dtype=numpy.int8),
+        outcomes=numpy.array([rng.choice([0.0, 0.5, 1.0]) for _ in range(games)]),
+        region_indexes=numpy.array([rng.choice([-1, 0]) for _ in range(games)], dtype=numpy.int16),
+        win_probabilities=numpy.full(games, 0.5),
+        player_count=20,
+        region_count=1,
+    )
+
+
+def test_prediction_metrics_should_score_predictions():
+    metrics = prediction_metrics(numpy.array([0.9, 0.2, 0.5]), numpy.array([1.0, 0.0, 0.5]))
+
+    assert metrics.games == 3
+    assert metrics.brier_score == pytest.approx((0.01 + 0.04) / 3)
+    assert metrics.log_loss == pytest.approx(
+        -(numpy.log(0.9) + numpy.log(0.8) + numpy.log(0.5)) / 3
+    )
+    assert [calibration_bin.games for calibration_bin in metrics.calibration] == [1, 1, 1]
+    assert metrics.expected_calibration_error == pytest.approx(0.1)
+
+
+def test_simulate_should_predict_from_ratings_before_each_game():
+    log = MatchLog(
+        game_offsets=numpy.array([0, 2, 4]),
+        player_indexes=numpy.array([0, 1, 0, 1], dtype=numpy.int32),
+        teams=numpy.array([0, 1, 0, 1], dtype=numpy.int8),
+        outcomes=numpy.array([1.0, 1.0]),
+        region_indexes=numpy.array([-1, -1], dtype=numpy.int16),
+        win_probabilities=numpy.full(2, 0.5),
+        player_count=2,
+        region_count=0,
+    )
+
+    parameters = TrueskillParameters()
+    metrics = simulate(log, parameters)
+
+    # The first game is a coin flip, the second is predicted from the ratings
+    # after the first
+    env = trueskill.TrueSkill()
+    (winner,), (loser,) = env.rate([[env.create_rating()], [env.create_rating()]], [0, 1])
+    second_prediction = env.cdf(
+        (winner.mu - loser.mu)
+        / numpy.sqrt(2 * parameters.beta**2 + winner.sigma**2 + loser.sigma**2)
+    )
+    assert metrics.brier_score == pytest.approx(
+        ((0.5 - 1) ** 2 + (second_prediction - 1) ** 2) / 2
+    )
+
+
+def test_run_simulations_should_match_serial_simulations(tmp_path):
+    log = match_log(50)
+    parameter_sets = [TrueskillParameters(), TrueskillParameters(beta=3.0, tau=0.2)]
+
+    results = run_simulations(log, parameter_sets, workers=2)
+
+    for parameters, metrics in zip(parameter_sets, results):
+        assert metrics == simulate(log, parameters)
+
+    log.save(str(tmp_path))
+    assert simulate(MatchLog.open(str(tmp_path)), parameter_sets[0]) == results[0]
@@ -0,0 +1,88 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from discord_bots.scheduler import DeadlineScheduler
+
+
+def in_seconds(seconds: float) -> datetime:
+    return datetime.now(timezone.utc) + timedelta(seconds=seconds)
+
+
+def recording_scheduler() -> tuple[DeadlineScheduler, list[datetime]]:
+    scheduler = DeadlineScheduler("test")
+    calls: list[datetime] = []
+
+    async def callback():
+        calls.append(datetime.now(timezone.utc))
+
+    scheduler.start(callback)
+    return scheduler, calls
+
+
+@pytest.mark.asyncio
+async def test_should_fire_at_the_deadline():
+    scheduler, calls = recording_scheduler()
+    deadline = in_seconds(0.1)
+    scheduler.schedule("a", deadline)
+
+    await asyncio.sleep(0.05)
+    assert calls == []
+    await asyncio.sleep(0.1)
+    assert len(calls) == 1
+    assert calls[0] >= deadline
+    assert scheduler.pending() == 0
+
+
+@pytest.mark.asyncio
+async def test_earlier_deadline_scheduled_later_should_fire_first():
+    scheduler, calls = recording_scheduler()
+    scheduler.schedule("late", in_seconds(10))
+    await asyncio.sleep(0)
+    scheduler.schedule("early", in_seconds(0.05))
+
+    await asyncio.sleep(0.1)
+    assert len(calls) == 1
+    assert scheduler.pending() == 1
+
+
+@pytest.mark.asyncio
+async def test_deadlines_due_together_should_fire_once():
+    scheduler = DeadlineScheduler("test")
+    calls = []
+
+    async def callback():
+        calls.append(scheduler.pending())
+
+    # Naive datetimes are treated as UTC, like the ones from the database
+    past = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(seconds=1)
+    scheduler.schedule("a", past)
+    scheduler.schedule("b", past)
+    scheduler.schedule("b", past)
+    scheduler.start(callback)
+
+    await asyncio.sleep(0.05)
+    assert calls == [0]
+
+
+@pytest.mark.asyncio
+async def test_failed_call_should_be_retried():
+    scheduler = DeadlineScheduler("test", min_retry_delay=0.05)
+    calls = []
+
+    async def callback():
+        calls.append(datetime.now(timezone.utc))
+        if len(calls) == 1:
+            raise RuntimeError("database unavailable")
+
+    scheduler.schedule("a", in_seconds(0))
+    scheduler.start(callback)
+
+    await asyncio.sleep(0.02)
+    assert len(calls) == 1
+    assert scheduler.pending() == 1
+    await asyncio.sleep(0.1)
+    assert len(calls) == 2
+    assert calls[1] - calls[0] >= timedelta(seconds=0.05)
+    assert scheduler.pending() == 0
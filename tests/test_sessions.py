@@ -0,0 +1,68 @@
+import asyncio
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
+
+from discord_bots.models import Player
+from discord_bots.sessions import (
+    ConnectionLeakDetector,
+    ScopedSession,
+    closes_sessions,
+    session_scope,
+)
+
+
+def test_session_scope_should_close_sessions_created_inside():
+    outside = ScopedSession()
+    with session_scope():
+        inside = ScopedSession()
+        inside.add(Player(id=1, name="inside"))
+        outside.add(Player(id=2, name="outside"))
+
+    assert len(inside.new) == 0
+    assert len(outside.new) == 1
+
+
+def test_closes_sessions_should_leave_tasks_started_inside_alone():
+    sessions = {}
+
+    async def child():
+        sessions["child"] = ScopedSession()
+        sessions["child"].add(Player(id=1, name="child"))
+        await asyncio.sleep(0)
+
+    @closes_sessions
+    async def handler():
+        sessions["handler"] = ScopedSession()
+        sessions["handler"].add(Player(id=2, name="handler"))
+        return asyncio.get_running_loop().create_task(child())
+
+    async def run():
+        await (await handler())
+
+    asyncio.run(run())
+
+    assert len(sessions["handler"].new) == 0
+    assert len(sessions["child"].new) == 1
+
+
+def test_leak_detector_should_report_long_checkouts(tmp_path):
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'test.db'}", poolclass=QueuePool, pool_size=2, max_overflow=1
+    )
+    connection_leak_detector = ConnectionLeakDetector(threshold_seconds=0.01)
+    connection_leak_detector.attach(engine)
+
+    with engine.connect():
+        time.sleep(0.02)
+        connection = engine.connect()
+        assert connection_leak_detector.check() == 1
+        pool_status = connection_leak_detector.pool_status()
+        assert pool_status.checked_out == 2
+        assert pool_status.max_overflow == 1
+        assert pool_status.longest_checkout_seconds >= 0.02
+        connection.close()
+
+    assert connection_leak_detector.check() == 0
+    assert connection_leak_detector.pool_status().checked_out == 0
@@ -0,0 +1,69 @@
+from pytest import fixture
+from sqlalchemy import event
+
+from discord_bots.models import Player, Queue, Session, engine
+from discord_bots.snapshot import load_system_snapshot
+
+from .fixtures import create_game, create_test_tables, delete_test_data
+
+PLAYER_IDS = [7001, 7002, 7003, 7004]
+QUEUE_NAMES = ["snapshot"]
+
+
+@fixture(autouse=True)
+def database():
+    create_test_tables()
+    delete_test_data(PLAYER_IDS, QUEUE_NAMES)
+    with Session() as session:
+        for player_id in PLAYER_IDS:
+            session.add(Player(id=player_id, name=f"player{player_id}"))
+        session.commit()
+    yield
+    delete_test_data(PLAYER_IDS, QUEUE_NAMES)
+
+
+def count_queries() -> int:
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        with Session() as session:
+            load_system_snapshot(session)
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+    return len(statements)
+
+
+def test_load_system_snapshot_should_load_games_with_teams():
+    with Session() as session:
+        queue = Queue(name="snapshot", size=2)
+        session.add(queue)
+        session.commit()
+        queue_id = queue.id
+    game_id = create_game(PLAYER_IDS[:2], queue_id)
+
+    with Session() as session:
+        snapshot = load_system_snapshot(session)
+
+    (game_snapshot,) = snapshot.games_by_queue_id[queue_id]
+    assert game_snapshot.game.id == game_id
+    assert [player.id for player in game_snapshot.team0_players] == [PLAYER_IDS[0]]
+    assert [player.id for player in game_snapshot.team1_players] == [PLAYER_IDS[1]]
+    assert "snapshot [0/2] *(In game)*" in snapshot.queue_status_strs()
+
+
+def test_load_system_snapshot_should_not_query_per_game():
+    with Session() as session:
+        queue = Queue(name="snapshot", size=2)
+        session.add(queue)
+        session.commit()
+        queue_id = queue.id
+    create_game(PLAYER_IDS[:2], queue_id)
+    queries = count_queries()
+
+    create_game(PLAYER_IDS[2:], queue_id)
+
+    assert count_queries() == queries
@@ -1,5 +1,5 @@
 from datetime import datetime, timedelta, timezone
-from unittest.mock import Mock, patch
+from unittest.mock import AsyncMock, Mock, patch
 
 import pytest
 from discord.channel import TextChannel
@@ -54,6 +54,26 @@ async def test_afk_timer_with_inactive_player_should_delete_player_from_queue(bo
     assert len(queue_players) == 0
 
 
+@pytest.mark.asyncio
+@patch("discord_bots.tasks.send_message", new_callable=AsyncMock)
+@patch("discord_bots.tasks.bot")
+async def test_afk_timer_with_inactive_player_should_send_notice(bot, send_message):
+    bot.get_channel.return_value = Mock(guild=TEST_GUILD)
+    player: Player = session.query(Player).filter(Player.id == opsayo.id).first()
+    player.last_activity_at = datetime.now(timezone.utc) - timedelta(hours=1)
+    queue = Queue("ltpug", 10)
+    session.add(queue)
+    session.add(QueuePlayer(queue.id, player.id, TEST_CHANNEL.id))
+    session.commit()
+
+    await afk_timer_task()
+
+    send_message.assert_awaited_once()
+    kwargs = send_message.await_args.kwargs
+    assert kwargs["content"] == opsayo.mention
+    assert kwargs["embed_description"].startswith("opsayo removed from all queues")
+
+
 @pytest.mark.asyncio
 async def test_afk_timer_with_active_player_should_not_delete_player_from_queue():
     player: Player = session.query(Player).filter(Player.id == opsayo.id).first()
@@ -0,0 +1,230 @@
+from itertools import combinations
+from random import Random
+
+import pytest
+from pytest import approx
+from trueskill import Rating, global_env
+
+import discord_bots.config as config
+import discord_bots.teams as teams
+from discord_bots.teams import (
+    combination_indices,
+    compute_team_split,
+    get_best_and_worst_team_indices,
+    get_even_team_indices,
+    normal_cdf,
+    normal_cdf_array,
+    prefix_sum_win_probability,
+    rating_prefix_sums,
+    solve_team_split,
+)
+from discord_bots.utils import win_probability
+
+
+def reference_even_team_indices(
+    ratings: list[Rating], team_size: int
+) -> tuple[list[int], float]:
+    """
+    The search get_even_teams did before it was vectorized
+    """
+    best_win_prob_so_far: float = 0.0
+    best_teams_so_far: list[int] = []
+    indices = list(range(len(ratings)))
+    all_combinations = list(combinations(indices, team_size))
+    for team0 in all_combinations[: len(all_combinations) // 2]:
+        team1 = [i for i in indices if i not in team0]
+        win_prob = win_probability(
+            [ratings[i] for i in team0], [ratings[i] for i in team1]
+        )
+        if abs(0.50 - win_prob) < abs(0.50 - best_win_prob_so_far):
+            best_win_prob_so_far = win_prob
+            best_teams_so_far = list(team0) + team1
+    return best_teams_so_far, best_win_prob_so_far
+
+
+def random_ratings(rng: Random, n: int) -> list[Rating]:
+    return [Rating(rng.uniform(10, 40), rng.uniform(1, 8.3)) for _ in range(n)]
+
+
+def reference_win_probability(team0: list[Rating], team1: list[Rating]) -> float:
+    """
+    utils.win_probability before it used the closed form kernel
+    """
+    delta_mu = sum(r.mu for r in team0) - sum(r.mu for r in team1)
+    sum_sigma = sum(r.sigma**2 for r in team0 + team1)
+    denom = (len(team0 + team1) * (4.1666 * 4.1666) + sum_sigma) ** 0.5
+    return global_env().cdf(delta_mu / denom)
+
+
+def test_normal_cdf_should_match_trueskill():
+    cdf = global_env().cdf
+    values = [i / 100 for i in range(-800, 801)] + [-40.0, 1e-12, 40.0]
+    for value in values:
+        assert normal_cdf(value) == approx(cdf(value), abs=1e-9)
+    assert normal_cdf_array(values).tolist() == approx(
+        [cdf(value) for value in values], abs=1e-9
+    )
+
+
+@pytest.mark.parametrize("n", [2, 3, 4, 10, 17, 32])
+def test_prefix_sum_win_probability_should_match_reference(n):
+    rng = Random(n)
+    for _ in range(50):
+        ratings = random_ratings(rng, n)
+        team_size = rng.randint(1, n - 1)
+        mu_sums, sigma_squared_sums = rating_prefix_sums(
+            [r.mu for r in ratings], [r.sigma for r in ratings]
+        )
+        assert prefix_sum_win_probability(
+            mu_sums, sigma_squared_sums, team_size
+        ) == approx(
+            reference_win_probability(ratings[:team_size], ratings[team_size:]),
+            abs=1e-9,
+        )
+        assert win_probability(ratings[:team_size], ratings[team_size:]) == approx(
+            reference_win_probability(ratings[:team_size], ratings[team_size:]),
+            abs=1e-9,
+        )
+
+
+@pytest.mark.parametrize("n,k", [(5, 2), (6, 2), (7, 3), (8, 4), (9, 4)])
+def test_combination_indices_should_match_itertools(n, k):
+    assert [tuple(row) for row in combination_indices(n, k).tolist()] == list(
+        combinations(range(n), k)
+    )
+
+
+@pytest.mark.parametrize("n", [2, 3, 4, 5, 6, 8, 10, 12])
+def test_get_even_team_indices_should_match_reference(n):
+    rng = Random(n)
+    for _ in range(20):
+        ratings = random_ratings(rng, n)
+        assert get_even_team_indices(ratings, n // 2) == reference_even_team_indices(
+            ratings, n // 2
+        )
+
+
+def test_get_even_team_indices_with_identical_ratings_should_pick_first_split():
+    ratings = [Rating(25, 8.333) for _ in range(10)]
+    assert get_even_team_indices(ratings, 5) == reference_even_team_indices(
+        ratings, 5
+    )
+
+
+def test_get_even_team_indices_with_repeated_ratings_should_match_reference():
+    rng = Random(0)
+    pool = random_ratings(rng, 3)
+    for _ in range(20):
+        ratings = [rng.choice(pool) for _ in range(10)]
+        assert get_even_team_indices(ratings, 5) == reference_even_team_indices(
+            ratings, 5
+        )
+
+
+@pytest.mark.parametrize("n", [4, 5, 8, 9, 12])
+def test_get_best_and_worst_team_indices_should_match_sorting_every_split(n):
+    ratings = random_ratings(Random(n), n)
+    all_combinations = list(combinations(range(n), n // 2))
+    scored = []
+    for team0 in all_combinations[: len(all_combinations) // 2]:
+        team1 = [i for i in range(n) if i not in team0]
+        evenness = abs(
+            0.5
+            - win_probability([ratings[i] for i in team0], [ratings[i] for i in team1])
+        )
+        scored.append((evenness, list(team0) + team1))
+
+    best, worst = get_best_and_worst_team_indices(ratings, n // 2, 5, 2)
+
+    expected_best = sorted(scored, key=lambda x: x[0])[:5]
+    expected_worst = sorted(scored, key=lambda x: -x[0])[:2]
+    assert [indices for _, indices in best] == [i for _, i in expected_best]
+    assert [indices for _, indices in worst] == [i for _, i in expected_worst]
+    assert [e for e, _ in best] == approx([e for e, _ in expected_best], abs=1e-12)
+    assert [e for e, _ in worst] == approx([e for e, _ in expected_worst], abs=1e-12)
+
+
+def test_get_best_and_worst_team_indices_should_stream_across_chunks(monkeypatch):
+    monkeypatch.setattr(teams, "SPLIT_CHUNK_SIZE", 7)
+    ratings = random_ratings(Random(3), 10)
+    chunked = get_best_and_worst_team_indices(ratings, 5, 5, 1)
+    monkeypatch.setattr(teams, "SPLIT_CHUNK_SIZE", 2**16)
+    assert chunked == get_best_and_worst_team_indices(ratings, 5, 5, 1)
+
+
+@pytest.mark.parametrize("n", [4, 5, 8, 11, 14])
+def test_solve_team_split_exact_should_be_as_even_as_exhaustive(n):
+    rng = Random(n)
+    for _ in range(10):
+        ratings = random_ratings(rng, n)
+        exact = solve_team_split(ratings, n // 2, "exact")
+        # With an odd number of players the exhaustive search only looks at
+        # half of the splits, so compare against every split instead
+        best_evenness = min(
+            abs(
+                0.5
+                - win_probability(
+                    [ratings[i] for i in team0],
+                    [ratings[i] for i in range(n) if i not in team0],
+                )
+            )
+            for team0 in combinations(range(n), n // 2)
+        )
+        assert exact.is_optimal
+        assert sorted(exact.indices) == list(range(n))
+        assert exact.evenness == approx(best_evenness, abs=1e-9)
+
+
+@pytest.mark.parametrize("n", [6, 7, 30, 48])
+def test_solve_team_split_heuristic_should_return_valid_split(n):
+    ratings = random_ratings(Random(n), n)
+    team_split = solve_team_split(ratings, n // 2, "heuristic")
+    assert team_split.solver == "heuristic"
+    assert sorted(team_split.indices) == list(range(n))
+    team0 = [ratings[i] for i in team_split.indices[: n // 2]]
+    team1 = [ratings[i] for i in team_split.indices[n // 2 :]]
+    assert team_split.win_probability == approx(win_probability(team0, team1))
+    assert team_split.evenness < 0.05
+
+
+def test_solve_team_split_auto_should_pick_solver_by_size():
+    rng = Random(0)
+    assert solve_team_split(random_ratings(rng, 10), 5).solver == "exhaustive"
+    assert (
+        solve_team_split(random_ratings(rng, 24), 12, exact_max_size=30).solver
+        == "exact"
+    )
+    assert (
+        solve_team_split(random_ratings(rng, 24), 12, exact_max_size=22).solver
+        == "heuristic"
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("n", [10, 16])
+async def test_compute_team_split_should_match_solve_team_split(n):
+    ratings = random_ratings(Random(n), n)
+    team_split = await compute_team_split(
+        [(r.mu, r.sigma) for r in ratings], n // 2, "exhaustive"
+    )
+    assert team_split == solve_team_split(ratings, n // 2, "exhaustive")
+
+
+@pytest.mark.asyncio
+async def test_compute_team_split_with_saturated_pool_should_fall_back(monkeypatch):
+    monkeypatch.setitem(teams._in_flight, "thread", config.TEAM_SOLVER_WORKERS)
+    ratings = random_ratings(Random(0), 10)
+    team_split = await compute_team_split(
+        [(r.mu, r.sigma) for r in ratings], 5, "exhaustive"
+    )
+    assert team_split.solver == "heuristic"
+    assert sorted(team_split.indices) == list(range(10))
+
+
+@pytest.mark.asyncio
+async def test_compute_team_split_with_timeout_should_fall_back():
+    ratings = random_ratings(Random(0), 10)
+    team_split = await compute_team_split(
+        [(r.mu, r.sigma) for r in ratings], 5, "exhaustive", timeout_seconds=0
+    )
+    assert team_split.solver == "heuristic"
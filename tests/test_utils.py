@@ -0,0 +1,14 @@
+from discord_bots.utils import ilike
+
+
+def test_ilike_should_match_like_postgres():
+    assert ilike("LTpug", "ltpug")
+    assert ilike("LTpug", "lt%")
+    assert ilike("LTpug", "%PUG")
+    assert ilike("LTpug", "lt_ug")
+    assert not ilike("LTpug", "lt")
+    assert not ilike("LTpug", "lt_")
+    assert ilike("50%", "50\\%")
+    assert not ilike("500", "50\\%")
+    assert ilike("a.b", "a.b")
+    assert not ilike("axb", "a.b")